@@ -0,0 +1,206 @@
+"""
+Answer lookups of nonexistent accounts without reading their files.
+
+Brute-force and misdirected logins mostly ask for addresses
+that do not exist.  `AccountFilter` keeps a Bloom filter
+of the account directories in ``mailboxes_dir`` and a small cache
+of addresses recently found missing.
+
+Accounts are created and deleted by other processes as well,
+e.g. by other doveauth workers, the admin helpers or ``chatmail-expire``.
+Both only answer "missing" while the modification time
+of ``mailboxes_dir``, which changes whenever an account directory
+is added or removed, is the same as when they were filled.
+Checking this costs one ``stat`` of ``mailboxes_dir`` per lookup.
+Because file systems update modification times with a coarse clock,
+nothing is answered from the filter or the cache
+within ``settle_time`` seconds after ``mailboxes_dir`` changed.
+The first filter is built on a background thread when a doveauth
+worker starts, so it is ready for the burst of lookups after a restart.
+A stale filter is rebuilt at most every ``rebuild_interval`` seconds
+on a background thread because listing ``mailboxes_dir`` takes long
+with many accounts.  Until the new filter is ready lookups fall back
+to the filesystem and to the negative cache.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+
+class BloomFilter:
+    """Set membership test without false negatives
+    and with a false positive rate of about ``error_rate``
+    for up to ``capacity`` items."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.num_bits = max(
+            64, int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def get_positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for pos in self.get_positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(
+            bits[pos >> 3] & (1 << (pos & 7)) for pos in self.get_positions(item)
+        )
+
+
+class AccountFilter:
+    """Tell whether an account certainly does not exist."""
+
+    # seconds between rebuilds of a stale filter
+    rebuild_interval = 10.0
+
+    # maximum number of addresses in the negative cache
+    negative_cache_size = 10000
+
+    # seconds after a change of mailboxes_dir during which
+    # further changes may not change its modification time
+    settle_time = 1.0
+
+    def __init__(
+        self, mailboxes_dir, negative_ttl=5.0, stats=None, clock=time.monotonic
+    ):
+        self.mailboxes_dir = mailboxes_dir
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        # Bloom filter and the mailboxes_dir version it was built for
+        self.filter = (None, None)
+        self.last_build = None
+        self.build_thread = None
+        self.missing = OrderedDict()
+        self.lock = Lock()
+        self.stats = stats
+        if stats is not None:
+            self.skipped = stats.counter(
+                "doveauth_missing_account_lookups_total",
+                "number of lookups of nonexistent accounts answered "
+                "without reading account files",
+            )
+            self.rebuilds = stats.counter(
+                "doveauth_account_filter_builds_total",
+                "number of times the account filter was built from mailboxes_dir",
+            )
+            self.skipped.inc(amount=0)
+            self.rebuilds.inc(amount=0)
+
+    def get_version(self):
+        """Return the modification time of ``mailboxes_dir``
+        or None if it does not exist or changed less than
+        ``settle_time`` seconds ago."""
+        try:
+            mtime = os.stat(self.mailboxes_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if time.time_ns() - mtime < self.settle_time * 1e9:
+            return None
+        return mtime
+
+    def is_missing(self, addr, version):
+        """Return True if ``addr`` certainly has no account.
+
+        ``version`` is the result of `get_version` before the lookup.
+        """
+        if version is None:
+            return False
+        if version != self.filter[1]:
+            self.maybe_rebuild(version)
+
+        bloom, bloom_version = self.filter
+        missing = False
+        if bloom_version == version and addr not in bloom:
+            missing = True
+        else:
+            with self.lock:
+                entry = self.missing.get(addr)
+            if entry is not None:
+                recorded_version, expires = entry
+                missing = recorded_version == version and expires > self.clock()
+
+        if missing and self.stats is not None:
+            with self.stats.lock:
+                self.skipped.inc()
+        return missing
+
+    def record_missing(self, addr, version):
+        """Remember that ``addr`` had no account when ``mailboxes_dir``
+        had the modification time ``version``."""
+        if version is None or not self.negative_ttl:
+            return
+        with self.lock:
+            self.missing[addr] = (version, self.clock() + self.negative_ttl)
+            self.missing.move_to_end(addr)
+            while len(self.missing) > self.negative_cache_size:
+                self.missing.popitem(last=False)
+
+    def add(self, addr):
+        """Record an account created by this process."""
+        with self.lock:
+            self.missing.pop(addr, None)
+        bloom = self.filter[0]
+        if bloom is not None:
+            bloom.add(addr)
+
+    def start(self):
+        """Start building the filter before the first lookup.
+
+        If ``mailboxes_dir`` changed too recently the build is left
+        to the first lookup after ``settle_time``.
+        """
+        version = self.get_version()
+        if version is not None:
+            self.maybe_rebuild(version)
+
+    def maybe_rebuild(self, version):
+        """Start building a filter for ``version`` in the background
+        unless a build is running or started recently."""
+        with self.lock:
+            if self.build_thread is not None and self.build_thread.is_alive():
+                return
+            now = self.clock()
+            if self.last_build is not None and (
+                now - self.last_build < self.rebuild_interval
+            ):
+                return
+            self.last_build = now
+            self.build_thread = Thread(
+                target=self.build, args=(version,), name="account-filter", daemon=True
+            )
+            self.build_thread.start()
+
+    def build(self, version):
+        """Fill a new filter with all account directories.
+
+        ``version`` must be read before listing so that accounts
+        added while listing make the new filter stale.
+        """
+        try:
+            with os.scandir(self.mailboxes_dir) as entries:
+                addresses = [entry.name for entry in entries if "@" in entry.name]
+        except OSError:
+            logging.exception("could not build the account filter")
+            return
+        bloom = BloomFilter(2 * len(addresses) + 1000)
+        for addr in addresses:
+            bloom.add(addr)
+        self.filter = (bloom, version)
+        if self.stats is not None:
+            with self.stats.lock:
+                self.rebuilds.inc()
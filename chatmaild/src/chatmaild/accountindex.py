@@ -0,0 +1,281 @@
+"""
+Persistent index of all accounts.
+
+Listing all accounts otherwise means listing ``mailboxes_dir``
+and reading a ``stat`` of every password file, which takes long
+on servers with many accounts.  With ``account_index = True``
+the accounts are kept in an SQLite database in WAL mode next to
+``mailboxes_dir``, with one row per account holding its address,
+creation time, last login day and, as recorded by ``chatmail-expire``,
+the number and total size of its messages.
+
+The index is updated where accounts change: when a password is set,
+when the last login day changes, and when the admin helpers
+or ``chatmail-expire`` delete an account.  Failing updates are logged
+and do not fail these operations.  Changes made by other means,
+e.g. removing a mailbox by hand, are picked up by::
+
+    chatmail-account-index /usr/local/lib/chatmaild/chatmail.ini reconcile
+
+which compares the index with ``mailboxes_dir`` and fixes all differences.
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import namedtuple
+from pathlib import Path
+
+from chatmaild.layout import iter_maildirs
+
+Account = namedtuple("Account", ("addr", "created", "last_login", "messages", "size"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    addr TEXT PRIMARY KEY,
+    created INTEGER NOT NULL,
+    last_login INTEGER,
+    messages INTEGER,
+    size INTEGER
+) WITHOUT ROWID
+"""
+
+# number of addresses read from the index per query when iterating
+PAGE_SIZE = 1000
+
+
+class AccountIndex:
+    """SQLite database of all accounts.
+
+    Every thread, and every forked process, uses its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.local = threading.local()
+
+    def get_connection(self):
+        local = self.local
+        if getattr(local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def update(self, query, *args):
+        """Execute a modifying ``query`` and log instead of raising errors."""
+        try:
+            self.get_connection().execute(query, args)
+        except sqlite3.Error:
+            logging.exception(f"could not update account index {self.path}")
+
+    def add(self, addr, created):
+        """Record the account ``addr`` unless it is already recorded."""
+        self.update(
+            "INSERT INTO accounts (addr, created) VALUES (?, ?) "
+            "ON CONFLICT (addr) DO NOTHING",
+            addr,
+            int(created),
+        )
+
+    def set_last_login(self, addr, timestamp):
+        self.update(
+            "INSERT INTO accounts (addr, created, last_login) VALUES (?, ?, ?) "
+            "ON CONFLICT (addr) DO UPDATE SET last_login = excluded.last_login",
+            addr,
+            int(timestamp),
+            int(timestamp),
+        )
+
+    def remove(self, addr):
+        self.update("DELETE FROM accounts WHERE addr = ?", addr)
+
+    def set_usage(self, usage):
+        """Record the number and size of messages
+        from ``(addr, messages, size)`` tuples."""
+        try:
+            with self.transaction() as conn:
+                conn.executemany(
+                    "UPDATE accounts SET messages = ?, size = ? WHERE addr = ?",
+                    [(messages, size, addr) for addr, messages, size in usage],
+                )
+        except sqlite3.Error:
+            logging.exception(f"could not update account index {self.path}")
+
+    def transaction(self):
+        return Transaction(self.get_connection())
+
+    def get(self, addr):
+        """Return the `Account` of ``addr`` or None."""
+        row = (
+            self.get_connection()
+            .execute("SELECT * FROM accounts WHERE addr = ?", (addr,))
+            .fetchone()
+        )
+        return None if row is None else Account(*row)
+
+    def iter_addresses(self, page_size=PAGE_SIZE):
+        """Yield all addresses in sorted order.
+
+        Addresses are read in pages with separate queries, so the iterator
+        can be advanced from different threads.
+        """
+        last = ""
+        while True:
+            rows = (
+                self.get_connection()
+                .execute(
+                    "SELECT addr FROM accounts WHERE addr > ? ORDER BY addr LIMIT ?",
+                    (last, page_size),
+                )
+                .fetchall()
+            )
+            for (addr,) in rows:
+                yield addr
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def get_accounts(self, limit=None, suffix=None):
+        """Return the `Account` tuples of all accounts sorted by address,
+        only those whose address ends with ``suffix`` if given."""
+        query = "SELECT * FROM accounts"
+        args = []
+        if suffix:
+            query += " WHERE substr(addr, ?) = ?"
+            args = [-len(suffix), suffix]
+        query += " ORDER BY addr"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        rows = self.get_connection().execute(query, args)
+        return [Account(*row) for row in rows]
+
+    def count(self, prefixes=()):
+        """Return the number of accounts, only those with one of the
+        address ``prefixes`` if given."""
+        query = "SELECT COUNT(*) FROM accounts"
+        if prefixes:
+            query += " WHERE " + " OR ".join("substr(addr, 1, ?) = ?" for _ in prefixes)
+        args = [arg for prefix in prefixes for arg in (len(prefix), prefix)]
+        return self.get_connection().execute(query, args).fetchone()[0]
+
+    def reconcile(self, config):
+        """Make the index match the accounts in ``mailboxes_dir``
+        and return the numbers of added, removed and updated accounts."""
+        on_disk = dict(scan_accounts(config))
+        with self.transaction() as conn:
+            indexed = dict(conn.execute("SELECT addr, last_login FROM accounts"))
+
+        added = []
+        updated = []
+        for addr, last_login in on_disk.items():
+            if addr not in indexed:
+                added.append(addr)
+            elif indexed[addr] != last_login:
+                updated.append((last_login, addr))
+        removed = [addr for addr in indexed if addr not in on_disk]
+
+        # accounts may have been created or deleted while scanning,
+        # only apply changes which are still true
+        def exists(addr):
+            return get_last_login(config.get_user(addr).password_path) is not None
+
+        added = [addr for addr in added if exists(addr)]
+        removed = [addr for addr in removed if not exists(addr)]
+
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO accounts (addr, created, last_login) VALUES (?, ?, ?) "
+                "ON CONFLICT (addr) DO NOTHING",
+                # the creation time is not known, use the last login
+                [(addr, on_disk[addr], on_disk[addr]) for addr in added],
+            )
+            conn.executemany(
+                "DELETE FROM accounts WHERE addr = ?", [(addr,) for addr in removed]
+            )
+            conn.executemany(
+                "UPDATE accounts SET last_login = ? WHERE addr = ?", updated
+            )
+        return len(added), len(removed), len(updated)
+
+
+class Transaction:
+    """Context manager running statements in one immediate transaction."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def get_last_login(password_path):
+    """Return the last login time of a password file
+    or None if it is missing or empty."""
+    try:
+        st = os.stat(password_path)
+    except FileNotFoundError:
+        return None
+    return int(st.st_mtime) if st.st_size > 0 else None
+
+
+def scan_accounts(config):
+    """Yield the address and last login time of all accounts
+    with a non-empty password file in ``mailboxes_dir``."""
+    for addr, maildir in iter_maildirs(config.mailboxes_dir):
+        last_login = get_last_login(os.path.join(maildir, "password"))
+        if last_login is not None:
+            yield addr, last_login
+
+
+def main(args=None):
+    """Maintain the account index of a chatmail server"""
+    from chatmaild.config import read_config
+
+    parser = ArgumentParser(description=main.__doc__)
+    ini = "/usr/local/lib/chatmaild/chatmail.ini"
+    parser.add_argument(
+        "chatmail_ini",
+        action="store",
+        nargs="?",
+        help=f"path pointing to chatmail.ini file, default: {ini}",
+        default=ini,
+    )
+    parser.add_argument(
+        "command",
+        choices=["reconcile", "count"],
+        help="'reconcile' updates the index from mailboxes_dir, "
+        "'count' prints the number of indexed accounts",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    if config.account_index is None:
+        print("account index is disabled", file=sys.stderr)
+        return
+
+    if args.command == "count":
+        print(config.account_index.count())
+        return
+
+    start = time.time()
+    added, removed, updated = config.account_index.reconcile(config)
+    print(
+        f"added {added}, removed {removed} and updated {updated} accounts "
+        f"of {config.account_index.path} in {time.time() - start:2.2f} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,295 @@
+"""
+Daily activity log of accounts.
+
+The last login of an account is otherwise only known from the
+modification time of its password file, so counting active users
+means a ``stat`` of every mailbox.  With ``activity_log = True``
+the lastlogin dict proxy also records every login day in a directory
+next to ``mailboxes_dir``:
+
+``accounts``
+    one address per line, the line number (starting with 0)
+    is the stable number of the account in all bitmaps.
+    Lines of deleted accounts are blanked, their numbers are not reused.
+
+``YYYY-MM-DD.active``
+    bitmap of the accounts which logged in on that day,
+    bit ``n % 8`` of byte ``n // 8`` belongs to account ``n``.
+
+``YYYY-MM-DD.new``
+    bitmap of the accounts which were recorded for the first time that day.
+
+Questions like "how many accounts were active in the last 30 days"
+are answered from these few small files::
+
+    chatmail-activity /usr/local/lib/chatmaild/chatmail.ini active --days 1 7 30
+    chatmail-activity /usr/local/lib/chatmaild/chatmail.ini retention --days 30
+
+Bitmaps older than ``activity_log_days`` are removed by ``chatmail-expire``.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import filelock
+
+from chatmaild.user import get_daytimestamp
+
+
+def get_day_name(day):
+    """Return the ``YYYY-MM-DD`` name of the UTC day of timestamp ``day``."""
+    return datetime.fromtimestamp(day, timezone.utc).strftime("%Y-%m-%d")
+
+
+def parse_day_name(name):
+    day = datetime.strptime(name, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return int(day.timestamp())
+
+
+def set_bits(path, numbers):
+    """Set the bits ``numbers`` in the bitmap file ``path``."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        for num in sorted(numbers):
+            offset = num // 8
+            old = os.pread(fd, 1, offset)
+            value = (old[0] if old else 0) | (1 << (num % 8))
+            os.pwrite(fd, bytes((value,)), offset)
+    finally:
+        os.close(fd)
+
+
+class ActivityLog:
+    """Per-day bitmaps of active accounts in ``directory``."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.accounts_path = self.directory.joinpath("accounts")
+        self.lock_path = self.directory.joinpath("lock")
+        self.lock = threading.Lock()
+        # numbers of the addresses read from the accounts file so far
+        # and the offsets of their lines, see `drop_forgotten`
+        self.numbers = {}
+        self.offsets = {}
+        self.num_lines = 0
+        self.read_offset = 0
+
+    def get_bitmap_path(self, day, kind):
+        return self.directory.joinpath(f"{get_day_name(day)}.{kind}")
+
+    def read_accounts(self):
+        """Read lines appended to the accounts file by any process
+        since the last call.  Call while holding ``lock``."""
+        try:
+            with self.accounts_path.open("rb") as f:
+                f.seek(self.read_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # ignore an incomplete last line
+        data = data[: data.rfind(b"\n") + 1]
+        offset = self.read_offset
+        self.read_offset += len(data)
+        for line in data.splitlines(keepends=True):
+            addr = line.decode().strip()
+            if addr:
+                self.numbers[addr] = self.num_lines
+                self.offsets[addr] = offset
+            self.num_lines += 1
+            offset += len(line)
+
+    def drop_forgotten(self, addrs):
+        """Drop the numbers of ``addrs`` whose lines were blanked
+        by `forget` in another process since they were read,
+        so that re-created accounts get a new line.
+        Call while holding ``lock``."""
+        known = [addr for addr in addrs if addr in self.numbers]
+        if not known:
+            return
+        with self.accounts_path.open("rb") as f:
+            for addr in known:
+                line = f"{addr}\n".encode()
+                f.seek(self.offsets[addr])
+                if f.read(len(line)) != line:
+                    del self.numbers[addr]
+                    del self.offsets[addr]
+
+    def record(self, days):
+        """Mark the accounts of the ``{addr: timestamp}`` dict
+        as active on the day of their timestamp."""
+        try:
+            self.directory.mkdir(exist_ok=True)
+            with self.lock, filelock.FileLock(self.lock_path):
+                self.read_accounts()
+                self.drop_forgotten(days)
+                new = [addr for addr in days if addr not in self.numbers]
+                if new:
+                    with self.accounts_path.open("a") as f:
+                        f.write("".join(f"{addr}\n" for addr in new))
+                    self.read_accounts()
+
+                active = defaultdict(list)
+                first = defaultdict(list)
+                for addr, timestamp in days.items():
+                    day = get_daytimestamp(timestamp)
+                    active[day].append(self.numbers[addr])
+                    if addr in new:
+                        first[day].append(self.numbers[addr])
+                for kind, bits in (("active", active), ("new", first)):
+                    for day, numbers in bits.items():
+                        set_bits(self.get_bitmap_path(day, kind), numbers)
+        except OSError:
+            logging.exception(f"could not update activity log {self.directory}")
+
+    def forget(self, addr):
+        """Blank the line of a deleted account in the accounts file."""
+        if not self.accounts_path.exists():
+            return
+        try:
+            with self.lock, filelock.FileLock(self.lock_path):
+                line = f"{addr}\n".encode()
+                with self.accounts_path.open("r+b") as f:
+                    data = f.read()
+                    offset = 0 if data.startswith(line) else data.find(b"\n" + line)
+                    if offset < 0:
+                        return
+                    if offset > 0:
+                        offset += 1
+                    f.seek(offset)
+                    f.write(b" " * len(addr))
+                self.numbers.pop(addr, None)
+                self.offsets.pop(addr, None)
+        except OSError:
+            logging.exception(f"could not update activity log {self.directory}")
+
+    def read_bitmap(self, day, kind="active"):
+        """Return the bitmap of ``day`` as an integer."""
+        try:
+            data = self.get_bitmap_path(day, kind).read_bytes()
+        except FileNotFoundError:
+            return 0
+        return int.from_bytes(data, "little")
+
+    def count_active(self, now, days):
+        """Return the number of accounts active on any of the ``days``
+        days up to and including the day of ``now``."""
+        today = get_daytimestamp(now)
+        bitmap = 0
+        for i in range(days):
+            bitmap |= self.read_bitmap(today - i * 86400)
+        return bitmap.bit_count()
+
+    def get_retention(self, start, days):
+        """Return the number of accounts first recorded on the day of ``start``
+        followed by how many of them were active on each of the next ``days`` days."""
+        start = get_daytimestamp(start)
+        cohort = self.read_bitmap(start, "new")
+        counts = [cohort.bit_count()]
+        for i in range(1, days + 1):
+            counts.append((cohort & self.read_bitmap(start + i * 86400)).bit_count())
+        return counts
+
+    def prune(self, now, keep_days):
+        """Remove bitmaps of days older than ``keep_days`` days
+        and return the number of removed files."""
+        cutoff = get_daytimestamp(now) - keep_days * 86400
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            day_name, _, kind = name.partition(".")
+            if kind not in ("active", "new"):
+                continue
+            try:
+                day = parse_day_name(day_name)
+            except ValueError:
+                continue
+            if day < cutoff:
+                self.directory.joinpath(name).unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+
+def main(args=None):
+    """Show numbers of active accounts from the activity log"""
+    from chatmaild.config import read_config
+
+    parser = ArgumentParser(description=main.__doc__)
+    ini = "/usr/local/lib/chatmaild/chatmail.ini"
+    parser.add_argument(
+        "chatmail_ini",
+        action="store",
+        nargs="?",
+        help=f"path pointing to chatmail.ini file, default: {ini}",
+        default=ini,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    active = subparsers.add_parser(
+        "active", help="print the number of accounts active in the last days"
+    )
+    active.add_argument(
+        "--days",
+        type=int,
+        nargs="+",
+        default=[1, 7, 30],
+        help="numbers of days to count active accounts for, default: 1 7 30",
+    )
+    retention = subparsers.add_parser(
+        "retention",
+        help="print how many accounts first seen on a day logged in on later days",
+    )
+    retention.add_argument(
+        "--start",
+        help="day the accounts were first seen as YYYY-MM-DD, "
+        "default: the given number of days ago",
+    )
+    retention.add_argument(
+        "--days", type=int, default=30, help="number of following days, default: 30"
+    )
+    prune = subparsers.add_parser(
+        "prune", help="remove bitmaps older than activity_log_days"
+    )
+    prune.add_argument(
+        "--days",
+        type=int,
+        default=None,
+        help="number of days to keep, default: activity_log_days",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    log = config.activity_log
+    if log is None:
+        print("activity log is disabled", file=sys.stderr)
+        return
+
+    now = time.time()
+    if args.command == "active":
+        for days in args.days:
+            print(f"active in last {days} days: {log.count_active(now, days)}")
+    elif args.command == "retention":
+        if args.start:
+            start = parse_day_name(args.start)
+        else:
+            start = now - args.days * 86400
+        counts = log.get_retention(start, args.days)
+        print(f"{get_day_name(start)}: {counts[0]} new accounts")
+        for i, count in enumerate(counts[1:], 1):
+            percent = 100 * count / counts[0] if counts[0] else 0
+            print(f"day {i}: {count} ({percent:.1f}%)")
+    else:
+        keep_days = config.activity_log_days if args.days is None else args.days
+        print(f"removed {log.prune(now, keep_days)} bitmaps")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
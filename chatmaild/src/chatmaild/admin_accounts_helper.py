@@ -7,10 +7,12 @@ files can be read with the correct permissions.
 from __future__ import annotations
 
 import json
+import os
 from pathlib import Path
 from typing import Any, Optional
 
 from chatmaild.config import Config, read_config
+from chatmaild.layout import iter_maildirs
 
 CONFIG_PATH = "/usr/local/lib/chatmaild/chatmail.ini"
 
@@ -21,27 +23,36 @@ def list_accounts(
     """Return a list of existing accounts.
 
     An account is considered to exist if a non-empty "password" file is present.
+    With the account index enabled accounts are read from the index instead.
     """
 
+    domain_suffix = f"@{config.mail_domain}"
+
+    if config.account_index is not None:
+        # Safety guard: the index should only contain this domain.
+        accounts = config.account_index.get_accounts(limit=limit, suffix=domain_suffix)
+        return [
+            {"email": account.addr, "last_login": account.last_login or account.created}
+            for account in accounts
+        ]
+
     base: Path = config.mailboxes_dir
     if not base.exists():
         return []
 
-    domain_suffix = f"@{config.mail_domain}"
-
     accounts: list[dict[str, Any]] = []
-    for entry in sorted(base.iterdir(), key=lambda p: p.name):
-        if not entry.is_dir():
+    for addr, maildir in sorted(iter_maildirs(base)):
+        if not os.path.isdir(maildir):
             continue
 
-        addr = entry.name
-        if "@" not in addr:
-            continue
         if not addr.endswith(domain_suffix):
             # Safety guard: mailboxes_dir should only contain this domain.
             continue
+        if accounts and accounts[-1]["email"] == addr:
+            # found in both layouts while being migrated
+            continue
 
-        pw_path = entry.joinpath("password")
+        pw_path = Path(maildir).joinpath("password")
         try:
             st = pw_path.stat()
         except FileNotFoundError:
@@ -39,6 +39,12 @@ def delete_admin_account(config: Config, email: str):
         return 404, {"error": "account not found"}
 
     shutil.rmtree(maildir)
+    if config.account_index is not None:
+        config.account_index.remove(email)
+    if config.activity_log is not None:
+        config.activity_log.forget(email)
+    if config.metadata_token_store is not None:
+        config.metadata_token_store.remove(email)
     return 200, {"status": "deleted", "email": email}
 
 
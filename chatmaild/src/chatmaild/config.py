@@ -3,6 +3,10 @@ from pathlib import Path
 
 import iniconfig
 
+from chatmaild.accountindex import AccountIndex
+from chatmaild.activity import ActivityLog
+from chatmaild.layout import LAYOUTS, get_maildir
+from chatmaild.tokenstore import TokenStore
 from chatmaild.user import User
 
 
@@ -45,6 +49,66 @@ class Config:
         self.postfix_reinject_port_incoming = int(
             params.get("postfix_reinject_port_incoming", "10026")
         )
+        self.dictproxy_engine = params.get("dictproxy_engine", "threads").strip()
+        if self.dictproxy_engine not in ("threads", "asyncio"):
+            raise ValueError(f"invalid dictproxy_engine: {self.dictproxy_engine!r}")
+        self.dictproxy_executor_threads = int(
+            params.get("dictproxy_executor_threads", "16")
+        )
+        self.dictproxy_workers = int(params.get("dictproxy_workers", "1"))
+        self.dictproxy_iterate_chunk_size = int(
+            params.get("dictproxy_iterate_chunk_size", "1000")
+        )
+        self.dictproxy_hub = params.get("dictproxy_hub", "false").lower() == "true"
+        self.dictproxy_max_connections = int(
+            params.get("dictproxy_max_connections", "0")
+        )
+        self.dictproxy_max_inflight = int(params.get("dictproxy_max_inflight", "0"))
+        self.dictproxy_trace_sample_rate = float(
+            params.get("dictproxy_trace_sample_rate", "0")
+        )
+        self.dictproxy_trace_slow_threshold = float(
+            params.get("dictproxy_trace_slow_threshold", "0")
+        )
+        self.dictproxy_trace_buffer_size = int(
+            params.get("dictproxy_trace_buffer_size", "1000")
+        )
+        self.dictproxy_queue_deadline = float(
+            params.get("dictproxy_queue_deadline", "5")
+        )
+        self.lastlogin_flush_interval = float(
+            params.get("lastlogin_flush_interval", "0")
+        )
+        self.metadata_cache_size = int(params.get("metadata_cache_size", "10000"))
+        self.metadata_notify_mode = params.get("metadata_notify_mode", "sync").strip()
+        if self.metadata_notify_mode not in ("sync", "async"):
+            raise ValueError(
+                f"invalid metadata_notify_mode: {self.metadata_notify_mode!r}"
+            )
+        self.metadata_notify_queue_size = int(
+            params.get("metadata_notify_queue_size", "1000")
+        )
+        self.metadata_sweep_interval = float(
+            params.get("metadata_sweep_interval", "86400")
+        )
+        self.metadata_sweep_batch_size = int(
+            params.get("metadata_sweep_batch_size", "100")
+        )
+        self.doveauth_cache_size = int(params.get("doveauth_cache_size", "10000"))
+        self.doveauth_cache_ttl = float(params.get("doveauth_cache_ttl", "60"))
+        self.doveauth_account_filter = (
+            params.get("doveauth_account_filter", "false").lower() == "true"
+        )
+        self.doveauth_negative_cache_ttl = float(
+            params.get("doveauth_negative_cache_ttl", "5")
+        )
+        self.doveauth_hash_processes = int(params.get("doveauth_hash_processes", "2"))
+        self.doveauth_create_max_inflight = int(
+            params.get("doveauth_create_max_inflight", "4")
+        )
+        self.doveauth_create_deadline = float(
+            params.get("doveauth_create_deadline", "5")
+        )
         self.mtail_address = params.get("mtail_address")
         self.disable_ipv6 = params.get("disable_ipv6", "false").lower() == "true"
         self.addr_v4 = os.environ.get("CHATMAIL_ADDR_V4", "")
@@ -70,6 +134,25 @@ class Config:
         # deprecated option
         mbdir = params.get("mailboxes_dir", f"/home/vmail/mail/{self.mail_domain}")
         self.mailboxes_dir = Path(mbdir.strip())
+        self.mailboxes_layout = params.get("mailboxes_layout", "flat").strip()
+        if self.mailboxes_layout not in LAYOUTS:
+            raise ValueError(f"invalid mailboxes_layout: {self.mailboxes_layout!r}")
+
+        self.account_index = None
+        if params.get("account_index", "false").lower() == "true":
+            name = f"{self.mailboxes_dir.name}.accounts.sqlite"
+            self.account_index = AccountIndex(self.mailboxes_dir.with_name(name))
+
+        self.activity_log = None
+        if params.get("activity_log", "false").lower() == "true":
+            name = f"{self.mailboxes_dir.name}.activity"
+            self.activity_log = ActivityLog(self.mailboxes_dir.with_name(name))
+        self.activity_log_days = int(params.get("activity_log_days", "90"))
+
+        self.metadata_token_store = None
+        if params.get("metadata_token_store", "false").lower() == "true":
+            name = f"{self.mailboxes_dir.name}.tokens.sqlite"
+            self.metadata_token_store = TokenStore(self.mailboxes_dir.with_name(name))
 
         # old unused option (except for first migration from sqlite to maildir store)
         self.passdb_path = Path(params.get("passdb_path", "/home/vmail/passdb.sqlite"))
@@ -81,10 +164,17 @@ class Config:
         if not addr or "@" not in addr or "/" in addr:
             raise ValueError(f"invalid address {addr!r}")
 
-        maildir = self.mailboxes_dir.joinpath(addr)
+        maildir = get_maildir(self.mailboxes_dir, addr, self.mailboxes_layout)
         password_path = maildir.joinpath("password")
 
-        return User(maildir, addr, password_path, uid="vmail", gid="vmail")
+        return User(
+            maildir,
+            addr,
+            password_path,
+            uid="vmail",
+            gid="vmail",
+            account_index=self.account_index,
+        )
 
 
 def write_initial_config(inipath, mail_domain, overrides):
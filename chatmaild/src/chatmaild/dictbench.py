@@ -0,0 +1,377 @@
+"""
+Offline load generator and benchmark for the dict proxies.
+
+    chatmail-dictbench --clients 16 --requests 20000 \\
+        --mix passdb=4,userdb=4,lastlogin=1,metadata=1
+
+The benchmark writes a temporary ``chatmail.ini`` whose mailboxes directory
+contains ``--accounts`` accounts.  It forks one server process for every
+dict proxy needed by the request mix, each listening on a temporary socket,
+and drives them with concurrent clients which speak the Dovecot dict protocol
+and wait for every reply before sending the next request.
+
+Request types of the mix:
+
+``passdb``
+    passdb lookup of an existing account (doveauth)
+``create``
+    passdb lookup of a new account, creating it (doveauth)
+``userdb``
+    userdb lookup of an existing account (doveauth)
+``iterate``
+    iteration over all accounts (doveauth)
+``lastlogin``
+    transaction setting the last login timestamp (lastlogin)
+``metadata``
+    transaction setting a device token (metadata)
+
+Throughput and latency percentiles are printed as JSON to stdout.
+``--set name=value`` overrides ``chatmail.ini`` values,
+e.g. ``--set dictproxy_engine=asyncio --set dictproxy_workers=4``,
+and ``--proxy role=module:Class`` benchmarks another
+`DictProxy` subclass taking a ``config`` argument in place of a proxy.
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import random
+import signal
+import socket
+import string
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from .config import read_config, write_initial_config
+from .doveauth import AuthDictProxy, encrypt_password
+from .lastlogin import LastLoginDictProxy
+from .metadata import create_metadata_dictproxy
+
+# request type of the mix -> dict proxy serving it
+OPERATIONS = {
+    "passdb": "doveauth",
+    "create": "doveauth",
+    "userdb": "doveauth",
+    "iterate": "doveauth",
+    "lastlogin": "lastlogin",
+    "metadata": "metadata",
+}
+
+DEFAULT_MIX = "passdb=4,userdb=4,lastlogin=1,metadata=1"
+
+PASSWORD = "benchmark-password"
+
+HELLO = "H3\t2\t0\t\tbenchmark\n"
+
+
+def parse_mix(text):
+    """Return a mapping of request types to weights from ``name=weight,...``."""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown request type {name!r} in mix {text!r}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError(f"empty request mix {text!r}")
+    return {name: weight for name, weight in mix.items() if weight}
+
+
+def percentile(sorted_values, q):
+    """Return the ``q`` quantile (0..1) of an ascending list of values."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(latencies):
+    """Return request count and latency statistics in milliseconds."""
+    values = sorted(latencies)
+    summary = dict(count=len(values))
+    if values:
+        summary["mean_ms"] = round(sum(values) / len(values) * 1000, 3)
+    for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+        summary[f"{name}_ms"] = round(percentile(values, q) * 1000, 3)
+    summary["max_ms"] = round(values[-1] * 1000, 3) if values else 0.0
+    return summary
+
+
+def random_localpart(config, rng):
+    alphanumeric = string.ascii_lowercase + string.digits
+    return "".join(rng.choices(alphanumeric, k=config.username_max_length))
+
+
+def create_accounts(config, num, rng):
+    """Create ``num`` accounts sharing one password and return their addresses."""
+    password = encrypt_password(PASSWORD)
+    addresses = []
+    for _ in range(num):
+        addr = f"{random_localpart(config, rng)}@{config.mail_domain}"
+        config.get_user(addr).set_password(password)
+        addresses.append(addr)
+    return addresses
+
+
+def create_dictproxy(role, config, spec=None):
+    """Return the dict proxy for ``role`` or an instance of the ``module:Class``
+    given by ``spec``."""
+    if spec:
+        modname, _, clsname = spec.partition(":")
+        cls = getattr(importlib.import_module(modname), clsname)
+        return cls(config=config)
+    if role == "doveauth":
+        return AuthDictProxy(config=config)
+    if role == "lastlogin":
+        return LastLoginDictProxy(config=config)
+    return create_metadata_dictproxy(config)
+
+
+def start_server(dictproxy, socket_path, config, quiet=True):
+    """Serve ``dictproxy`` from a forked process and return its pid."""
+    pid = os.fork()
+    if pid:
+        return pid
+
+    code = 1
+    try:
+        if quiet:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+        dictproxy.serve_forever_from_config(socket_path, config)
+        code = 0
+    finally:
+        os._exit(code)
+
+
+def wait_for_socket(path, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+        time.sleep(0.02)
+
+
+def stop_server(pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+
+class Client:
+    """One simulated Dovecot process with a connection to every dict proxy."""
+
+    def __init__(self, num, sockets, config, addresses, mix, seed):
+        self.num = num
+        self.sockets = sockets
+        self.config = config
+        self.addresses = addresses
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.rng = random.Random(seed)
+        self.streams = {}
+        self.transaction_id = 0
+
+    async def connect(self):
+        for role, path in self.sockets.items():
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(HELLO.encode())
+            self.streams[role] = reader, writer
+
+    def close(self):
+        for reader, writer in self.streams.values():
+            writer.close()
+
+    def next_operation(self):
+        return self.rng.choices(self.operations, self.weights)[0]
+
+    async def run(self, operation):
+        """Send one request of the given type and return whether it succeeded."""
+        reader, writer = self.streams[OPERATIONS[operation]]
+        writer.write(self.get_request(operation).encode())
+        reply = await reader.readline()
+        if operation == "iterate":
+            while reply != b"\n":
+                if not reply.startswith(b"O"):
+                    return False
+                reply = await reader.readline()
+            return True
+        return reply.startswith(b"O")
+
+    def get_request(self, operation):
+        rng = self.rng
+        addr = rng.choice(self.addresses)
+        if operation == "passdb":
+            return f'Lshared/passdb/{PASSWORD}"{addr}\t{addr}\n'
+        if operation == "create":
+            addr = f"{random_localpart(self.config, rng)}@{self.config.mail_domain}"
+            return f'Lshared/passdb/{PASSWORD}"{addr}\t{addr}\n'
+        if operation == "userdb":
+            return f"Lshared/userdb/{addr}\t{addr}\n"
+        if operation == "iterate":
+            return "I0\t0\tshared/userdb/\n"
+
+        self.transaction_id += 1
+        tid = self.transaction_id
+        if operation == "lastlogin":
+            key, value = f"shared/last-login/{addr}", int(time.time())
+        else:
+            key, value = "priv/guid/devicetoken", f"token{rng.randrange(3)}"
+        return f"B{tid}\t{addr}\nS{tid}\t{key}\t{value}\nC{tid}\n"
+
+
+async def drive(clients, num_requests, warmup):
+    """Send ``warmup`` and then ``num_requests`` requests from all ``clients``
+    and return the measured latencies by request type, errors and duration."""
+    latencies = {}
+    errors = 0
+    remaining = num_requests + warmup
+    started = None
+
+    async def client_loop(client):
+        nonlocal remaining, errors, started
+        while remaining > 0:
+            remaining -= 1
+            measured = remaining < num_requests
+            if measured and started is None:
+                started = time.perf_counter()
+            operation = client.next_operation()
+            start = time.perf_counter()
+            ok = await client.run(operation)
+            if measured:
+                latencies.setdefault(operation, []).append(time.perf_counter() - start)
+                errors += not ok
+
+    for client in clients:
+        await client.connect()
+    try:
+        await asyncio.gather(*[client_loop(client) for client in clients])
+    finally:
+        for client in clients:
+            client.close()
+    return latencies, errors, time.perf_counter() - started
+
+
+def run_benchmark(
+    mix,
+    num_clients=16,
+    num_requests=10000,
+    warmup=100,
+    num_accounts=100,
+    settings=None,
+    proxies=None,
+    seed=None,
+):
+    """Run the benchmark in a temporary directory and return the report."""
+    rng = random.Random(seed)
+    roles = sorted(set(OPERATIONS[name] for name in mix))
+    proxies = proxies or {}
+
+    with tempfile.TemporaryDirectory(prefix="dictbench-") as tmpname:
+        tmpdir = Path(tmpname)
+        inipath = tmpdir.joinpath("chatmail.ini")
+        overrides = dict(settings or {})
+        overrides["mailboxes_dir"] = str(tmpdir.joinpath("mailboxes"))
+        overrides.setdefault("public_create_enabled", "true")
+        write_initial_config(inipath, "bench.example.org", overrides=overrides)
+        config = read_config(inipath)
+        config.mailboxes_dir.mkdir()
+        addresses = create_accounts(config, num_accounts, rng)
+
+        sockets = {role: str(tmpdir.joinpath(f"{role}.socket")) for role in roles}
+        pids = []
+        try:
+            for role, path in sockets.items():
+                dictproxy = create_dictproxy(role, config, proxies.get(role))
+                pids.append(start_server(dictproxy, path, config))
+            for path in sockets.values():
+                wait_for_socket(path)
+
+            clients = [
+                Client(num, sockets, config, addresses, mix, rng.random())
+                for num in range(num_clients)
+            ]
+            latencies, errors, duration = asyncio.run(
+                drive(clients, num_requests, warmup)
+            )
+        finally:
+            for pid in pids:
+                stop_server(pid)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return dict(
+        mix=mix,
+        clients=num_clients,
+        accounts=num_accounts,
+        settings=settings or {},
+        requests=len(all_latencies),
+        errors=errors,
+        duration_s=round(duration, 3),
+        throughput_rps=round(len(all_latencies) / duration, 1),
+        latency=summarize(all_latencies),
+        operations={name: summarize(values) for name, values in latencies.items()},
+    )
+
+
+def main(args=None):
+    """Benchmark the dict proxies with concurrent clients and print a JSON report"""
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"weighted request types, choose from {', '.join(OPERATIONS)}, "
+        f"default: {DEFAULT_MIX}",
+    )
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="override a chatmail.ini setting",
+    )
+    parser.add_argument(
+        "--proxy",
+        action="append",
+        default=[],
+        metavar="ROLE=MODULE:CLASS",
+        help="serve doveauth, lastlogin or metadata with another DictProxy subclass",
+    )
+    args = parser.parse_args(args)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    settings = dict(item.split("=", 1) for item in args.set)
+    proxies = dict(item.split("=", 1) for item in args.proxy)
+
+    report = run_benchmark(
+        mix,
+        num_clients=args.clients,
+        num_requests=args.requests,
+        warmup=args.warmup,
+        num_accounts=args.accounts,
+        settings=settings,
+        proxies=proxies,
+        seed=args.seed,
+    )
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Parsing of Dovecot dict protocol request lines.
+
+Request lines arrive as bytes and consist of a one-letter command
+followed by tab separated fields, see
+https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
+
+Fields are split with a single ``bytes.split`` of the whole line
+and only decoded when a handler actually accesses them,
+for example the trailing username field of a passdb lookup
+is never decoded because `AuthDictProxy` only reads the key.
+"""
+
+import re
+from collections.abc import Sequence
+
+
+class Fields(Sequence):
+    """Tab separated fields of a request line, decoded on access.
+
+    The first raw field still starts with the command letter,
+    which is skipped when decoding instead of copying the line.
+    """
+
+    __slots__ = ("_raw",)
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return [self._decode(i) for i in range(*index.indices(len(self._raw)))]
+        if index < 0:
+            index += len(self._raw)
+            if index < 0:
+                raise IndexError("field index out of range")
+        return self._decode(index)
+
+    def _decode(self, index):
+        field = self._raw[index]
+        if index == 0:
+            return str(memoryview(field)[1:], "utf-8")
+        return field.decode()
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def parse_request(line):
+    """Return the one-letter command and the `Fields` of a request ``line``.
+
+    ``line`` is a bytes-like object without the trailing newline.
+    Other objects than bytes are converted once
+    because memoryviews can not be split.
+    """
+    if type(line) is not bytes:
+        line = bytes(line)
+    return chr(line[0]), Fields(line.split(b"\t"))
+
+
+_ESCAPED_OR_SEPARATOR = re.compile(r'\\(.)|"', re.DOTALL)
+
+
+def split_and_unescape(s):
+    """Split strings using double quote as a separator and backslash as escape character
+    into parts.
+
+    The string is scanned once, jumping from one special character
+    to the next instead of visiting every character.
+    """
+    if "\\" not in s:
+        return s.split('"')
+
+    parts = []
+    out = []
+    pos = 0
+    for match in _ESCAPED_OR_SEPARATOR.finditer(s):
+        out.append(s[pos : match.start()])
+        escaped = match.group(1)
+        if escaped is None:
+            parts.append("".join(out))
+            out = []
+        else:
+            out.append(escaped)
+        pos = match.end()
+
+    tail = s[pos:]
+    if tail.endswith("\\"):
+        # an escape character without a following character is invalid input
+        raise ValueError(f"dangling escape character in {s!r}")
+    out.append(tail)
+    parts.append("".join(out))
+    return parts
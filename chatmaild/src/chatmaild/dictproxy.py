@@ -1,39 +1,332 @@
+import asyncio
 import logging
 import os
+import signal
+import socket
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from threading import Semaphore
+from time import perf_counter
+
+from .dictparse import parse_request
+from .dictstats import DictProxyStats, get_stats_socket_path, start_stats_server
+from .dicttrace import Tracer, describe_request, get_current_trace
+from .profiling import Profiler
+
+# first file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+# Maximum number of bytes read from a connection at once.
+# All complete lines contained in one read are handled as one batch
+# and their replies are written with a single write call.
+READ_SIZE = 65536
+
+
+class TemporaryFailure(Exception):
+    """Raised by lookup and iterate handlers to answer with the protocol
+    failure reply, which Dovecot reports as a temporary error."""
+
+
+def split_lines(pending, data):
+    """Return the complete lines from ``pending + data``
+    and the remaining incomplete line."""
+    *lines, pending = (pending + data).split(b"\n")
+    return lines, pending
 
 
 class DictProxy:
-    def loop_forever(self, rfile, wfile):
+    # name of the proxy in statistics
+    name = "dictproxy"
+
+    # load limits, 0 means unlimited, see `set_limits`
+    max_connections = 0
+    max_inflight = 0
+    queue_deadline = 0.0
+
+    # seconds to wait for connections to finish their requests on shutdown
+    drain_timeout = 30.0
+
+    def __init__(self):
+        self.stats = DictProxyStats(self.name)
+        self._inflight_slots = None
+        self.tracer = None
+        self.profiler = None
+        self.draining = False
+        self._connection_socks = set()
+
+    def set_limits(self, max_connections=0, max_inflight=0, queue_deadline=0.0):
+        """Limit concurrent connections and concurrently handled requests.
+
+        Connections beyond ``max_connections`` are closed right away.
+        Requests wait for one of ``max_inflight`` handling slots
+        and are answered with the protocol failure reply
+        if they could not start within ``queue_deadline`` seconds
+        after they were read.
+        """
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.queue_deadline = queue_deadline
+        self._inflight_slots = Semaphore(max_inflight) if max_inflight else None
+
+    def set_tracing(self, sample_rate=0.0, slow_threshold=0.0, buffer_size=1000):
+        """Trace a ``sample_rate`` fraction of requests and all requests
+        taking ``slow_threshold`` seconds or longer, see `chatmaild.dicttrace`.
+
+        Tracing is disabled if both are 0.
+        """
+        if sample_rate or slow_threshold:
+            self.tracer = Tracer(self.name, sample_rate, slow_threshold, buffer_size)
+        else:
+            self.tracer = None
+
+    def configure(self, config):
+        """Apply the load limits and tracing settings of ``config``."""
+        self.set_limits(
+            max_connections=config.dictproxy_max_connections,
+            max_inflight=config.dictproxy_max_inflight,
+            queue_deadline=config.dictproxy_queue_deadline,
+        )
+        self.set_tracing(
+            sample_rate=config.dictproxy_trace_sample_rate,
+            slow_threshold=config.dictproxy_trace_slow_threshold,
+            buffer_size=config.dictproxy_trace_buffer_size,
+        )
+
+    def accept_connection(self, count=False):
+        """Return False and count the rejection if the connection limit is reached.
+
+        With ``count=True`` an accepted connection is counted right away,
+        together with the check, so that connections accepted in a burst
+        before their handlers start can not exceed the limit.
+        """
+        if self.draining:
+            return False
+        stats = self.stats
+        with stats.lock:
+            num = self.get_num_connections()
+            if self.max_connections and num >= self.max_connections:
+                stats.rejected_connections.inc()
+                return False
+            if count:
+                stats.connections.inc()
+        return True
+
+    def get_num_connections(self):
+        return self.stats.connections.values[()]
+
+    def track_connection(self, sock):
+        """Register the socket of a connection so that `drain` can end it."""
+        self._connection_socks.add(sock)
+        if self.draining:
+            shutdown_read(sock)
+
+    def untrack_connection(self, sock):
+        self._connection_socks.discard(sock)
+
+    def drain(self):
+        """Stop reading requests from all connections and reject new ones.
+
+        Requests which were already received are still handled and answered,
+        then each connection is closed and Dovecot reconnects,
+        with socket activation to the next process serving the socket.
+        """
+        self.draining = True
+        for sock in list(self._connection_socks):
+            shutdown_read(sock)
+
+    def wait_drained(self, timeout=None):
+        """Wait until all connections are closed, at most ``timeout`` seconds."""
+        deadline = time.monotonic() + (
+            self.drain_timeout if timeout is None else timeout
+        )
+        while self.get_num_connections() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    async def wait_drained_async(self, timeout=None):
+        deadline = time.monotonic() + (
+            self.drain_timeout if timeout is None else timeout
+        )
+        while self.get_num_connections() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def shutdown(self):
+        """Called once after serving stopped and connections were drained."""
+
+    def loop_forever(self, rfile, wfile, counted=False):
+        """Serve one Dovecot connection until the client closes it.
+
+        ``counted`` tells that `accept_connection` already counted
+        the connection, it is uncounted when the loop ends in any case.
+        """
         # Transaction storage is local to each handler loop.
         # Dovecot reuses transaction IDs across connections,
         # starting transaction with the name `1`
         # on two different connections to the same proxy sometimes.
         transactions = {}
 
-        while True:
-            msg = rfile.readline().strip().decode()
+        if not counted:
+            self._add_connection(1)
+        try:
+            pending = b""
+            while True:
+                data = rfile.read1(READ_SIZE)
+                if data:
+                    lines, pending = split_lines(pending, data)
+                    if not lines:
+                        continue
+                else:
+                    # a partial request cut off by `drain` is not handled
+                    lines = [] if self.draining else [pending]
+
+                replies, done = self.handle_batch(lines, transactions)
+                for reply in replies:
+                    if type(reply) is bytes:
+                        wfile.write(reply)
+                    else:
+                        for chunk in reply:
+                            wfile.write(chunk.encode("ascii"))
+                if replies:
+                    wfile.flush()
+                if done or not data:
+                    break
+        finally:
+            self._add_connection(-1)
+
+    def _add_connection(self, num):
+        with self.stats.lock:
+            self.stats.connections.inc(amount=num)
+
+    def handle_batch(self, lines, transactions, received=None):
+        """Handle pipelined request ``lines`` in order.
+
+        ``received`` is the `time.perf_counter` value when the lines were read
+        and is used to enforce the queue deadline.
+
+        Return the list of replies and whether the client finished
+        the connection with an empty line.  Consecutive replies are
+        concatenated into one bytes object while streamed replies
+        (see `handle_iterate`) are passed on as iterators of strings.
+        """
+        if received is None:
+            received = perf_counter()
+        stats = self.stats
+        tracer = self.tracer
+        replies = []
+        pending = []
+        done = False
+        num = 0
+        for line in lines:
+            msg = line.strip()
             if not msg:
+                done = True
                 break
+            num += 1
+            if tracer is None:
+                res = self.handle_admitted(msg, transactions, received)
+            else:
+                res = tracer.trace(self.handle_admitted, msg, transactions, received)
+            if type(res) is str:
+                pending.append(res)
+            elif res is not None:
+                if pending:
+                    replies.append("".join(pending).encode("ascii"))
+                    pending = []
+                replies.append(res)
+        if pending:
+            replies.append("".join(pending).encode("ascii"))
+
+        if num:
+            with stats.lock:
+                stats.batch_sizes.observe(num)
+        return replies, done
+
+    def handle_admitted(self, msg, transactions, received):
+        """Handle one request line once a handling slot is free
+        or reject it if none becomes free before the queue deadline."""
+        slots = self._inflight_slots
+        if slots is None:
+            return self.handle_recorded(msg, transactions)
+
+        stats = self.stats
+        if self.queue_deadline:
+            timeout = received + self.queue_deadline - perf_counter()
+            admitted = timeout > 0 and slots.acquire(timeout=timeout)
+        else:
+            admitted = slots.acquire()
+        waited = perf_counter() - received
+        if self.tracer is not None:
+            get_current_trace().add_phase("queue", waited)
+        if not admitted:
+            with stats.lock:
+                stats.rejected_requests.inc()
+                stats.queue_wait.observe(waited)
+            return self.reject_request(msg, transactions)
 
+        with stats.lock:
+            stats.queue_wait.observe(waited)
+        try:
+            return self.handle_recorded(msg, transactions)
+        finally:
+            slots.release()
+
+    def reject_request(self, msg, transactions):
+        """Answer a request with the protocol failure reply without handling it."""
+        short_command, parts = parse_request(msg)
+        if short_command in ("L", "I"):
+            return "F\n"
+        elif short_command == "B":
+            transactions[parts[0]] = dict(addr=parts[1], res="F\n", sets=[])
+        elif short_command == "S":
+            if parts[0] in transactions:
+                transactions[parts[0]]["res"] = "F\n"
+        elif short_command == "C":
+            transactions.pop(parts[0], None)
+            return "F\n"
+        elif short_command == "R":
+            transactions.pop(parts[0], None)
+
+    def handle_recorded(self, msg, transactions):
+        """Handle one request line and record it in the request statistics."""
+        stats = self.stats
+        stats.start_request()
+        failed = True
+        start = perf_counter()
+        try:
             res = self.handle_dovecot_request(msg, transactions)
-            if res:
-                wfile.write(res.encode("ascii"))
-                wfile.flush()
+            failed = type(res) is str and res.startswith("F")
+            return res
+        finally:
+            duration = perf_counter() - start
+            stats.finish_request(chr(msg[0]), duration, failed)
+            if self.tracer is not None:
+                get_current_trace().add_phase("handle", duration)
 
     def handle_dovecot_request(self, msg, transactions):
         # see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
-        short_command = msg[0]
-        parts = msg[1:].split("\t")
+        if isinstance(msg, str):
+            msg = msg.encode()
+        short_command, parts = parse_request(msg)
+        if self.tracer is not None:
+            trace = get_current_trace()
+            trace.namespace, trace.addr = describe_request(short_command, parts)
 
-        if short_command == "L":
-            return self.handle_lookup(parts)
-        elif short_command == "I":
-            return self.handle_iterate(parts)
+        if short_command in ("L", "I"):
+            try:
+                if short_command == "L":
+                    return self.handle_lookup(parts)
+                return self.handle_iterate(parts)
+            except TemporaryFailure as e:
+                logging.warning(f"{self.name} request failed temporarily: {e}")
+                return "F\n"
         elif short_command == "H":
             return  # no version checking
 
-        if short_command not in ("BSC"):
+        if short_command not in ("BSCR"):
             logging.warning(f"unknown dictproxy request: {msg!r}")
             return
 
@@ -43,11 +336,11 @@ class DictProxy:
             return self.handle_begin_transaction(transaction_id, parts, transactions)
         elif short_command == "C":
             return self.handle_commit_transaction(transaction_id, parts, transactions)
+        elif short_command == "R":
+            return self.handle_rollback_transaction(transaction_id, transactions)
         elif short_command == "S":
-            addr = transactions[transaction_id]["addr"]
-            if not self.handle_set(addr, parts):
-                transactions[transaction_id]["res"] = "F\n"
-                logging.error(f"dictproxy-set failed for {addr!r}: {msg!r}")
+            # sets are only applied when the transaction is committed
+            transactions[transaction_id]["sets"].append(parts)
 
     def handle_lookup(self, parts):
         logging.warning(f"lookup ignored: {parts!r}")
@@ -56,43 +349,345 @@ class DictProxy:
     def handle_iterate(self, parts):
         # Empty line means ITER_FINISHED.
         # If we don't return empty line Dovecot will timeout.
+        # Subclasses may return an iterator of reply chunks instead of a string
+        # to stream large results, see `iter_chunks`.
         return "\n"
 
     def handle_begin_transaction(self, transaction_id, parts, transactions):
         addr = parts[1]
-        transactions[transaction_id] = dict(addr=addr, res="O\n")
+        transactions[transaction_id] = dict(addr=addr, res="O\n", sets=[])
 
     def handle_set(self, addr, parts):
         # For documentation on key structure see
         # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
         return False
 
+    def handle_set_batch(self, addr, sets):
+        """Apply the parts of all set requests of a committed transaction
+        and return False if one of them failed.
+
+        Subclasses can override this to apply all sets with one write.
+        An exception fails the commit.
+        """
+        ok = True
+        for parts in sets:
+            if not self.handle_set(addr, parts):
+                logging.error(f"dictproxy-set failed for {addr!r}: {list(parts)!r}")
+                ok = False
+        return ok
+
     def handle_commit_transaction(self, transaction_id, parts, transactions):
-        # return whatever "set" command(s) set as result.
-        return transactions.pop(transaction_id)["res"]
+        transaction = transactions.pop(transaction_id)
+        if transaction["res"] != "O\n" or not transaction["sets"]:
+            return transaction["res"]
+        addr = transaction["addr"]
+        try:
+            ok = self.handle_set_batch(addr, transaction["sets"])
+        except Exception:
+            logging.exception(f"dictproxy-commit failed for {addr!r}")
+            ok = False
+        return "O\n" if ok else "F\n"
 
-    def serve_forever_from_socket(self, socket):
+    def handle_rollback_transaction(self, transaction_id, transactions):
+        # discard the buffered sets, Dovecot expects no reply
+        transactions.pop(transaction_id, None)
+
+    async def loop_forever_async(self, reader, writer, executor):
+        """Serve one Dovecot connection from the event loop.
+
+        Requests are handled by the same ``handle_*`` hooks as in
+        `loop_forever` but run on ``executor`` because they
+        may block on filesystem access.
+        """
+        loop = asyncio.get_running_loop()
+        transactions = {}
+
+        self._add_connection(1)
+        try:
+            pending = b""
+            while True:
+                data = await reader.read(READ_SIZE)
+                if data:
+                    lines, pending = split_lines(pending, data)
+                    if not lines:
+                        continue
+                else:
+                    lines = [] if self.draining else [pending]
+
+                replies, done = await loop.run_in_executor(
+                    executor, self.handle_batch, lines, transactions, perf_counter()
+                )
+                for reply in replies:
+                    if type(reply) is bytes:
+                        writer.write(reply)
+                        continue
+                    # produce chunks on the executor because they may read
+                    # the filesystem, and only when the previous chunk was sent
+                    while chunk := await loop.run_in_executor(
+                        executor, next, reply, None
+                    ):
+                        writer.write(chunk.encode("ascii"))
+                        await writer.drain()
+                if replies:
+                    await writer.drain()
+                if done or not data:
+                    break
+        except Exception:
+            logging.exception("Exception in the handler")
+        finally:
+            self._add_connection(-1)
+            writer.close()
+
+    async def start_async_server(self, socket, executor, listen_sock=None):
+        """Start listening on the unix ``socket`` path from the running event loop
+        and return the asyncio server object.
+
+        If ``listen_sock`` is given, accept connections on this
+        already listening socket instead of binding ``socket``.
+        """
+
+        async def handle_connection(reader, writer):
+            if not self.accept_connection():
+                writer.close()
+                return
+            sock = writer.get_extra_info("socket")
+            self.track_connection(sock)
+            try:
+                await self.loop_forever_async(reader, writer, executor)
+            finally:
+                self.untrack_connection(sock)
+
+        if listen_sock is None:
+            listen_sock = open_listening_socket(socket)
+
+        kwargs = {}
+        if sys.version_info >= (3, 13):
+            # Python 3.13 removes the socket path when the server is closed,
+            # even while systemd or other workers still listen on it
+            kwargs["cleanup_socket"] = False
+        return await asyncio.start_unix_server(
+            handle_connection,
+            sock=listen_sock,
+            backlog=CustomThreadingUnixStreamServer.request_queue_size,
+            **kwargs,
+        )
+
+    def serve_forever_async(self, socket, max_workers=16, listen_sock=None):
+        """Serve all connections on ``socket`` from a single event loop,
+        running blocking handler work on at most ``max_workers`` threads."""
+
+        async def serve():
+            server = await self.start_async_server(socket, executor, listen_sock)
+            async with server:
+                await serve_until_stopped([server], [self])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            asyncio.run(serve())
+        self.shutdown()
+
+    def handle_stats_command(self, command):
+        """Return the reply to a command received on the statistics socket."""
+        if command == "metrics":
+            return self.stats.render()
+        if command == "traces":
+            if self.tracer is None:
+                return ""
+            return self.tracer.dump()
+        if command.startswith("profile-") or command == "stacks":
+            if self.profiler is None:
+                return "profiling not available\n"
+            return self.profiler.handle_command(command)
+        return f"unknown command: {command!r}\n"
+
+    def init_worker(self, worker_num, first_start=True):
+        """Called in each serving process before it starts serving.
+
+        ``worker_num`` is 0 unless the proxy runs with several worker processes.
+        ``first_start`` is False if the process replaces an exited worker
+        while the other workers keep running.
+        """
+
+    def serve_forever_from_config(self, socket, config, workers=None):
+        """Serve on ``socket`` using the dict proxy engine selected in ``config``
+        and serve statistics on the corresponding statistics socket.
+
+        With more than one worker, preforked worker processes
+        accept connections on the same listening socket.
+        ``workers`` defaults to ``dictproxy_workers`` from ``config``.
+        """
+        if workers is None:
+            workers = config.dictproxy_workers
+        self.configure(config)
+        if workers > 1:
+            from .prefork import Supervisor
+
+            Supervisor(self, socket, config, workers).serve_forever()
+        else:
+            self.serve_worker(socket, config)
+
+    def serve_worker(
+        self,
+        socket,
+        config,
+        worker_num=0,
+        listen_sock=None,
+        stats_socket=None,
+        first_start=True,
+    ):
+        """Serve connections in the current process until interrupted."""
+        if stats_socket is None:
+            stats_socket = get_stats_socket_path(socket)
+        start_stats_server(stats_socket, self.handle_stats_command)
+        self.profiler = Profiler(self.name, Path(socket).parent)
+        self.profiler.install_signal_handlers()
+        self.init_worker(worker_num, first_start)
+        if config.dictproxy_engine == "asyncio":
+            self.serve_forever_async(
+                socket,
+                max_workers=config.dictproxy_executor_threads,
+                listen_sock=listen_sock,
+            )
+        else:
+            self.serve_forever_from_socket(socket, listen_sock=listen_sock)
+
+    def serve_forever_from_socket(self, socket, listen_sock=None):
         dictproxy = self
 
+        class Server(CustomThreadingUnixStreamServer):
+            # connections are drained by `drain` instead of joining threads
+            daemon_threads = True
+
+            def verify_request(self, request, client_address):
+                # count here because handler threads start later
+                return dictproxy.accept_connection(count=True)
+
+            def process_request(self, request, client_address):
+                try:
+                    super().process_request(request, client_address)
+                except Exception:
+                    # the handler thread did not start
+                    dictproxy._add_connection(-1)
+                    raise
+
         class Handler(StreamRequestHandler):
             def handle(self):
+                dictproxy.track_connection(self.connection)
                 try:
-                    dictproxy.loop_forever(self.rfile, self.wfile)
+                    dictproxy.loop_forever(self.rfile, self.wfile, counted=True)
                 except Exception:
                     logging.exception("Exception in the handler")
                     raise
+                finally:
+                    dictproxy.untrack_connection(self.connection)
 
-        try:
-            os.unlink(socket)
-        except FileNotFoundError:
-            pass
+        if listen_sock is None:
+            listen_sock = open_listening_socket(socket)
 
-        with CustomThreadingUnixStreamServer(socket, Handler) as server:
+        with Server(socket, Handler, bind_and_activate=False) as server:
+            server.socket.close()
+            server.socket = listen_sock
+
+            def stop(signum, frame):
+                # shutdown() waits for serve_forever() running in this thread
+                threading.Thread(target=server.shutdown).start()
+
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGTERM, stop)
             try:
                 server.serve_forever()
             except KeyboardInterrupt:
                 pass
+            self.drain()
+            self.wait_drained()
+        self.shutdown()
 
 
 class CustomThreadingUnixStreamServer(ThreadingUnixStreamServer):
     request_queue_size = 1000
+
+
+def iter_chunks(lines, chunk_size):
+    """Join the strings of ``lines`` into chunks of at most ``chunk_size`` lines."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def shutdown_read(sock):
+    try:
+        sock.shutdown(socket.SHUT_RD)
+    except OSError:
+        pass
+
+
+async def serve_until_stopped(servers, dictproxies):
+    """Serve from the running event loop until SIGTERM or SIGINT,
+    then stop accepting connections and drain all ``dictproxies``."""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+    await stopped.wait()
+
+    for server in servers:
+        server.close()
+    for dictproxy in dictproxies:
+        dictproxy.drain()
+    await asyncio.gather(*[dictproxy.wait_drained_async() for dictproxy in dictproxies])
+
+
+def get_systemd_socket(path):
+    """Return the listening socket for ``path`` passed by systemd
+    socket activation or None if systemd did not pass one."""
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    num_fds = int(os.environ.get("LISTEN_FDS", "0"))
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + num_fds):
+        sock = socket.socket(fileno=fd)
+        if sock.family == socket.AF_UNIX and sock.getsockname() == str(path):
+            return sock
+        sock.detach()
+    return None
+
+
+def open_listening_socket(path):
+    """Return the socket passed by systemd for ``path``
+    or a newly created listening socket."""
+    sock = get_systemd_socket(path)
+    if sock is not None:
+        logging.info(f"using socket passed by systemd: {path}")
+        return sock
+    return create_listening_socket(path)
+
+
+def create_listening_socket(path):
+    """Return a unix stream socket listening on ``path``,
+    replacing any stale socket file."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(path))
+    sock.listen(CustomThreadingUnixStreamServer.request_queue_size)
+    return sock
+
+
+def get_argument_parser(description):
+    """Return the command line parser shared by all dict proxy daemons."""
+    parser = ArgumentParser(description=description)
+    parser.add_argument("socket", help="unix socket path to serve the dict protocol on")
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of preforked worker processes accepting connections, "
+        "default: dictproxy_workers from chatmail.ini",
+    )
+    return parser
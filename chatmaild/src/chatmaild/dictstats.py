@@ -0,0 +1,333 @@
+"""
+Request statistics for dict proxies in the Prometheus text format.
+
+Every `DictProxy` records per-command request counts, error counts and
+latency histograms as well as the number of active connections
+and in-flight requests.  Recording only takes a lock and increments
+a few integers so it can stay enabled in production.
+
+A proxy serves its statistics on a separate unix socket next to its
+dict socket.  A client writes a command line (``metrics`` if empty)
+and reads the reply until the proxy closes the connection.
+The ``chatmail-dictstats`` command collects the metrics of several
+proxies into one text file, which a cron job writes
+next to ``/var/www/html/metrics``.
+"""
+
+import logging
+import os
+import socket
+import sys
+from argparse import ArgumentParser
+from bisect import bisect_left
+from pathlib import Path
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from threading import Lock, Thread
+
+# upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# upper bounds of the histogram of requests handled per batch
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join(f'{name}="{value}"' for name, value in labels)
+    return "{" + inner + "}"
+
+
+class Metric:
+    """A metric family whose samples are keyed by a tuple of label pairs."""
+
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class CounterMetric(Metric):
+    type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, base_labels=()):
+        lines = self.header()
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(base_labels + labels)} {value}")
+        return lines
+
+
+class GaugeMetric(CounterMetric):
+    type = "gauge"
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+class HistogramMetric(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def add_series(self, labels=()):
+        # per-bucket counts, an overflow bucket and the sum of observed values
+        counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0]
+        return counts
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels) or self.add_series(labels)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, base_labels=()):
+        lines = self.header()
+        for labels, counts in self.values.items():
+            all_labels = base_labels + labels
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = format_labels(all_labels + (("le", bound),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(all_labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{format_labels(all_labels)} {cumulative}")
+        return lines
+
+
+class Stats:
+    """Registry of metrics sharing one lock and a set of constant labels.
+
+    Update metrics only while holding ``lock``.
+    """
+
+    def __init__(self, **labels):
+        self.labels = tuple(labels.items())
+        self.lock = Lock()
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(CounterMetric(name, help))
+
+    def gauge(self, name, help):
+        return self.add(GaugeMetric(name, help))
+
+    def histogram(self, name, help, buckets):
+        return self.add(HistogramMetric(name, help, buckets))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.extend(metric.render(self.labels))
+        return "\n".join(lines) + "\n"
+
+
+class DictProxyStats(Stats):
+    """Request statistics of one dict proxy."""
+
+    # commands of the dict protocol, all others are recorded as "other"
+    COMMANDS = ("H", "L", "I", "B", "S", "C", "R", "other")
+
+    def __init__(self, proxy):
+        super().__init__(proxy=proxy)
+        self.requests = self.counter(
+            "dictproxy_requests_total", "number of handled requests by command"
+        )
+        self.errors = self.counter(
+            "dictproxy_errors_total", "number of failed requests by command"
+        )
+        self.latency = self.histogram(
+            "dictproxy_request_duration_seconds",
+            "time spent handling requests by command",
+            LATENCY_BUCKETS,
+        )
+        self.batch_sizes = self.histogram(
+            "dictproxy_batch_size",
+            "number of pipelined requests handled in one batch",
+            BATCH_SIZE_BUCKETS,
+        )
+        self.connections = self.gauge(
+            "dictproxy_connections", "number of active connections"
+        )
+        self.inflight = self.gauge(
+            "dictproxy_inflight_requests", "number of requests being handled"
+        )
+        self.queue_wait = self.histogram(
+            "dictproxy_queue_wait_seconds",
+            "time requests waited for a handling slot",
+            LATENCY_BUCKETS,
+        )
+        self.rejected_requests = self.counter(
+            "dictproxy_rejected_requests_total",
+            "number of requests answered with a failure because of overload",
+        )
+        self.rejected_connections = self.counter(
+            "dictproxy_rejected_connections_total",
+            "number of connections closed because of the connection limit",
+        )
+        self.connections.set(0)
+        self.inflight.set(0)
+        self.rejected_requests.inc(amount=0)
+        self.rejected_connections.inc(amount=0)
+
+        # pre-create all series so that recording only increments
+        self._command_labels = {}
+        for command in self.COMMANDS:
+            labels = self._command_labels[command] = (("command", command),)
+            self.requests.values[labels] = 0
+            self.errors.values[labels] = 0
+            self.latency.add_series(labels)
+
+    def start_request(self):
+        with self.lock:
+            self.inflight.values[()] += 1
+
+    def finish_request(self, command, duration, failed):
+        labels = self._command_labels.get(command) or self._command_labels["other"]
+        bucket = bisect_left(LATENCY_BUCKETS, duration)
+        counts = self.latency.values[labels]
+        with self.lock:
+            self.inflight.values[()] -= 1
+            self.requests.values[labels] += 1
+            if failed:
+                self.errors.values[labels] += 1
+            counts[bucket] += 1
+            counts[-1] += duration
+
+
+def get_stats_socket_path(socket_path, worker_num=None):
+    """Return the statistics socket path belonging to a dict proxy socket path
+    or to one of its worker processes."""
+    path = Path(socket_path)
+    suffix = "" if worker_num is None else f"-{worker_num}"
+    return str(path.with_name(f"{path.stem}-stats{suffix}.socket"))
+
+
+def start_stats_server(socket_path, handle_command):
+    """Serve replies of ``handle_command(command)`` on the unix ``socket_path``
+    from a daemon thread and return the server."""
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            command = self.rfile.readline().strip().decode() or "metrics"
+            try:
+                res = handle_command(command)
+            except Exception:
+                logging.exception(f"stats command failed: {command!r}")
+                res = "error\n"
+            self.wfile.write(res.encode())
+
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+    server = ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def query_stats_socket(socket_path, command="metrics", timeout=10.0):
+    """Send ``command`` to a statistics socket and return the reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        sock.sendall(command.encode() + b"\n")
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+    return b"".join(chunks).decode()
+
+
+def merge_metrics(texts):
+    """Merge Prometheus texts into one, keeping one HELP/TYPE header per metric
+    and summing the values of samples with identical names and labels."""
+    families = {}
+    for text in texts:
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                family = line.split()[2]
+                headers, samples = families.setdefault(family, ([], {}))
+                if line not in headers:
+                    headers.append(line)
+                continue
+            key, value = line.rsplit(" ", 1)
+            family = key.partition("{")[0]
+            for suffix in ("_bucket", "_sum", "_count"):
+                if family.endswith(suffix) and family[: -len(suffix)] in families:
+                    family = family[: -len(suffix)]
+            headers, samples = families.setdefault(family, ([], {}))
+            value = float(value)
+            samples[key] = samples.get(key, 0) + value
+
+    lines = []
+    for headers, samples in families.values():
+        lines.extend(headers)
+        for key, value in samples.items():
+            lines.append(f"{key} {int(value) if value.is_integer() else value}")
+    return "\n".join(lines) + "\n"
+
+
+def main(args=None):
+    """Print merged statistics of running dict proxies in the Prometheus text format"""
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "sockets",
+        nargs="+",
+        help="statistics sockets of the dict proxies, e.g. /run/doveauth/doveauth-stats.socket",
+    )
+    parser.add_argument(
+        "--command",
+        default="metrics",
+        help="command sent to every statistics socket, default: metrics",
+    )
+    args = parser.parse_args(args)
+
+    texts = []
+    for path in args.sockets:
+        try:
+            texts.append(query_stats_socket(path, args.command))
+        except OSError as e:
+            print(f"could not query {path}: {e}", file=sys.stderr)
+
+    if args.command == "metrics":
+        print(merge_metrics(texts), end="")
+    else:
+        print("".join(texts), end="")
+
+
+if __name__ == "__main__":
+    main()
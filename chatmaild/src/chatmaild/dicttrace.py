@@ -0,0 +1,216 @@
+"""
+Sampled request tracing and slow request log for dict proxies.
+
+Tracing is off by default.  With ``dictproxy_trace_sample_rate`` or
+``dictproxy_trace_slow_threshold`` set in ``chatmail.ini``, every request
+is traced while it is handled and the trace is kept if the request
+was sampled or took longer than the slow threshold.
+Slow requests are additionally logged as warnings.
+
+A trace records the command, the key namespace,
+a hash of the address instead of the address itself,
+the time spent in each phase of handling the request
+and the filesystem calls made, captured with an audit hook
+(see `sys.addaudithook`).  Passwords, tokens and other values
+are never recorded.
+
+Kept traces go to a ring buffer of ``dictproxy_trace_buffer_size`` entries
+which the ``traces`` command of the statistics socket dumps
+as one JSON object per line, e.g.::
+
+    chatmail-dictstats --command traces /run/doveauth/doveauth-stats.socket
+
+Handlers can mark additional phases with `trace_phase`.
+"""
+
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+# audit events of filesystem calls recorded in traces
+FS_EVENTS = frozenset(
+    (
+        "open",
+        "os.chmod",
+        "os.chown",
+        "os.link",
+        "os.listdir",
+        "os.mkdir",
+        "os.remove",
+        "os.rename",
+        "os.rmdir",
+        "os.scandir",
+        "os.symlink",
+        "os.truncate",
+        "os.utime",
+    )
+)
+
+# maximum number of filesystem calls recorded per trace
+MAX_FS_CALLS = 100
+
+_local = threading.local()
+_null_phase = contextlib.nullcontext()
+
+
+def hash_address(addr):
+    """Return a short hash identifying ``addr`` without revealing it."""
+    return hashlib.blake2b(addr.encode(), digest_size=6).hexdigest()
+
+
+def hash_path(path):
+    """Replace path components containing an address with their hash."""
+    return "/".join(
+        hash_address(part) if "@" in part else part for part in str(path).split("/")
+    )
+
+
+def get_key_namespace(key):
+    """Return the namespace of a dict key without its address or user id,
+    e.g. ``shared/passdb`` or ``priv/devicetoken``."""
+    keyparts = key.split("/", 2)
+    if keyparts[0] == "priv" and len(keyparts) == 3:
+        return f"priv/{keyparts[2]}"
+    return "/".join(keyparts[:2])
+
+
+def describe_request(command, parts):
+    """Return the key namespace and address hash of a request."""
+    namespace = addr = None
+    if command in "LI" and parts:
+        key = parts[0] if command == "L" else parts[-1]
+        namespace = get_key_namespace(key)
+        if command == "L" and len(parts) > 1:
+            addr = parts[1]
+    elif command == "B" and len(parts) > 1:
+        addr = parts[1]
+    elif command == "S" and len(parts) > 1:
+        namespace = get_key_namespace(parts[1])
+    return namespace, addr and hash_address(addr)
+
+
+class Trace:
+    def __init__(self, proxy, command, sampled):
+        self.proxy = proxy
+        self.command = command
+        self.sampled = sampled
+        self.namespace = None
+        self.addr = None
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.fs_calls = []
+        self.result = None
+        self.duration = None
+
+    def add_fs_call(self, event, args):
+        if len(self.fs_calls) >= MAX_FS_CALLS:
+            return
+        path = args[0] if args else None
+        if isinstance(path, bytes):
+            path = path.decode(errors="replace")
+        offset = time.perf_counter() - self.start
+        self.fs_calls.append((event, hash_path(path), round(offset, 6)))
+
+    def add_phase(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def as_dict(self):
+        return dict(
+            time=round(self.time, 3),
+            proxy=self.proxy,
+            command=self.command,
+            namespace=self.namespace,
+            addr=self.addr,
+            result=self.result,
+            duration=round(self.duration, 6),
+            sampled=self.sampled,
+            phases={name: round(value, 6) for name, value in self.phases.items()},
+            fs_calls=self.fs_calls,
+        )
+
+
+@contextlib.contextmanager
+def _measure_phase(trace, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_phase(name, time.perf_counter() - start)
+
+
+def trace_phase(name):
+    """Return a context manager adding its duration to the phase ``name``
+    of the request traced in the current thread, if any."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return _null_phase
+    return _measure_phase(trace, name)
+
+
+def get_current_trace():
+    return getattr(_local, "trace", None)
+
+
+def _audit_hook(event, args):
+    if event in FS_EVENTS:
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace.add_fs_call(event, args)
+
+
+@functools.cache
+def install_audit_hook():
+    """Install the audit hook recording filesystem calls, once per process.
+
+    Audit hooks can not be removed again but the hook returns right away
+    for threads which do not trace a request.
+    """
+    sys.addaudithook(_audit_hook)
+
+
+class Tracer:
+    """Trace requests of one dict proxy and keep sampled and slow traces."""
+
+    def __init__(self, proxy, sample_rate=0.0, slow_threshold=0.0, buffer_size=1000):
+        self.proxy = proxy
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.traces = deque(maxlen=buffer_size)
+        self.random = random.random
+        install_audit_hook()
+
+    def trace(self, func, msg, *args):
+        """Call ``func(msg, *args)`` to handle a request line while tracing it."""
+        trace = Trace(self.proxy, chr(msg[0]), self.random() < self.sample_rate)
+        _local.trace = trace
+        try:
+            res = func(msg, *args)
+            if type(res) is str:
+                trace.result = res[:1]
+            return res
+        finally:
+            _local.trace = None
+            trace.duration = time.perf_counter() - trace.start
+            self.finish(trace)
+
+    def finish(self, trace):
+        slow = self.slow_threshold and trace.duration >= self.slow_threshold
+        if not (slow or trace.sampled):
+            return
+        self.traces.append(trace)
+        if slow:
+            logging.warning(f"slow dict request: {json.dumps(trace.as_dict())}")
+
+    def dump(self):
+        """Return all kept traces as JSON lines, oldest first."""
+        return "".join(
+            json.dumps(trace.as_dict()) + "\n" for trace in list(self.traces)
+        )
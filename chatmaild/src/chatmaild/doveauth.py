@@ -1,4 +1,4 @@
-import json
+import itertools
 import logging
 import os
 import sys
@@ -8,9 +8,16 @@ try:
 except ImportError:
     import crypt as crypt_r
 
+from .accountfilter import AccountFilter
 from .config import Config, read_config
-from .dictproxy import DictProxy
+from .dictparse import split_and_unescape
+from .dictproxy import DictProxy, get_argument_parser, iter_chunks
+from .dicttrace import trace_phase
+from .layout import iter_maildirs
 from .migrate_db import migrate_from_db_to_maildir
+from .passwordhash import PasswordHasher
+from .singleflight import SingleFlight
+from .userdbcache import UserdbCache
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
 
@@ -26,7 +33,9 @@ def is_allowed_to_create(
 ) -> bool:
     """Return True if user and password are admissable."""
     if not ignore_nocreate and not getattr(config, "public_create_enabled", True):
-        logging.warning("blocked account creation because public_create_enabled is false.")
+        logging.warning(
+            "blocked account creation because public_create_enabled is false."
+        )
         return False
 
     if not ignore_nocreate and os.path.exists(NOCREATE_FILE):
@@ -61,36 +70,38 @@ def is_allowed_to_create(
     return True
 
 
-def split_and_unescape(s):
-    """Split strings using double quote as a separator and backslash as escape character
-    into parts."""
-
-    out = ""
-    i = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\":
-            # Skip escape character.
-            i += 1
-
-            # This will raise IndexError if there is no character
-            # after escape character. This is expected
-            # as this is an invalid input.
-            out += s[i]
-        elif c == '"':
-            # Separator
-            yield out
-            out = ""
-        else:
-            out += c
-        i += 1
-    yield out
-
-
 class AuthDictProxy(DictProxy):
+    name = "doveauth"
+
     def __init__(self, config):
         super().__init__()
         self.config = config
+        self.userdb_cache = UserdbCache(
+            maxsize=config.doveauth_cache_size,
+            ttl=config.doveauth_cache_ttl,
+            stats=self.stats,
+        )
+        # concurrent lookups of the same account share one filesystem read
+        # and concurrent first logins create the account only once
+        self.flights = SingleFlight(stats=self.stats)
+        self.password_hasher = PasswordHasher(
+            processes=config.doveauth_hash_processes,
+            max_inflight=config.doveauth_create_max_inflight,
+            deadline=config.doveauth_create_deadline,
+            stats=self.stats,
+        )
+        self.account_filter = None
+        # the filter tracks changes of the top directory of the "flat" layout
+        if config.doveauth_account_filter and config.mailboxes_layout == "flat":
+            self.account_filter = AccountFilter(
+                config.mailboxes_dir,
+                negative_ttl=config.doveauth_negative_cache_ttl,
+                stats=self.stats,
+            )
+
+    def init_worker(self, worker_num, first_start=True):
+        if self.account_filter is not None:
+            self.account_filter.start()
 
     def handle_lookup(self, parts):
         # Dovecot <2.3.17 has only one part,
@@ -98,7 +109,7 @@ class AuthDictProxy(DictProxy):
         keyname = parts[0]
 
         namespace, type, args = keyname.split("/", 2)
-        args = list(split_and_unescape(args))
+        args = split_and_unescape(args)
 
         config = self.config
         reply_command = "F"
@@ -106,57 +117,107 @@ class AuthDictProxy(DictProxy):
         if namespace == "shared":
             if type == "userdb":
                 user = args[0]
+                entry = None
                 if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_userdb(user)
-                if res:
+                    entry = self.get_userdb_entry(user)
+                if entry:
                     reply_command = "O"
+                    res = entry.json
                 else:
                     reply_command = "N"
             elif type == "passdb":
                 user = args[1]
+                entry = None
                 if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_passdb(user, cleartext_password=args[0])
-                if res:
+                    entry = self.get_passdb_entry(user, cleartext_password=args[0])
+                if entry:
                     reply_command = "O"
+                    res = entry.json
                 else:
                     reply_command = "N"
-        json_res = json.dumps(res) if res else ""
-        return f"{reply_command}{json_res}\n"
+        return f"{reply_command}{res}\n"
 
     def handle_iterate(self, parts):
         # example: I0\t0\tshared/userdb/
         if parts[2] == "shared/userdb/":
-            result = "".join(
-                f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb()
+            # stream the reply so that memory use does not grow with the
+            # number of accounts, the empty line finishes the iteration
+            lines = (f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb())
+            return iter_chunks(
+                itertools.chain(lines, ["\n"]),
+                self.config.dictproxy_iterate_chunk_size,
             )
-            return f"{result}\n"
 
-    def iter_userdb(self) -> list:
-        """Get a list of all user addresses."""
-        return [x for x in os.listdir(self.config.mailboxes_dir) if "@" in x]
+    def iter_userdb(self):
+        """Yield all user addresses."""
+        if self.config.account_index is not None:
+            yield from self.config.account_index.iter_addresses()
+            return
+        for addr, _ in iter_maildirs(self.config.mailboxes_dir):
+            yield addr
 
-    def lookup_userdb(self, addr):
-        return self.config.get_user(addr).get_userdb_dict()
+    def get_userdb_entry(self, addr):
+        """Return the cached `UserdbEntry` of ``addr`` or None."""
+        return self.flights.do(("userdb", addr), self.load_userdb_entry, addr)
 
-    def lookup_passdb(self, addr, cleartext_password):
+    def load_userdb_entry(self, addr):
         user = self.config.get_user(addr)
-        userdata = user.get_userdb_dict()
-        if userdata:
-            return userdata
+        account_filter = self.account_filter
+        if account_filter is None:
+            return self.userdb_cache.get(user)
+
+        version = account_filter.get_version()
+        if account_filter.is_missing(addr, version):
+            return None
+        entry = self.userdb_cache.get(user)
+        if entry is None:
+            account_filter.record_missing(addr, version)
+        return entry
+
+    def get_passdb_entry(self, addr, cleartext_password):
+        """Return the `UserdbEntry` of ``addr``,
+        creating the account if it does not exist and creation is allowed."""
+        entry = self.get_userdb_entry(addr)
+        if entry:
+            return entry
         if not is_allowed_to_create(self.config, addr, cleartext_password):
             return
+        return self.flights.do(
+            ("create", addr), self.create_account, addr, cleartext_password
+        )
+
+    def create_account(self, addr, cleartext_password):
+        # never overwrite an account that was created by a concurrent lookup
+        # or by another process after the filter or the negative cache answered
+        user = self.config.get_user(addr)
+        entry = self.userdb_cache.get(user)
+        if entry:
+            return entry
 
-        user.set_password(encrypt_password(cleartext_password))
+        with trace_phase("encrypt_password"):
+            passhash = self.password_hasher.hash(encrypt_password, cleartext_password)
+        user.set_password(passhash)
         print(f"Created address: {addr}", file=sys.stderr)
-        return user.get_userdb_dict()
+        if self.account_filter is not None:
+            self.account_filter.add(addr)
+        return self.get_userdb_entry(addr)
+
+    def lookup_userdb(self, addr):
+        entry = self.get_userdb_entry(addr)
+        return entry.userdb if entry else {}
+
+    def lookup_passdb(self, addr, cleartext_password):
+        entry = self.get_passdb_entry(addr, cleartext_password)
+        return entry.userdb if entry else None
 
 
 def main():
-    socket, cfgpath = sys.argv[1:]
-    config = read_config(cfgpath)
+    parser = get_argument_parser("Serve Dovecot passdb and userdb lookups")
+    args = parser.parse_args()
+    config = read_config(args.chatmail_ini)
 
     migrate_from_db_to_maildir(config)
 
     dictproxy = AuthDictProxy(config=config)
 
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever_from_config(args.socket, config, workers=args.workers)
@@ -13,18 +13,33 @@ from datetime import datetime
 from stat import S_ISREG
 
 from chatmaild.config import read_config
+from chatmaild.layout import iter_maildirs
 
 FileEntry = namedtuple("FileEntry", ("path", "mtime", "size"))
 
 
-def iter_mailboxes(basedir, maxnum):
+def iter_mailboxes(basedir, maxnum, maildirs=None):
+    """Yield a `MailboxStat` for the mailboxes in ``basedir`` in any layout,
+    only for the ``maildirs`` paths if given, e.g. from the account index."""
     if not os.path.exists(basedir):
         print_info(f"no mailboxes found at: {basedir}")
         return
 
-    for name in os_listdir_if_exists(basedir)[:maxnum]:
-        if "@" in name:
-            yield MailboxStat(basedir + "/" + name)
+    if maildirs is None:
+        maildirs = [path for _, path in iter_maildirs(basedir)]
+    for path in maildirs[:maxnum]:
+        yield MailboxStat(path)
+
+
+def get_indexed_maildirs(config):
+    """Return the mailbox paths of all accounts in the account index
+    or None if the index is disabled."""
+    if config.account_index is None:
+        return None
+    return [
+        str(config.get_user(addr).maildir)
+        for addr in config.account_index.iter_addresses()
+    ]
 
 
 def get_file_entry(path):
@@ -89,12 +104,20 @@ class Expiry:
         self.del_files = 0
         self.all_files = 0
         self.start = time.time()
+        # (address, number of messages, size of messages) of kept mailboxes
+        self.usage = []
 
     def remove_mailbox(self, mboxdir):
         if self.verbose:
             print_info(f"removing {mboxdir}")
         if not self.dry:
             shutil.rmtree(mboxdir)
+            if self.config.account_index is not None:
+                self.config.account_index.remove(os.path.basename(mboxdir))
+            if self.config.activity_log is not None:
+                self.config.activity_log.forget(os.path.basename(mboxdir))
+            if self.config.metadata_token_store is not None:
+                self.config.metadata_token_store.remove(os.path.basename(mboxdir))
         self.del_mboxes += 1
 
     def remove_file(self, path, mtime=None):
@@ -132,6 +155,7 @@ class Expiry:
             else:
                 print_info(f"checking mailbox (no last_login) {mboxname}")
         self.all_files += len(mbox.messages)
+        kept_messages = kept_size = 0
         for message in mbox.messages:
             if message.mtime < cutoff_mails:
                 self.remove_file(message.path, mtime=message.mtime)
@@ -140,11 +164,22 @@ class Expiry:
                 parts = message.path.split("/")
                 if len(parts) >= 2 and parts[-2] == "cur":
                     self.remove_file(message.path, mtime=message.mtime)
+                else:
+                    kept_messages += 1
+                    kept_size += message.size
             else:
+                kept_messages += 1
+                kept_size += message.size
                 continue
             changed = True
         if changed:
             self.remove_file(f"{mbox.basedir}/maildirsize")
+        self.usage.append((mboxname, kept_messages, kept_size))
+
+    def record_usage(self):
+        """Store the message usage of kept mailboxes in the account index."""
+        if not self.dry and self.config.account_index is not None:
+            self.config.account_index.set_usage(self.usage)
 
     def get_summary(self):
         return (
@@ -197,8 +232,13 @@ def main(args=None):
 
     maxnum = int(args.maxnum) if args.maxnum else None
     exp = Expiry(config, dry=not args.remove, now=now, verbose=args.verbose)
-    for mailbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
+    for mailbox in iter_mailboxes(
+        str(config.mailboxes_dir), maxnum, maildirs=get_indexed_maildirs(config)
+    ):
         exp.process_mailbox_stat(mailbox)
+    exp.record_usage()
+    if args.remove and config.activity_log is not None:
+        config.activity_log.prune(now, config.activity_log_days)
     print(exp.get_summary())
 
 
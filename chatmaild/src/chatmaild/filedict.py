@@ -13,6 +13,8 @@ class FileDict:
     def __init__(self, path):
         self.path = path
         self.lock_path = path.with_name(path.name + ".lock")
+        # `get_validator` of the file written by the last `modify`
+        self.validator = None
 
     @contextmanager
     def modify(self):
@@ -25,6 +27,7 @@ class FileDict:
             with write_path.open("w") as f:
                 json.dump(data, f)
             os.rename(write_path, self.path)
+            self.validator = get_validator(self.path)
 
     def read(self):
         try:
@@ -37,6 +40,16 @@ class FileDict:
             return {}
 
 
+def get_validator(path):
+    """Return the inode, modification time and size of ``path``
+    or None if it is missing."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
 def write_bytes_atomic(path, content):
     rint = randint(0, 10000000)
     tmp = path.with_name(path.name + f".tmp-{rint}")
@@ -20,7 +20,7 @@ from argparse import ArgumentParser
 from datetime import datetime
 
 from chatmaild.config import read_config
-from chatmaild.expire import iter_mailboxes
+from chatmaild.expire import get_indexed_maildirs, iter_mailboxes
 
 DAYSECONDS = 24 * 60 * 60
 MONTHSECONDS = DAYSECONDS * 30
@@ -159,7 +159,8 @@ def main(args=None):
 
     maxnum = int(args.maxnum) if args.maxnum else None
     rep = Report(now=now, min_login_age=int(args.min_login_age), mdir=args.mdir)
-    for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
+    maildirs = get_indexed_maildirs(config)
+    for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum, maildirs=maildirs):
         rep.process_mailbox_stat(mbox)
     rep.dump_summary()
 
@@ -0,0 +1,102 @@
+"""
+Serve the doveauth, lastlogin and metadata dict proxies from one process.
+
+Small deployments can run the ``chatmail-hub`` unit instead of the
+``doveauth``, ``lastlogin`` and ``chatmail-metadata`` units
+to load Python and chatmaild only once.
+The hub listens on the same socket paths as the separate services
+so the Dovecot configuration does not change.
+
+All proxies share one `Config` instance and are served from a single
+event loop, running filesystem work on one pool of
+``dictproxy_executor_threads`` threads regardless of ``dictproxy_engine``
+and ``dictproxy_workers``.
+"""
+
+import asyncio
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .config import read_config
+from .dictproxy import serve_until_stopped
+from .dictstats import get_stats_socket_path, start_stats_server
+from .doveauth import AuthDictProxy
+from .lastlogin import LastLoginDictProxy
+from .metadata import create_metadata_dictproxy
+from .migrate_db import migrate_from_db_to_maildir
+from .profiling import Profiler
+
+DOVEAUTH_SOCKET = "/run/doveauth/doveauth.socket"
+LASTLOGIN_SOCKET = "/run/chatmail-lastlogin/lastlogin.socket"
+METADATA_SOCKET = "/run/chatmail-metadata/metadata.socket"
+
+
+def create_dictproxies(config, doveauth_socket, lastlogin_socket, metadata_socket):
+    """Return a mapping of socket paths to the dict proxies serving them."""
+    metadata = create_metadata_dictproxy(config)
+    if metadata is None:
+        return None
+
+    return {
+        doveauth_socket: AuthDictProxy(config=config),
+        lastlogin_socket: LastLoginDictProxy(config=config),
+        metadata_socket: metadata,
+    }
+
+
+async def start_hub(dictproxies, config, executor):
+    """Start serving all ``dictproxies`` from the running event loop
+    and return the asyncio server objects."""
+    servers = []
+    # all proxies control the same profiler of the hub process
+    profiler = Profiler("hub", Path(next(iter(dictproxies))).parent)
+    profiler.install_signal_handlers()
+    for socket, dictproxy in dictproxies.items():
+        dictproxy.configure(config)
+        dictproxy.profiler = profiler
+        start_stats_server(
+            get_stats_socket_path(socket), dictproxy.handle_stats_command
+        )
+        dictproxy.init_worker(0)
+        servers.append(await dictproxy.start_async_server(socket, executor))
+    return servers
+
+
+def serve_hub(dictproxies, config):
+    async def serve():
+        servers = await start_hub(dictproxies, config, executor)
+        await serve_until_stopped(servers, dictproxies.values())
+
+    with ThreadPoolExecutor(max_workers=config.dictproxy_executor_threads) as executor:
+        asyncio.run(serve())
+    for dictproxy in dictproxies.values():
+        dictproxy.shutdown()
+
+
+def main(args=None):
+    """Serve passdb/userdb lookups, last login tracking and IMAP METADATA
+    from a single process"""
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    parser.add_argument("--doveauth-socket", default=DOVEAUTH_SOCKET)
+    parser.add_argument("--lastlogin-socket", default=LASTLOGIN_SOCKET)
+    parser.add_argument("--metadata-socket", default=METADATA_SOCKET)
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    migrate_from_db_to_maildir(config)
+
+    dictproxies = create_dictproxies(
+        config, args.doveauth_socket, args.lastlogin_socket, args.metadata_socket
+    )
+    if dictproxies is None:
+        return 1
+
+    logging.info(f"serving {', '.join(dictproxies)}")
+    serve_hub(dictproxies, config)
+
+
+if __name__ == "__main__":
+    main()
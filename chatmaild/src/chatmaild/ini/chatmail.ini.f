@@ -70,6 +70,133 @@ postfix_reinject_port = 10025
 filtermail_smtp_port_incoming = 10081
 postfix_reinject_port_incoming = 10026
 
+# How the dict proxies (doveauth, lastlogin, chatmail-metadata) serve
+# Dovecot connections: "threads" starts one thread per connection,
+# "asyncio" serves all connections from a single event loop
+# and runs filesystem work on a bounded pool of executor threads.
+dictproxy_engine = threads
+
+# number of executor threads used by the "asyncio" dict proxy engine
+dictproxy_executor_threads = 16
+
+# if set to "True" a single chatmail-hub process serves
+# the doveauth, lastlogin and metadata dict proxies
+# instead of three separate services, saving memory on small servers
+dictproxy_hub = False
+
+# number of worker processes of each dict proxy,
+# more than 1 spreads lookups of busy relays across several CPU cores
+dictproxy_workers = 1
+
+# number of accounts sent per write when Dovecot iterates
+# over all accounts, e.g. for "doveadm -A"
+dictproxy_iterate_chunk_size = 1000
+
+# Load limits of each dict proxy (0 means unlimited).
+# Connections beyond dictproxy_max_connections are closed right away.
+# At most dictproxy_max_inflight requests are handled concurrently,
+# and requests which could not start within dictproxy_queue_deadline seconds
+# are answered with a failure instead of letting Dovecot time out.
+dictproxy_max_connections = 0
+dictproxy_max_inflight = 0
+dictproxy_queue_deadline = 5
+
+# Request tracing of each dict proxy (0 means disabled).
+# A dictproxy_trace_sample_rate fraction of requests (e.g. 0.001)
+# and all requests taking dictproxy_trace_slow_threshold seconds or longer
+# are traced; slow requests are also logged.  The last
+# dictproxy_trace_buffer_size traces are available with
+# "chatmail-dictstats --command traces <stats socket>".
+dictproxy_trace_sample_rate = 0
+dictproxy_trace_slow_threshold = 0
+dictproxy_trace_buffer_size = 1000
+
+# doveauth caches the userdb entries of up to doveauth_cache_size
+# recently seen accounts (0 disables the cache).  Entries are checked
+# against the password file on every use and expire
+# after doveauth_cache_ttl seconds.
+doveauth_cache_size = 10000
+doveauth_cache_ttl = 60
+
+# chatmail-metadata caches the push notification tokens of up to
+# metadata_cache_size recently notified accounts (0 disables the cache).
+# Entries are checked against the metadata.json file on every use.
+metadata_cache_size = 10000
+
+# With metadata_notify_mode "sync" chatmail-metadata looks up the tokens
+# of a user with a new message and stores them in its persistent
+# notification queue before Dovecot finishes delivering the message.
+# With "async" it only remembers the user in memory and does this
+# in the background, so deliveries do not wait for the filesystem,
+# but users waiting when chatmail-metadata crashes are not notified.
+# If metadata_notify_queue_size users are waiting, new messages
+# are handled as with "sync" until the queue has space again.
+metadata_notify_mode = sync
+metadata_notify_queue_size = 1000
+
+# Expired push notification tokens are skipped when notifying
+# and removed every metadata_sweep_interval seconds (0 disables removal)
+# by a low-priority background thread of chatmail-metadata, which checks
+# metadata_sweep_batch_size mailboxes and then pauses for a second.
+metadata_sweep_interval = 86400
+metadata_sweep_batch_size = 100
+
+# if set to "True" chatmail-metadata stores the push notification tokens
+# of all accounts in an SQLite database next to the mailboxes directory
+# instead of a metadata.json file in every mailbox.  After enabling it
+# and deploying, import the existing tokens with "runuser -u vmail --
+# chatmail-token-store /usr/local/lib/chatmaild/chatmail.ini import --remove".
+# The metadata.json files are used until the import has finished.
+metadata_token_store = False
+
+# if set to "True" doveauth answers lookups of nonexistent accounts
+# from a filter of existing accounts and from a cache of addresses
+# found missing during the last doveauth_negative_cache_ttl seconds,
+# without reading account files.
+# The filter is rebuilt by listing mailboxes_dir at most every 10 seconds
+# after accounts were created or deleted, which is costly on servers
+# with many accounts and frequent sign-ups.
+doveauth_account_filter = False
+doveauth_negative_cache_ttl = 5
+
+# Passwords of new accounts are hashed in doveauth_hash_processes
+# helper processes (0 hashes on the dict handler threads).
+# At most doveauth_create_max_inflight accounts are created concurrently,
+# creations which could not start within doveauth_create_deadline seconds
+# fail temporarily so that logins of existing accounts stay fast.
+doveauth_hash_processes = 2
+doveauth_create_max_inflight = 4
+doveauth_create_deadline = 5
+
+# The lastlogin dict proxy remembers which users logged in today
+# and does not touch their password files again until the next day.
+# With lastlogin_flush_interval greater than 0 the first login of a day
+# is written in batches every that many seconds instead of before replying,
+# a crash then loses the last logins of at most that interval.
+lastlogin_flush_interval = 0
+
+# if set to "True" all accounts are recorded in an SQLite database
+# next to the mailboxes directory which tools like chatmail-expire,
+# chatmail-metrics and the admin helpers read instead of listing
+# all mailboxes, see "chatmail-account-index --help"
+account_index = False
+
+# if set to "True" the lastlogin dict proxy also records the login days
+# of all accounts in small per-day bitmaps next to the mailboxes directory,
+# see "chatmail-activity --help" for counting active accounts.
+# chatmail-expire removes bitmaps older than activity_log_days.
+activity_log = False
+activity_log_days = 90
+
+# "flat" stores each mailbox directly in the mailboxes directory,
+# "sharded" stores it two levels deeper in directories named after
+# a hash of the address, which keeps directories small on servers
+# with hundreds of thousands of accounts.  After switching to "sharded"
+# and deploying, move existing mailboxes by running "chatmail-migrate-layout"
+# as root.
+# The doveauth_account_filter is not used with the "sharded" layout.
+mailboxes_layout = flat
+
 # if set to "True" IPv6 is disabled
 disable_ipv6 = False
 
@@ -1,29 +1,164 @@
-import sys
+import logging
+import threading
 
 from .config import read_config
-from .dictproxy import DictProxy
+from .dictproxy import DictProxy, get_argument_parser
+from .user import get_daytimestamp
 
 
 class LastLoginDictProxy(DictProxy):
+    """Record the day of the last login of every user
+    as the modification time of its password file.
+
+    Addresses recorded for the current day are kept in memory,
+    so repeated logins on the same day do not touch the filesystem.
+    With ``lastlogin_flush_interval`` greater than 0 new timestamps
+    are written in batches from a background thread instead of before
+    replying, and the remaining ones when the proxy shuts down.
+    """
+
+    name = "lastlogin"
+
     def __init__(self, config):
         super().__init__()
         self.config = config
+        self.flush_interval = config.lastlogin_flush_interval
+        self.lock = threading.Lock()
+        # addresses recorded or waiting to be written for ``self.day``
+        self.day = None
+        self.recorded = set()
+        # day timestamps of addresses waiting for the next flush
+        self.pending = {}
+        self.flusher = None
+        self.stopped = threading.Event()
+
+        stats = self.stats
+        self.saved_syscalls = stats.counter(
+            "lastlogin_saved_syscalls_total",
+            "number of stat and utime calls saved by coalescing last logins",
+        )
+        self.flushed = stats.counter(
+            "lastlogin_flushed_total",
+            "number of last login timestamps written in background batches",
+        )
+        self.recorded_size = stats.gauge(
+            "lastlogin_recorded_addresses",
+            "number of addresses whose last login is recorded for the current day",
+        )
+        for syscall in ("stat", "utime"):
+            self.saved_syscalls.inc((("syscall", syscall),), amount=0)
+        self.flushed.inc(amount=0)
+        self.recorded_size.set(0)
 
     def handle_set(self, addr, parts):
-        keyname = parts[1].split("/")
-        value = parts[2] if len(parts) > 2 else ""
-        if keyname[0] == "shared" and keyname[1] == "last-login":
-            addr = keyname[2]
-            timestamp = int(value)
-            user = self.config.get_user(addr)
-            user.set_last_login_timestamp(timestamp)
-            return True
+        return self.handle_set_batch(addr, [parts])
+
+    def handle_set_batch(self, addr, sets):
+        # only the latest timestamp of every user is written,
+        # so a transaction touches each password file at most once
+        timestamps = {}
+        for parts in sets:
+            keyname = parts[1].split("/")
+            value = parts[2] if len(parts) > 2 else ""
+            if keyname[0] != "shared" or keyname[1] != "last-login":
+                logging.error(f"dictproxy-set failed for {addr!r}: {list(parts)!r}")
+                return False
+            timestamps[keyname[2]] = max(int(value), timestamps.get(keyname[2], 0))
+
+        days = self.coalesce(timestamps)
+        if self.flush_interval > 0:
+            self.add_pending(days)
+        else:
+            self.write(days)
+        return True
+
+    def coalesce(self, timestamps):
+        """Return the day timestamps of the addresses in ``timestamps``
+        which are not yet recorded for their day and mark them as recorded."""
+        days = {}
+        saved = 0
+        with self.lock:
+            for user_addr, timestamp in timestamps.items():
+                day = get_daytimestamp(timestamp)
+                if self.day is None or day > self.day:
+                    self.day = day
+                    self.recorded.clear()
+                if day == self.day:
+                    if user_addr in self.recorded:
+                        saved += 1
+                        continue
+                    self.recorded.add(user_addr)
+                days[user_addr] = day
+            num_recorded = len(self.recorded)
+
+        stats = self.stats
+        with stats.lock:
+            self.saved_syscalls.inc((("syscall", "stat"),), amount=saved)
+            self.recorded_size.set(num_recorded)
+        return days
+
+    def add_pending(self, days):
+        saved = 0
+        with self.lock:
+            for user_addr, day in days.items():
+                if user_addr in self.pending:
+                    # a login on a later day replaces a not yet written one
+                    saved += 1
+                self.pending[user_addr] = max(day, self.pending.get(user_addr, 0))
+
+        stats = self.stats
+        with stats.lock:
+            self.saved_syscalls.inc((("syscall", "stat"),), amount=saved)
+            self.saved_syscalls.inc((("syscall", "utime"),), amount=saved)
+
+    def write(self, days):
+        recorded = {}
+        for user_addr, day in days.items():
+            user = self.config.get_user(user_addr)
+            if user.set_last_login_timestamp(day):
+                recorded[user_addr] = day
+            else:
+                # retry with the next login
+                with self.lock:
+                    if day == self.day:
+                        self.recorded.discard(user_addr)
+        if recorded and self.config.activity_log is not None:
+            self.config.activity_log.record(recorded)
+
+    def flush(self):
+        """Write all pending timestamps."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        self.write(pending)
+
+        stats = self.stats
+        with stats.lock:
+            self.flushed.inc(amount=len(pending))
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("writing last login timestamps failed")
+
+    def init_worker(self, worker_num, first_start=True):
+        if self.flush_interval > 0:
+            self.flusher = threading.Thread(
+                target=self.run_flusher, name="lastlogin-flush", daemon=True
+            )
+            self.flusher.start()
 
-        return False
+    def shutdown(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
 
 
 def main():
-    socket, config_path = sys.argv[1:]
-    config = read_config(config_path)
+    parser = get_argument_parser("Record last login timestamps of Dovecot users")
+    args = parser.parse_args()
+    config = read_config(args.chatmail_ini)
     dictproxy = LastLoginDictProxy(config=config)
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever_from_config(args.socket, config, workers=args.workers)
@@ -0,0 +1,83 @@
+"""
+Layouts of the mailboxes directory.
+
+With the "flat" layout every mailbox is a direct child
+of ``mailboxes_dir``, e.g. ``<mailboxes_dir>/user@example.org``.
+Directories with hundreds of thousands of entries make
+listing, lookups and backups slow, so the "sharded" layout
+puts each mailbox two levels deeper into directories named
+after the first four hex digits of the MD5 hash of the address,
+e.g. ``<mailboxes_dir>/b5/8e/user@example.org``.
+
+Mailboxes of a server switched to the "sharded" layout
+are moved by ``chatmail-migrate-layout`` while the server keeps running.
+Until then they are still found at their flat location,
+and listing functions return mailboxes of both layouts.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+LAYOUTS = ("flat", "sharded")
+
+
+def get_shard(addr):
+    """Return the names of the two shard directories of ``addr``."""
+    digest = hashlib.md5(addr.encode(), usedforsecurity=False).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+def get_sharded_maildir(mailboxes_dir, addr):
+    return Path(mailboxes_dir).joinpath(*get_shard(addr), addr)
+
+
+def get_maildir(mailboxes_dir, addr, layout):
+    """Return the mailbox directory of ``addr`` in ``layout``."""
+    flat = Path(mailboxes_dir).joinpath(addr)
+    if layout == "flat":
+        return flat
+    maildir = get_sharded_maildir(mailboxes_dir, addr)
+    if not maildir.exists() and flat.exists():
+        # not migrated yet
+        return flat
+    return maildir
+
+
+def is_shard_name(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def iter_maildirs(mailboxes_dir):
+    """Yield the address and path of all mailboxes in both layouts,
+    listing ``mailboxes_dir`` only once.
+
+    A mailbox which is being migrated may be yielded twice.
+    """
+    for name, path in scandir_if_exists(mailboxes_dir):
+        if "@" in name:
+            yield name, path
+        elif is_shard_name(name):
+            yield from iter_shard_maildirs(path)
+
+
+def iter_shard_maildirs(shard_dir):
+    """Yield the address and path of all mailboxes
+    below the top-level shard directory ``shard_dir``."""
+    for name, path in scandir_if_exists(shard_dir):
+        if is_shard_name(name):
+            for addr, maildir in scandir_if_exists(path):
+                if "@" in addr:
+                    yield addr, maildir
+
+
+def scandir_if_exists(path):
+    """Yield the names and paths of the entries of ``path``,
+    nothing if it does not exist or is not a directory."""
+    try:
+        entries = os.scandir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with entries:
+        for entry in entries:
+            yield entry.name, entry.path
@@ -1,19 +1,25 @@
 import logging
-import sys
+import os
+import threading
 import time
 from contextlib import contextmanager
 
 from .config import read_config
-from .dictproxy import DictProxy
-from .filedict import FileDict
-from .notifier import Notifier
+from .dictproxy import DictProxy, get_argument_parser
+from .filedict import FileDict, get_validator
+from .layout import get_maildir, iter_maildirs
+from .notifier import NewMessageQueue, Notifier
+from .tokencache import TokenCache
 from .turnserver import turn_credentials
 
+# seconds after which a registered token expires
+TOKEN_MAX_AGE = 3600 * 24 * 90
+
 
 def _is_valid_token_timestamp(timestamp, now):
     # Token if invalid after 90 days
     # or if the timestamp is in the future.
-    return timestamp > now - 3600 * 24 * 90 and timestamp < now + 60
+    return timestamp > now - TOKEN_MAX_AGE and timestamp < now + 60
 
 
 class Metadata:
@@ -22,15 +28,30 @@ class Metadata:
     # which only ever get removed if the upstream indicates the token is invalid
     DEVICETOKEN_KEY = "devicetoken"
 
-    def __init__(self, vmail_dir):
+    def __init__(self, vmail_dir, layout="flat", cache=None, store=None):
         self.vmail_dir = vmail_dir
+        self.layout = layout
+        # optional `TokenCache` of parsed tokens
+        self.cache = cache
+        # optional `TokenStore` used instead of metadata.json files
+        # once their tokens were imported, see `get_store`
+        self.store = store
+
+    def get_store(self):
+        """Return the token store or None if it is disabled
+        or the metadata.json files were not imported yet."""
+        if self.store is not None and self.store.is_imported():
+            return self.store
+        return None
 
     def get_metadata_dict(self, addr):
-        return FileDict(self.vmail_dir / addr / "metadata.json")
+        maildir = get_maildir(self.vmail_dir, addr, self.layout)
+        return FileDict(maildir / "metadata.json")
 
     @contextmanager
-    def _modify_tokens(self, addr):
-        with self.get_metadata_dict(addr).modify() as data:
+    def _modify_tokens(self, addr, use_cache=True):
+        mdict = self.get_metadata_dict(addr)
+        with mdict.modify() as data:
             tokens = data.setdefault(self.DEVICETOKEN_KEY, {})
             now = int(time.time())
             if isinstance(tokens, list):
@@ -46,18 +67,65 @@ class Metadata:
 
             yield tokens
 
+        if self.cache is not None and use_cache:
+            self.cache.put(addr, mdict.validator, dict(tokens))
+
     def add_token_to_addr(self, addr, token):
+        self.add_tokens_to_addr(addr, [token])
+
+    def add_tokens_to_addr(self, addr, new_tokens):
+        store = self.get_store()
+        if store is not None:
+            now = int(time.time())
+            store.add_tokens([(addr, token, now) for token in new_tokens])
+            return
         with self._modify_tokens(addr) as tokens:
-            tokens[token] = int(time.time())
+            now = int(time.time())
+            for token in new_tokens:
+                tokens[token] = now
 
     def remove_token_from_addr(self, addr, token):
+        store = self.get_store()
+        if store is not None:
+            store.remove_token_from_addr(addr, token)
+            return
         with self._modify_tokens(addr) as tokens:
             if token in tokens:
                 del tokens[token]
 
+    def remove_invalid_token(self, addr, token):
+        """Remove a token which the notification server does not accept anymore."""
+        store = self.get_store()
+        if store is not None:
+            # the same device may have registered the token for several addresses
+            store.remove_token(token)
+        else:
+            self.remove_token_from_addr(addr, token)
+
+    def read_tokens(self, addr):
+        """Return the tokens stored for ``addr``, from the cache if possible."""
+        store = self.get_store()
+        if store is not None:
+            return store.get_tokens(addr)
+        mdict = self.get_metadata_dict(addr)
+        if self.cache is None:
+            return mdict.read().get(self.DEVICETOKEN_KEY, {})
+
+        validator = get_validator(mdict.path)
+        tokens = self.cache.get(addr, validator)
+        if tokens is None:
+            # a file replaced after the stat above is cached with the old
+            # validator and therefore read again on the next lookup
+            tokens = mdict.read().get(self.DEVICETOKEN_KEY, {})
+            self.cache.put(addr, validator, tokens)
+        return tokens
+
     def get_tokens_for_addr(self, addr):
-        mdict = self.get_metadata_dict(addr).read()
-        tokens = mdict.get(self.DEVICETOKEN_KEY, {})
+        """Return the valid tokens of ``addr``.
+
+        Expired tokens are only skipped, they are removed by the `TokenSweeper`.
+        """
+        tokens = self.read_tokens(addr)
 
         now = int(time.time())
         if isinstance(tokens, dict):
@@ -66,22 +134,164 @@ class Metadata:
                 for token, timestamp in tokens.items()
                 if _is_valid_token_timestamp(timestamp, now)
             ]
-            if len(token_list) < len(tokens):
-                # Some tokens have expired, remove them.
-                with self._modify_tokens(addr) as _tokens:
-                    pass
         else:
             token_list = []
         return token_list
 
+    def remove_expired_tokens(self, addr):
+        """Remove the expired tokens of ``addr`` from its metadata.json
+        and return the number of removed tokens.
+
+        The cache is bypassed so that sweeping all mailboxes
+        does not evict the tokens of recently notified users.
+        """
+        tokens = self.get_metadata_dict(addr).read().get(self.DEVICETOKEN_KEY, {})
+        now = int(time.time())
+        if isinstance(tokens, dict) and all(
+            _is_valid_token_timestamp(timestamp, now) for timestamp in tokens.values()
+        ):
+            return 0
+        num = len(tokens)
+        with self._modify_tokens(addr, use_cache=False) as tokens:
+            pass
+        return max(num - len(tokens), 0)
+
+
+class TokenSweeper:
+    """Remove expired tokens of all users from a background thread.
+
+    Every ``interval`` seconds all mailboxes, or the token store,
+    are checked in batches of ``batch_size`` with a pause
+    of ``pause`` seconds after each batch, to limit the load
+    on the message delivery path.
+    """
+
+    # seconds to wait after starting before the first sweep
+    initial_delay = 60.0
+
+    def __init__(self, metadata, interval, batch_size=100, pause=1.0, stats=None):
+        self.metadata = metadata
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = stats
+        if stats is not None:
+            self.sweeps = stats.counter(
+                "metadata_token_sweeps_total", "number of completed token sweeps"
+            )
+            self.expired = stats.counter(
+                "metadata_expired_tokens_total",
+                "number of expired tokens removed by the sweeper",
+            )
+            self.sweeps.inc(amount=0)
+            self.expired.inc(amount=0)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="token-sweeper", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        try:
+            # on Linux this only lowers the priority of the calling thread
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        delay = self.initial_delay
+        while not self.stopped.wait(delay):
+            delay = self.interval
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("sweeping expired tokens failed")
+
+    def sweep(self):
+        """Remove all expired tokens and return their number,
+        or None if the sweep was stopped."""
+        store = self.metadata.get_store()
+        num = 0
+        if store is not None:
+            while True:
+                now = int(time.time())
+                removed = store.remove_expired_tokens(
+                    now - TOKEN_MAX_AGE + 1, now + 59, self.batch_size
+                )
+                num += removed
+                self.record(removed)
+                if removed < self.batch_size:
+                    break
+                if self.stopped.wait(self.pause):
+                    return None
+        else:
+            checked = 0
+            for addr, maildir in iter_maildirs(self.metadata.vmail_dir):
+                if os.path.exists(os.path.join(maildir, "metadata.json")):
+                    try:
+                        removed = self.metadata.remove_expired_tokens(addr)
+                    except FileNotFoundError:
+                        # mailbox deleted meanwhile
+                        removed = 0
+                    except OSError:
+                        logging.exception(f"could not sweep tokens of {addr}")
+                        removed = 0
+                    num += removed
+                    self.record(removed)
+                checked += 1
+                if checked % self.batch_size == 0 and self.stopped.wait(self.pause):
+                    return None
+        self.record(0, completed=True)
+        return num
+
+    def record(self, removed, completed=False):
+        if self.stats is not None:
+            with self.stats.lock:
+                self.expired.inc(amount=removed)
+                if completed:
+                    self.sweeps.inc()
+
 
 class MetadataDictProxy(DictProxy):
+    name = "metadata"
+
     def __init__(self, notifier, metadata, iroh_relay=None, turn_hostname=None):
         super().__init__()
         self.notifier = notifier
         self.metadata = metadata
         self.iroh_relay = iroh_relay
         self.turn_hostname = turn_hostname
+        # optional `TokenSweeper` run by the first worker
+        self.sweeper = None
+        # optional `NewMessageQueue` for handling new messages after replying
+        self.new_messages = None
+
+    def init_worker(self, worker_num, first_start=True):
+        # Notification threads must be started in every worker process
+        # because threads do not survive forking.  Only the first worker
+        # requeues persisted notifications so that they are sent only once,
+        # and only when all workers start together: a restarted worker
+        # would requeue notifications which the running workers still own.
+        self.notifier.start_notification_threads(
+            self.metadata.remove_invalid_token,
+            requeue=worker_num == 0 and first_start,
+        )
+        if self.sweeper is not None and worker_num == 0:
+            self.sweeper.start()
+        if self.new_messages is not None:
+            self.new_messages.start()
+
+    def shutdown(self):
+        if self.sweeper is not None:
+            self.sweeper.stop()
+        if self.new_messages is not None:
+            self.new_messages.stop()
 
     def handle_lookup(self, parts):
         # Lpriv/43f5f508a7ea0366dff30200c15250e3/devicetoken\tlkj123poi@c2.testrun.org
@@ -109,43 +319,84 @@ class MetadataDictProxy(DictProxy):
         return "N\n"
 
     def handle_set(self, addr, parts):
+        return self.handle_set_batch(addr, [parts])
+
+    def handle_set_batch(self, addr, sets):
         # For documentation on key structure see
         # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
-        keyname = parts[1].split("/")
-        value = parts[2] if len(parts) > 2 else ""
-        if keyname[0] == "priv" and keyname[2] == self.metadata.DEVICETOKEN_KEY:
-            self.metadata.add_token_to_addr(addr, value)
-            return True
-        elif keyname[0] == "priv" and keyname[2] == "messagenew":
-            self.notifier.new_message_for_addr(addr, self.metadata)
-            return True
+        tokens = []
+        new_message = False
+        for parts in sets:
+            keyname = parts[1].split("/")
+            value = parts[2] if len(parts) > 2 else ""
+            if keyname[0] == "priv" and keyname[2] == self.metadata.DEVICETOKEN_KEY:
+                tokens.append(value)
+            elif keyname[0] == "priv" and keyname[2] == "messagenew":
+                new_message = True
+            else:
+                logging.error(f"dictproxy-set failed for {addr!r}: {list(parts)!r}")
+                return False
 
-        return False
+        # all tokens are stored with one write of the metadata file,
+        # before notifying so that new tokens are notified as well
+        if tokens:
+            self.metadata.add_tokens_to_addr(addr, tokens)
+        if new_message:
+            if self.new_messages is not None:
+                self.new_messages.put(addr)
+            else:
+                self.notifier.new_message_for_addr(addr, self.metadata)
+        return True
 
 
-def main():
-    socket, config_path = sys.argv[1:]
-
-    config = read_config(config_path)
-    iroh_relay = config.iroh_relay
-    mail_domain = config.mail_domain
-
+def create_metadata_dictproxy(config):
+    """Return a `MetadataDictProxy` for ``config``
+    or None if the mailboxes directory does not exist."""
     vmail_dir = config.mailboxes_dir
     if not vmail_dir.exists():
         logging.error("vmail dir does not exist: %r", vmail_dir)
-        return 1
+        return None
 
     queue_dir = vmail_dir / "pending_notifications"
     queue_dir.mkdir(exist_ok=True)
-    metadata = Metadata(vmail_dir)
+    metadata = Metadata(
+        vmail_dir, config.mailboxes_layout, store=config.metadata_token_store
+    )
     notifier = Notifier(queue_dir)
-    notifier.start_notification_threads(metadata.remove_token_from_addr)
 
     dictproxy = MetadataDictProxy(
         notifier=notifier,
         metadata=metadata,
-        iroh_relay=iroh_relay,
-        turn_hostname=mail_domain,
+        iroh_relay=config.iroh_relay,
+        turn_hostname=config.mail_domain,
     )
+    # lookups in the token store are cheap and not validated by a file
+    if config.metadata_cache_size and metadata.store is None:
+        metadata.cache = TokenCache(config.metadata_cache_size, stats=dictproxy.stats)
+    if config.metadata_notify_mode == "async":
+        dictproxy.new_messages = NewMessageQueue(
+            notifier,
+            metadata,
+            maxsize=config.metadata_notify_queue_size,
+            stats=dictproxy.stats,
+        )
+    if config.metadata_sweep_interval:
+        dictproxy.sweeper = TokenSweeper(
+            metadata,
+            interval=config.metadata_sweep_interval,
+            batch_size=config.metadata_sweep_batch_size,
+            stats=dictproxy.stats,
+        )
+    return dictproxy
+
+
+def main():
+    parser = get_argument_parser("Serve Dovecot metadata lookups and notifications")
+    args = parser.parse_args()
+
+    config = read_config(args.chatmail_ini)
+    dictproxy = create_metadata_dictproxy(config)
+    if dictproxy is None:
+        return 1
 
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever_from_config(args.socket, config, workers=args.workers)
@@ -2,20 +2,36 @@
 import sys
 from pathlib import Path
 
+from chatmaild.accountindex import AccountIndex
+from chatmaild.layout import is_shard_name, iter_shard_maildirs, scandir_if_exists
 
-def main(vmail_dir=None):
+
+def main(vmail_dir=None, account_index_path=None):
     if vmail_dir is None:
         vmail_dir = sys.argv[1]
+        if len(sys.argv) > 2:
+            account_index_path = sys.argv[2]
 
     accounts = 0
     ci_accounts = 0
 
-    for path in Path(vmail_dir).iterdir():
-        if not path.joinpath("cur").is_dir():
-            continue
-        accounts += 1
-        if path.name[:3] in ("ci-", "ac_"):
-            ci_accounts += 1
+    if account_index_path is not None:
+        # count all accounts with a password instead of listing mailboxes
+        index = AccountIndex(account_index_path)
+        accounts = index.count()
+        ci_accounts = index.count(prefixes=("ci-", "ac_"))
+    else:
+        for name, path in scandir_if_exists(vmail_dir):
+            if is_shard_name(name):
+                maildirs = iter_shard_maildirs(path)
+            else:
+                maildirs = [(name, path)]
+            for addr, maildir in maildirs:
+                if not Path(maildir).joinpath("cur").is_dir():
+                    continue
+                accounts += 1
+                if addr[:3] in ("ci-", "ac_"):
+                    ci_accounts += 1
 
     print("# HELP total number of accounts")
     print("# TYPE accounts gauge")
@@ -0,0 +1,187 @@
+"""
+Move mailboxes from the "flat" into the "sharded" layout
+(see `chatmaild.layout`) while the server keeps running.
+
+Set ``mailboxes_layout = sharded`` in ``chatmail.ini`` and deploy first,
+then run as root::
+
+    chatmail-migrate-layout /usr/local/lib/chatmaild/chatmail.ini
+
+Root is needed to run ``doveadm``, and the shard directories created
+by the migration are handed to the owner of ``mailboxes_dir`` (vmail),
+so doveauth can still create accounts in them.
+
+After every move Dovecot's auth cache entry of the user is flushed
+with ``doveadm auth cache flush``, because Dovecot would otherwise
+keep using the cached flat home directory and deliver into
+a new empty mailbox there.  The migration stops if flushing fails.
+
+Mailboxes are renamed one by one, in batches with pauses in between
+to limit the load.  Every mailbox still at its flat location is found
+at its old place until it is moved, so the migration can be interrupted
+and resumed at any time.  If a client was using a mailbox while it was
+moved and Dovecot re-created parts of it at the flat location, running
+the migration again merges these files into the moved mailbox.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from chatmaild.config import read_config
+from chatmaild.layout import get_sharded_maildir
+
+
+def makedirs_owned(path, owner):
+    """Create ``path`` and its missing parents, owned by the uid and gid
+    of the ``owner`` stat result."""
+    path = Path(path)
+    if path.exists():
+        return
+    makedirs_owned(path.parent, owner)
+    try:
+        path.mkdir()
+    except FileExistsError:
+        return
+    os.chown(path, owner.st_uid, owner.st_gid)
+
+
+def merge_maildir(source, target, owner):
+    """Move all files below ``source`` into ``target``
+    and remove ``source``.  Files existing in both are kept in ``target``."""
+    for dirpath, dirnames, filenames in os.walk(source, topdown=False):
+        targetdir = os.path.join(target, os.path.relpath(dirpath, source))
+        makedirs_owned(targetdir, owner)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            targetpath = os.path.join(targetdir, name)
+            if os.path.exists(targetpath):
+                os.unlink(path)
+            else:
+                os.rename(path, targetpath)
+        os.rmdir(dirpath)
+
+
+def migrate_mailbox(config, addr):
+    """Move the mailbox of ``addr`` from its flat to its sharded location."""
+    source = config.mailboxes_dir.joinpath(addr)
+    target = get_sharded_maildir(config.mailboxes_dir, addr)
+    owner = os.stat(config.mailboxes_dir)
+    makedirs_owned(target.parent, owner)
+    try:
+        os.rename(source, target)
+    except FileNotFoundError:
+        # deleted meanwhile
+        return
+    except OSError:
+        # partly re-created at the flat location after an earlier move
+        merge_maildir(source, target, owner)
+
+
+def iter_flat_addresses(config):
+    try:
+        names = os.listdir(config.mailboxes_dir)
+    except FileNotFoundError:
+        return
+    for name in sorted(names):
+        if "@" in name:
+            yield name
+
+
+def kick(addr):
+    """Disconnect the IMAP sessions of ``addr`` before moving its mailbox."""
+    subprocess.run(["doveadm", "kick", addr], capture_output=True, check=False)
+
+
+def flush_auth_cache(addr):
+    """Make Dovecot look up the moved home directory of ``addr``."""
+    try:
+        subprocess.run(
+            ["doveadm", "auth", "cache", "flush", addr], capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"could not flush Dovecot's auth cache of {addr}: {e}")
+
+
+def migrate_layout(config, batch_size=1000, pause=1.0, limit=None, use_kick=False):
+    """Move up to ``limit`` mailboxes into the sharded layout
+    and return the number of moved mailboxes."""
+    if config.mailboxes_layout != "sharded":
+        raise ValueError("mailboxes_layout must be set to 'sharded' to migrate")
+
+    num = 0
+    start = time.time()
+    for addr in iter_flat_addresses(config):
+        if limit is not None and num >= limit:
+            break
+        if use_kick:
+            kick(addr)
+        migrate_mailbox(config, addr)
+        flush_auth_cache(addr)
+        num += 1
+        if num % batch_size == 0:
+            rate = num / (time.time() - start)
+            logging.info(f"moved {num} mailboxes ({rate:.0f}/s)")
+            time.sleep(pause)
+    return num
+
+
+def main(args=None):
+    """Move mailboxes into the sharded layout, can be interrupted and resumed"""
+    parser = ArgumentParser(description=main.__doc__)
+    ini = "/usr/local/lib/chatmaild/chatmail.ini"
+    parser.add_argument(
+        "chatmail_ini",
+        action="store",
+        nargs="?",
+        help=f"path pointing to chatmail.ini file, default: {ini}",
+        default=ini,
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of mailboxes to move between pauses",
+    )
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=1.0,
+        help="seconds to pause after each batch",
+    )
+    parser.add_argument(
+        "--maxnum",
+        type=int,
+        default=None,
+        help="maximum number of mailboxes to move",
+    )
+    parser.add_argument(
+        "--kick",
+        action="store_true",
+        help="disconnect IMAP sessions of each user with 'doveadm kick' first",
+    )
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    config = read_config(args.chatmail_ini)
+    try:
+        num = migrate_layout(
+            config,
+            batch_size=args.batch_size,
+            pause=args.pause,
+            limit=args.maxnum,
+            use_kick=args.kick,
+        )
+    except (ValueError, RuntimeError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    remaining = sum(1 for _ in iter_flat_addresses(config))
+    print(f"moved {num} mailboxes, {remaining} remaining")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
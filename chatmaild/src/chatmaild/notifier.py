@@ -17,6 +17,10 @@ and which are scheduled for retry using exponential back-off timing.
 If a token notification would be scheduled more than DROP_DEADLINE seconds
 after its first attempt, it is dropped with a log error.
 
+With ``metadata_notify_mode = async`` new messages are only put into
+the in-memory NewMessageQueue before Dovecot's transaction is committed,
+and a background thread looks up the tokens and persists the queue items.
+
 Note that tokens are opaque to the notification machinery here
 and are encrypted foreclosing all ability to distinguish
 which device token ultimately goes to which phone-provider notification service,
@@ -31,8 +35,8 @@ import os
 import time
 from dataclasses import dataclass
 from pathlib import Path
-from queue import PriorityQueue
-from threading import Thread
+from queue import Full, PriorityQueue, Queue
+from threading import Lock, Thread
 from uuid import uuid4
 
 import requests
@@ -114,8 +118,9 @@ class Notifier:
 
         self.retry_queues[retry_num].put((when, queue_item))
 
-    def start_notification_threads(self, remove_token_from_addr):
-        self.requeue_persistent_queue_items()
+    def start_notification_threads(self, remove_token_from_addr, requeue=True):
+        if requeue:
+            self.requeue_persistent_queue_items()
         threads = {}
         for retry_num in range(len(self.retry_queues)):
             # use 4 threads for first-try tokens and less for subsequent tries
@@ -128,9 +133,104 @@ class Notifier:
         return threads
 
 
+class NewMessageQueue:
+    """Bounded in-memory queue of addresses with new messages
+    whose tokens are looked up and queued for notification
+    by a background thread.
+
+    An address which is already waiting is not queued again.
+    If ``maxsize`` addresses are waiting, new messages are handled
+    by the caller instead, which slows down Dovecot rather than
+    growing the queue.  Addresses still waiting when the process
+    crashes are not notified.
+    """
+
+    def __init__(self, notifier, metadata, maxsize=1000, stats=None):
+        self.notifier = notifier
+        self.metadata = metadata
+        self.queue = Queue(maxsize)
+        self.lock = Lock()
+        self.waiting = set()
+        self.thread = None
+        self.stats = stats
+        if stats is not None:
+            self.queued = stats.counter(
+                "metadata_messagenew_queued_total",
+                "number of new messages queued for background handling",
+            )
+            self.coalesced = stats.counter(
+                "metadata_messagenew_coalesced_total",
+                "number of new messages for addresses already waiting in the queue",
+            )
+            self.inline = stats.counter(
+                "metadata_messagenew_inline_total",
+                "number of new messages handled before replying because the queue was full",
+            )
+            self.depth = stats.gauge(
+                "metadata_messagenew_queue_depth",
+                "number of addresses waiting in the new message queue",
+            )
+            self.queued.inc(amount=0)
+            self.coalesced.inc(amount=0)
+            self.inline.inc(amount=0)
+            self.depth.set(0)
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="messagenew", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Handle all waiting addresses and stop the background thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def put(self, addr):
+        """Queue ``addr`` or handle it right away if the queue is full."""
+        with self.lock:
+            if addr in self.waiting:
+                counter = "coalesced"
+            else:
+                try:
+                    self.queue.put_nowait(addr)
+                except Full:
+                    counter = "inline"
+                else:
+                    self.waiting.add(addr)
+                    counter = "queued"
+        self.record(counter)
+        if counter == "inline":
+            self.notifier.new_message_for_addr(addr, self.metadata)
+
+    def run(self):
+        while self.handle_one():
+            pass
+
+    def handle_one(self):
+        addr = self.queue.get()
+        if addr is None:
+            return False
+        with self.lock:
+            self.waiting.discard(addr)
+        self.record()
+        try:
+            self.notifier.new_message_for_addr(addr, self.metadata)
+        except Exception:
+            logging.exception(f"could not queue notifications for {addr!r}")
+        return True
+
+    def record(self, counter=None):
+        if self.stats is not None:
+            with self.stats.lock:
+                if counter is not None:
+                    getattr(self, counter).inc()
+                self.depth.set(self.queue.qsize())
+
+
 class NotifyThread(Thread):
     def __init__(self, notifier, retry_num, remove_token_from_addr):
-        super().__init__(daemon=True)
+        super().__init__(daemon=True, name=f"notify-{retry_num}")
         self.notifier = notifier
         self.retry_num = retry_num
         self.remove_token_from_addr = remove_token_from_addr
@@ -0,0 +1,140 @@
+"""
+Password hashing for account creation off the dict handler threads.
+
+Hashing a new password with SHA512-crypt takes milliseconds of CPU time
+while holding the GIL, so a wave of sign-ups would delay all other
+lookups served by the same doveauth process.
+`PasswordHasher` runs the hashing in a small pool of helper processes
+and admits at most ``max_inflight`` concurrent account creations.
+Creations which can not start within ``deadline`` seconds fail with
+`TemporaryFailure` so that Dovecot answers with a temporary error
+and the client retries later, while logins of existing accounts
+are not affected.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock, Semaphore
+from time import perf_counter
+
+from .dictproxy import TemporaryFailure
+from .dictstats import LATENCY_BUCKETS
+
+
+class PasswordHasher:
+    """Run password hash functions in helper processes with admission control.
+
+    With ``processes=0`` hashing runs on the calling thread.
+    """
+
+    # process pools by size, shared by all hashers of a process
+    _pools = {}
+    _pools_lock = Lock()
+
+    def __init__(self, processes=2, max_inflight=4, deadline=5.0, stats=None):
+        self.processes = processes
+        self.deadline = deadline
+        self.slots = Semaphore(max_inflight) if max_inflight else None
+        self.stats = stats
+        if stats is not None:
+            self.latency = stats.histogram(
+                "doveauth_password_hash_seconds",
+                "time to hash the password of a new account",
+                LATENCY_BUCKETS,
+            )
+            self.queued = stats.gauge(
+                "doveauth_account_creations_queued",
+                "number of account creations waiting to start",
+            )
+            self.inflight = stats.gauge(
+                "doveauth_account_creations_inflight",
+                "number of account creations hashing a password",
+            )
+            self.rejected = stats.counter(
+                "doveauth_account_creations_rejected_total",
+                "number of account creations failed because of overload",
+            )
+            self.latency.add_series()
+            self.queued.set(0)
+            self.inflight.set(0)
+            self.rejected.inc(amount=0)
+
+    def get_pool(self):
+        with self._pools_lock:
+            pool = self._pools.get(self.processes)
+            if pool is None:
+                # helper processes are spawned because forking a process
+                # with running threads is unsafe
+                pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self._pools[self.processes] = pool
+            return pool
+
+    def discard_pool(self, pool):
+        with self._pools_lock:
+            if self._pools.get(self.processes) is pool:
+                del self._pools[self.processes]
+        pool.shutdown(wait=False)
+
+    def hash(self, func, password):
+        """Return ``func(password)`` computed in a helper process.
+
+        Raise `TemporaryFailure` if no creation slot became free
+        within the deadline or the helper processes failed.
+        """
+        if self.slots is not None:
+            self.add_gauge("queued", 1)
+            try:
+                admitted = self.slots.acquire(timeout=self.deadline or None)
+            finally:
+                self.add_gauge("queued", -1)
+            if not admitted:
+                if self.stats is not None:
+                    with self.stats.lock:
+                        self.rejected.inc()
+                raise TemporaryFailure("too many concurrent account creations")
+
+        self.add_gauge("inflight", 1)
+        start = perf_counter()
+        try:
+            if not self.processes:
+                return func(password)
+            return self.run_in_pool(func, password)
+        finally:
+            duration = perf_counter() - start
+            self.add_gauge("inflight", -1)
+            if self.stats is not None:
+                with self.stats.lock:
+                    self.latency.observe(duration)
+            if self.slots is not None:
+                self.slots.release()
+
+    def run_in_pool(self, func, password):
+        for _ in range(2):
+            pool = self.get_pool()
+            try:
+                future = pool.submit(func, password)
+            except RuntimeError:
+                # the pool broke or another thread discarded it, use a new one
+                self.discard_pool(pool)
+                continue
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                self.discard_pool(pool)
+                raise TemporaryFailure("password hashing processes failed")
+        raise TemporaryFailure("password hashing processes unavailable")
+
+    def add_gauge(self, name, amount):
+        if self.stats is not None:
+            gauge = getattr(self, name)
+            with self.stats.lock:
+                gauge.values[()] += amount
+
+
+# pools of the parent process can not be used by forked children
+os.register_at_fork(after_in_child=PasswordHasher._pools.clear)
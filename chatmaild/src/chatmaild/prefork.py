@@ -0,0 +1,244 @@
+"""
+Preforked worker processes for dict proxies.
+
+A single Python process serves requests on one core only.
+With ``--workers N`` a dict proxy binds its listening socket once
+and forks N worker processes which all accept connections on it,
+so that the kernel spreads connections across the workers.
+
+The parent process only supervises the workers:
+it restarts workers that exit unexpectedly, with an increasing delay
+if they keep crashing right after start, forwards SIGTERM
+to all workers on shutdown and forwards the profiling signals
+SIGUSR1 and SIGUSR2 (see `chatmaild.profiling`).
+
+Every worker serves its own statistics on a numbered socket
+(e.g. ``doveauth-stats-0.socket``).  The supervisor serves
+the merged statistics of all workers on the usual statistics socket
+so that ``chatmail-dictstats`` does not need to know about workers.
+"""
+
+import logging
+import os
+import signal
+import time
+from socketserver import StreamRequestHandler, UnixStreamServer
+
+from .dictproxy import open_listening_socket
+from .dictstats import Stats, get_stats_socket_path, merge_metrics, query_stats_socket
+
+# workers running shorter than this many seconds are restarted with a delay
+MIN_WORKER_LIFETIME = 5.0
+
+# upper bound of the delay before restarting a crashing worker in seconds
+MAX_RESTART_DELAY = 30.0
+
+
+class Worker:
+    def __init__(self, num):
+        self.num = num
+        self.pid = None
+        self.started = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = None
+        # whether the worker process was not restarted yet
+        self.first_start = True
+
+
+class Supervisor:
+    """Fork and supervise worker processes serving one dict proxy socket."""
+
+    # seconds between checks for exited workers
+    poll_interval = 0.5
+
+    def __init__(self, dictproxy, socket, config, num_workers):
+        self.dictproxy = dictproxy
+        self.socket = socket
+        self.config = config
+        self.workers = [Worker(num) for num in range(num_workers)]
+        self.stopping = False
+
+        self.stats = Stats(proxy=dictproxy.name)
+        self.num_workers = self.stats.gauge(
+            "dictproxy_workers", "number of running worker processes"
+        )
+        self.worker_restarts = self.stats.counter(
+            "dictproxy_worker_restarts_total",
+            "number of worker processes restarted after they exited",
+        )
+        self.num_workers.set(0)
+        self.worker_restarts.inc(amount=0)
+
+    def serve_forever(self):
+        """Serve until SIGTERM or SIGINT and return after all workers exited."""
+        self.listen_sock = open_listening_socket(self.socket)
+        # let all workers poll the shared socket without blocking in accept()
+        # after another worker took the connection
+        self.listen_sock.setblocking(False)
+        self.stats_server = self.create_stats_server()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.signal_workers)
+        signal.signal(signal.SIGUSR2, self.signal_workers)
+
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        with self.stats_server:
+            while self.reap_workers():
+                if not self.stopping:
+                    self.restart_workers()
+                self.stats_server.handle_request()
+
+        self.listen_sock.close()
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        """Stop accepting connections and terminate all workers."""
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, signum, frame=None):
+        """Send ``signum`` to all running workers."""
+        for worker in self.workers:
+            if worker.pid:
+                try:
+                    os.kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def start_worker(self, worker):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(worker)
+        worker.pid = pid
+        worker.first_start = False
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        logging.info(f"started {self.dictproxy.name} worker {worker.num}: pid {pid}")
+        self.update_num_workers()
+
+    def run_worker(self, worker):
+        """Serve in the forked worker process and never return."""
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            self.stats_server.socket.close()
+            self.dictproxy.serve_worker(
+                self.socket,
+                self.config,
+                worker_num=worker.num,
+                listen_sock=self.listen_sock,
+                stats_socket=get_stats_socket_path(self.socket, worker.num),
+                first_start=worker.first_start,
+            )
+            code = 0
+        except BaseException:
+            logging.exception(f"worker {worker.num} failed")
+        finally:
+            os._exit(code)
+
+    def reap_workers(self):
+        """Collect exited workers and schedule their restart.
+
+        Return False once all workers exited after stopping.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return not self.stopping
+            if pid == 0:
+                return True
+
+            for worker in self.workers:
+                if worker.pid == pid:
+                    break
+            else:
+                continue
+
+            worker.pid = None
+            self.update_num_workers()
+            if self.stopping:
+                continue
+
+            logging.error(
+                f"{self.dictproxy.name} worker {worker.num} (pid {pid}) "
+                f"exited with status {os.waitstatus_to_exitcode(status)}"
+            )
+            if time.monotonic() - worker.started < MIN_WORKER_LIFETIME:
+                worker.restart_delay = min(
+                    max(worker.restart_delay * 2, 1.0), MAX_RESTART_DELAY
+                )
+            else:
+                worker.restart_delay = 0.0
+            worker.restart_at = time.monotonic() + worker.restart_delay
+
+    def restart_workers(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.pid is None and worker.restart_at <= now:
+                with self.stats.lock:
+                    self.worker_restarts.inc()
+                self.start_worker(worker)
+
+    def update_num_workers(self):
+        num = sum(1 for worker in self.workers if worker.pid)
+        with self.stats.lock:
+            self.num_workers.set(num)
+
+    def create_stats_server(self):
+        supervisor = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                command = self.rfile.readline().strip().decode() or "metrics"
+                try:
+                    res = supervisor.handle_stats_command(command)
+                except Exception:
+                    logging.exception(f"stats command failed: {command!r}")
+                    res = "error\n"
+                self.wfile.write(res.encode())
+
+        path = get_stats_socket_path(self.socket)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        # served from the supervisor loop so that no thread runs when forking
+        server = UnixStreamServer(path, Handler)
+        server.timeout = self.poll_interval
+        return server
+
+    def handle_stats_command(self, command):
+        """Return the reply to a command received on the statistics socket.
+
+        ``metrics`` returns the merged metrics of all workers,
+        ``workers`` lists the worker processes
+        and other commands are passed to every worker.
+        """
+        if command == "workers":
+            now = time.monotonic()
+            lines = []
+            for worker in self.workers:
+                uptime = int(now - worker.started) if worker.pid else 0
+                lines.append(f"{worker.num} pid={worker.pid} uptime={uptime}s\n")
+            return "".join(lines)
+
+        replies = []
+        for worker in self.workers:
+            if not worker.pid:
+                continue
+            path = get_stats_socket_path(self.socket, worker.num)
+            try:
+                replies.append(query_stats_socket(path, command, timeout=5.0))
+            except OSError as e:
+                logging.warning(f"could not query worker {worker.num}: {e}")
+
+        if command == "metrics":
+            return merge_metrics([self.stats.render()] + replies)
+        return "".join(replies)
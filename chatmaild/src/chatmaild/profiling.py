@@ -0,0 +1,199 @@
+"""
+Live profiling and stack dumps of running dict proxies.
+
+A dict proxy can be profiled while it serves, without a restart
+and without external tools.  The profiler periodically samples the
+Python stacks of all threads of the process, including the threads
+sending push notifications, and counts identical stacks.
+It measures wall-clock time, so threads waiting for I/O
+or for work show up as well.
+
+Profiling is started and stopped with the statistics socket::
+
+    chatmail-dictstats --command profile-start /run/doveauth/doveauth-stats.socket
+    chatmail-dictstats --command profile-stop /run/doveauth/doveauth-stats.socket
+
+or by sending SIGUSR1 to the process, which toggles profiling.
+The ``stacks`` command or SIGUSR2 dump the current stack of every thread.
+
+Results are written next to the dict socket, e.g.
+``/run/doveauth/doveauth-1234-20250101-120000.folded``.
+Profiles use the "folded stacks" format with one line per distinct stack,
+which ``flamegraph.pl`` or speedscope can render directly.
+"""
+
+import logging
+import math
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+
+# seconds between two samples of all thread stacks
+DEFAULT_INTERVAL = 0.01
+
+# shorter intervals are raised to this to not busy a CPU with sampling
+MIN_INTERVAL = 0.001
+
+# maximum number of frames recorded per sampled stack
+MAX_STACK_DEPTH = 100
+
+
+def get_thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def format_frame(frame):
+    code = frame.f_code
+    filename = "/".join(Path(code.co_filename).parts[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def get_stack(frame):
+    """Return the frames of a stack as strings, outermost first."""
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(format_frame(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def dump_stacks():
+    """Return the current stacks of all threads of the process as text."""
+    names = get_thread_names()
+    lines = [f"stacks of process {os.getpid()} at {time.ctime()}\n"]
+    for ident, frame in sys._current_frames().items():
+        lines.append(f"\nthread {names.get(ident, ident)} ({ident}):\n")
+        lines.extend(traceback.format_stack(frame))
+    return "".join(lines)
+
+
+class SamplingProfiler:
+    """Sample the stacks of all other threads from a background thread."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = get_thread_names()
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    thread_name = str(names.get(ident, ident))
+                    self.stacks[(thread_name,) + get_stack(frame)] += 1
+            self.samples += 1
+
+    def format_folded(self):
+        """Return the sampled stacks in the folded stacks format."""
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+
+class Profiler:
+    """Start and stop profiling sessions of the current process
+    and write their results to files in ``directory``."""
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = Path(directory)
+        self.session = None
+        self.lock = threading.Lock()
+
+    def get_output_path(self, suffix):
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        return self.directory.joinpath(f"{self.name}-{os.getpid()}-{timestamp}{suffix}")
+
+    def start(self, interval=DEFAULT_INTERVAL):
+        with self.lock:
+            if self.session is not None:
+                return "profiling already running\n"
+            self.session = SamplingProfiler(interval)
+            self.session.start()
+        logging.info(f"started profiling {self.name} every {interval}s")
+        return "profiling started\n"
+
+    def stop(self):
+        with self.lock:
+            session, self.session = self.session, None
+        if session is None:
+            return "profiling not running\n"
+        session.stop()
+        path = self.get_output_path(".folded")
+        path.write_text(session.format_folded())
+        duration = time.monotonic() - session.started
+        res = f"wrote {session.samples} samples over {duration:.1f}s to {path}\n"
+        logging.info(res.strip())
+        return res
+
+    def toggle(self):
+        if self.session is None:
+            return self.start()
+        return self.stop()
+
+    def write_stacks(self):
+        path = self.get_output_path(".stacks")
+        path.write_text(dump_stacks())
+        logging.info(f"wrote stacks to {path}")
+        return f"wrote stacks to {path}\n"
+
+    def handle_command(self, command):
+        """Return the reply to a profiling command of the statistics socket.
+
+        ``profile-start [interval]`` starts profiling,
+        ``profile-stop`` stops it and writes the profile
+        and ``stacks`` writes the stacks of all threads.
+        """
+        name, _, arg = command.partition(" ")
+        if name == "profile-start":
+            try:
+                interval = float(arg) if arg else DEFAULT_INTERVAL
+            except ValueError:
+                return f"invalid interval: {arg!r}\n"
+            if not 0 < interval < math.inf:
+                return f"invalid interval: {arg!r}, must be positive\n"
+            return self.start(max(interval, MIN_INTERVAL))
+        if name == "profile-stop":
+            return self.stop()
+        if name == "stacks":
+            return self.write_stacks()
+        return f"unknown command: {command!r}\n"
+
+    def install_signal_handlers(self):
+        """Toggle profiling on SIGUSR1 and write stacks on SIGUSR2.
+
+        Does nothing unless called from the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        def handle_signal(signum, frame):
+            try:
+                if signum == signal.SIGUSR1:
+                    self.toggle()
+                else:
+                    self.write_stacks()
+            except OSError:
+                logging.exception("could not write profiling results")
+
+        signal.signal(signal.SIGUSR1, handle_signal)
+        signal.signal(signal.SIGUSR2, handle_signal)
@@ -0,0 +1,65 @@
+"""
+Coalescing of concurrent identical requests.
+
+When a client opens many connections at once, Dovecot sends bursts
+of identical lookups which dict proxies handle on separate threads.
+`SingleFlight` lets only the first of concurrent calls with the same key
+do the work while the others wait for it and share its result.
+Calls starting after the first one finished do the work again,
+so nothing is cached beyond the duration of one call.
+"""
+
+from threading import Event, Lock
+
+
+class Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run concurrent calls with equal keys only once."""
+
+    def __init__(self, stats=None):
+        self.lock = Lock()
+        self.calls = {}
+        self.stats = stats
+        if stats is not None:
+            self.shared = stats.counter(
+                "dictproxy_coalesced_requests_total",
+                "number of requests which shared the result of a concurrent request",
+            )
+            self.shared.inc(amount=0)
+
+    def do(self, key, func, *args):
+        """Return ``func(*args)`` or the result of a concurrent call
+        with the same ``key``, re-raising its exception if it failed."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            if self.stats is not None:
+                with self.stats.lock:
+                    self.shared.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,70 @@
+"""
+Microbenchmark comparing the bytes-level dict protocol parser
+with the previous str-based request parsing.
+
+    python -m chatmaild.tests.bench_dictparse
+
+"""
+
+import timeit
+
+from chatmaild.dictparse import parse_request, split_and_unescape
+
+REQUESTS = [
+    b'Lshared/passdb/qh3uoa6Zo\\\\Ahm9e\\"g/ai"ab3cd5efg@chat.example.org'
+    b"\tab3cd5efg@chat.example.org\n",
+    b'Lshared/passdb/Ahng9ahph6ohGh4wai6i"xk2m9pq1r@chat.example.org'
+    b"\txk2m9pq1r@chat.example.org\n",
+    b"Lshared/userdb/ab3cd5efg@chat.example.org\tab3cd5efg@chat.example.org\n",
+    b"Lpriv/43f5f508a7ea0366dff30200c15250e3/devicetoken\tab3cd5efg@chat.example.org\n",
+]
+
+
+def old_split_and_unescape(s):
+    out = ""
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == "\\":
+            i += 1
+            out += s[i]
+        elif c == '"':
+            yield out
+            out = ""
+        else:
+            out += c
+        i += 1
+    yield out
+
+
+def old_path(line):
+    msg = line.strip().decode()
+    parts = msg[1:].split("\t")
+    namespace, type, args = parts[0].split("/", 2)
+    if namespace == "shared":
+        return list(old_split_and_unescape(args))
+    return parts[1]
+
+
+def new_path(line):
+    command, parts = parse_request(line.strip())
+    namespace, type, args = parts[0].split("/", 2)
+    if namespace == "shared":
+        return split_and_unescape(args)
+    return parts[1]
+
+
+def main(number=100000):
+    for line in REQUESTS:
+        assert old_path(line) == new_path(line), line
+
+    for line in REQUESTS:
+        key = line.split(b"\t", 1)[0].decode()
+        print(key)
+        for func in (old_path, new_path):
+            t = timeit.timeit(lambda: func(line), number=number)
+            print(f"   {func.__name__:8} {t / number * 1e9:8.0f} ns/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import importlib.resources
+import io
 import itertools
 import os
 import random
@@ -95,3 +96,28 @@ def mockout():
             self.captured_plain.append(msg)
 
     return MockOut()
+
+
+class CountingWriter(io.BytesIO):
+    """Binary output file which counts its ``write`` calls."""
+
+    num_writes = 0
+
+    def write(self, data):
+        self.num_writes += 1
+        return super().write(data)
+
+
+@pytest.fixture
+def counting_writer():
+    return CountingWriter()
+
+
+def get_samples(text):
+    """Return the ``{name: value}`` dict of samples in a metrics ``text``."""
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            key, value = line.rsplit(" ", 1)
+            samples[key] = float(value)
+    return samples
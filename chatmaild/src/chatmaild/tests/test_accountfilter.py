@@ -0,0 +1,180 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from chatmaild.accountfilter import AccountFilter, BloomFilter
+from chatmaild.dictstats import Stats
+from chatmaild.doveauth import AuthDictProxy
+
+
+def settle(path):
+    """Move the modification time of ``path`` into the past."""
+    past = time.time() - 10 - len(os.listdir(path))
+    os.utime(path, (past, past))
+
+
+@pytest.fixture
+def mailboxes_dir(example_config):
+    example_config.mailboxes_dir.mkdir(parents=True, exist_ok=True)
+    settle(example_config.mailboxes_dir)
+    return example_config.mailboxes_dir
+
+
+def build(account_filter):
+    account_filter.maybe_rebuild(account_filter.get_version())
+    account_filter.build_thread.join()
+
+
+def create_account(config, addr):
+    config.get_user(addr).set_password("{SHA512-CRYPT}xyz")
+    settle(config.mailboxes_dir)
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    items = [f"user{i}@example.org" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(f"other{i}@example.org" in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_filter_answers_missing(example_config, mailboxes_dir):
+    create_account(example_config, "existing@chat.example.org")
+    stats = Stats()
+    account_filter = AccountFilter(mailboxes_dir, stats=stats)
+    version = account_filter.get_version()
+    account_filter.is_missing("existing@chat.example.org", version)
+    account_filter.build_thread.join()
+    assert not account_filter.is_missing("existing@chat.example.org", version)
+    assert account_filter.is_missing("missing@chat.example.org", version)
+    assert "doveauth_missing_account_lookups_total 1" in stats.render()
+    assert "doveauth_account_filter_builds_total 1" in stats.render()
+
+
+def test_stale_filter_is_not_used(example_config, mailboxes_dir):
+    account_filter = AccountFilter(mailboxes_dir)
+    build(account_filter)
+    assert account_filter.is_missing(
+        "new@chat.example.org", account_filter.get_version()
+    )
+
+    # created by another process
+    create_account(example_config, "new@chat.example.org")
+    version = account_filter.get_version()
+    assert not account_filter.is_missing("new@chat.example.org", version)
+    assert not account_filter.is_missing("other@chat.example.org", version)
+
+    account_filter.last_build -= account_filter.rebuild_interval
+    account_filter.is_missing("other@chat.example.org", version)
+    account_filter.build_thread.join()
+    assert account_filter.is_missing("other@chat.example.org", version)
+    assert not account_filter.is_missing("new@chat.example.org", version)
+
+
+def test_recently_changed_dir_is_not_trusted(example_config, mailboxes_dir):
+    example_config.get_user("new@chat.example.org").set_password("x")
+    account_filter = AccountFilter(mailboxes_dir)
+    assert account_filter.get_version() is None
+    assert not account_filter.is_missing("other@chat.example.org", None)
+
+
+def test_lookups_do_not_wait_for_build(mailboxes_dir, monkeypatch):
+    account_filter = AccountFilter(mailboxes_dir)
+    release = threading.Event()
+    real_scandir = os.scandir
+
+    def slow_scandir(path):
+        release.wait()
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", slow_scandir)
+    version = account_filter.get_version()
+    assert not account_filter.is_missing("x@chat.example.org", version)
+    build_thread = account_filter.build_thread
+    assert build_thread.is_alive()
+    # no second build is started while the first one runs
+    account_filter.last_build -= account_filter.rebuild_interval
+    assert not account_filter.is_missing("x@chat.example.org", version)
+    assert account_filter.build_thread is build_thread
+    release.set()
+    build_thread.join()
+    assert account_filter.is_missing("x@chat.example.org", version)
+
+
+def test_negative_cache(mailboxes_dir):
+    class Clock:
+        now = 100.0
+
+        def __call__(self):
+            return self.now
+
+    clock = Clock()
+    account_filter = AccountFilter(mailboxes_dir, negative_ttl=5, clock=clock)
+    # do not build the filter
+    account_filter.last_build = clock.now
+    version = account_filter.get_version()
+    assert not account_filter.is_missing("x@chat.example.org", version)
+
+    account_filter.record_missing("x@chat.example.org", version)
+    assert account_filter.is_missing("x@chat.example.org", version)
+    assert not account_filter.is_missing("x@chat.example.org", version + 1)
+    clock.now += 6
+    assert not account_filter.is_missing("x@chat.example.org", version)
+
+
+def test_doveauth_skips_missing_accounts(example_config, mailboxes_dir, monkeypatch):
+    example_config.public_create_enabled = True
+    example_config.doveauth_account_filter = True
+    create_account(example_config, "existing@chat.example.org")
+    dictproxy = AuthDictProxy(config=example_config)
+
+    def fail(path):
+        raise AssertionError(f"read {path}")
+
+    reply = dictproxy.handle_lookup(["shared/userdb/missing@chat.example.org"])
+    assert reply == "N\n"
+    dictproxy.account_filter.build_thread.join()
+    with monkeypatch.context() as m:
+        m.setattr("chatmaild.userdbcache.get_validator", fail)
+        reply = dictproxy.handle_lookup(["shared/userdb/missing@chat.example.org"])
+        assert reply == "N\n"
+        reply = dictproxy.handle_lookup(
+            ['shared/passdb/short"missing@chat.example.org']
+        )
+        assert reply == "N\n"
+
+    # account creation still works and is visible right away
+    password = "q9mr3faue8ahkeeh"
+    reply = dictproxy.handle_lookup(
+        [f'shared/passdb/{password}"missing@chat.example.org']
+    )
+    assert reply.startswith("O")
+    assert dictproxy.lookup_userdb("missing@chat.example.org")
+
+
+def test_doveauth_builds_filter_on_start(example_config, mailboxes_dir):
+    example_config.doveauth_account_filter = True
+    create_account(example_config, "existing@chat.example.org")
+    dictproxy = AuthDictProxy(config=example_config)
+    account_filter = dictproxy.account_filter
+    assert account_filter.build_thread is None
+
+    dictproxy.init_worker(0)
+    account_filter.build_thread.join()
+    version = account_filter.get_version()
+    assert account_filter.filter[1] == version
+    assert account_filter.is_missing("missing@chat.example.org", version)
+
+
+def test_doveauth_sees_deleted_accounts(example_config, mailboxes_dir):
+    example_config.doveauth_account_filter = True
+    create_account(example_config, "existing@chat.example.org")
+    dictproxy = AuthDictProxy(config=example_config)
+    assert dictproxy.lookup_userdb("existing@chat.example.org")
+    shutil.rmtree(example_config.get_user("existing@chat.example.org").maildir)
+    assert not dictproxy.lookup_userdb("existing@chat.example.org")
@@ -0,0 +1,171 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from chatmaild.accountindex import AccountIndex
+from chatmaild.accountindex import main as account_index_main
+from chatmaild.admin_accounts_helper import list_accounts
+from chatmaild.admin_delete_helper import delete_admin_account
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import main as expiry_main
+from chatmaild.metrics import main as metrics_main
+
+
+@pytest.fixture
+def config(make_config):
+    return make_config("chat.example.org", settings=dict(account_index="true"))
+
+
+@pytest.fixture
+def index(config):
+    return config.account_index
+
+
+def create_account(config, addr, last_login=None):
+    user = config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    if last_login is not None:
+        user.set_last_login_timestamp(last_login)
+    return user
+
+
+def test_index_is_disabled_by_default(example_config):
+    assert example_config.account_index is None
+    assert example_config.get_user("a@chat.example.org").account_index is None
+
+
+def test_write_paths_update_index(config, index):
+    assert index.path.parent == config.mailboxes_dir.parent
+    user = create_account(config, "a@chat.example.org")
+    account = index.get("a@chat.example.org")
+    assert account.created > 0
+    assert account.last_login is None
+
+    user.set_last_login_timestamp(86400 * 3 + 100)
+    assert index.get("a@chat.example.org").last_login == 86400 * 3
+
+    # setting a new password keeps the creation time
+    user.set_password("{SHA512-CRYPT}abc")
+    assert index.get("a@chat.example.org").created == account.created
+
+    index.remove("a@chat.example.org")
+    assert index.get("a@chat.example.org") is None
+
+
+def test_failing_updates_are_logged(config, index, caplog):
+    index.path.mkdir()
+    create_account(config, "a@chat.example.org")
+    assert config.get_user("a@chat.example.org").get_userdb_dict()
+    assert "could not update account index" in caplog.text
+
+
+def test_iter_addresses_pages(config, index):
+    addresses = [f"user{i}@chat.example.org" for i in range(7)]
+    for addr in reversed(addresses):
+        index.add(addr, created=0)
+    assert list(index.iter_addresses(page_size=3)) == addresses
+    assert list(index.iter_addresses(page_size=7)) == addresses
+
+
+def test_connections_are_per_thread(index):
+    index.add("a@chat.example.org", created=0)
+    conns = [index.get_connection()]
+    thread = threading.Thread(target=lambda: conns.append(index.get_connection()))
+    thread.start()
+    thread.join()
+    assert conns[0] is not conns[1]
+    assert index.get_connection() is conns[0]
+
+
+def test_count(index):
+    for addr in ("ci-1@x.org", "ac_2@x.org", "user@x.org", "ci-3@x.org"):
+        index.add(addr, created=0)
+    assert index.count() == 4
+    assert index.count(prefixes=("ci-", "ac_")) == 3
+
+
+def test_reconcile(config, index):
+    create_account(config, "kept@chat.example.org", last_login=86400)
+    create_account(config, "deleted@chat.example.org")
+    config.mailboxes_dir.joinpath("nopw@chat.example.org").mkdir()
+
+    # changed without updating the index
+    shutil.rmtree(config.get_user("deleted@chat.example.org").maildir)
+    unindexed = AccountIndex(index.path.with_name("other.sqlite"))
+    user = config.get_user("new@chat.example.org")
+    user.account_index = unindexed
+    user.set_password("{SHA512-CRYPT}xyz")
+    password_path = config.get_user("kept@chat.example.org").password_path
+    os.utime(password_path, (86400 * 2, 86400 * 2))
+
+    assert index.reconcile(config) == (1, 1, 1)
+    assert list(index.iter_addresses()) == [
+        "kept@chat.example.org",
+        "new@chat.example.org",
+    ]
+    assert index.get("kept@chat.example.org").last_login == 86400 * 2
+    assert index.reconcile(config) == (0, 0, 0)
+
+
+def test_reconcile_command(config, index, capsys):
+    create_account(config, "a@chat.example.org")
+    index.remove("a@chat.example.org")
+    account_index_main([str(config._inipath), "reconcile"])
+    out, _ = capsys.readouterr()
+    assert out.startswith("added 1, removed 0 and updated 0 accounts")
+    account_index_main([str(config._inipath), "count"])
+    out, _ = capsys.readouterr()
+    assert out == "1\n"
+
+
+def test_readers_use_index(config, index, capsys):
+    config.public_create_enabled = True
+    create_account(config, "a@chat.example.org", last_login=86400)
+    create_account(config, "ci-b@chat.example.org")
+    # not yet picked up by reconcile
+    config.mailboxes_dir.joinpath("unindexed@chat.example.org").mkdir()
+
+    assert list(AuthDictProxy(config=config).iter_userdb()) == [
+        "a@chat.example.org",
+        "ci-b@chat.example.org",
+    ]
+    accounts = list_accounts(config)
+    assert [a["email"] for a in accounts] == [
+        "a@chat.example.org",
+        "ci-b@chat.example.org",
+    ]
+    assert accounts[0]["last_login"] == 86400
+    assert list_accounts(config, limit=1) == accounts[:1]
+    index.add("0stray@other.org", 0)
+    index.add("stray@chat.example.org.other.org", 0)
+    assert list_accounts(config) == accounts
+    assert list_accounts(config, limit=1) == accounts[:1]
+    index.remove("0stray@other.org")
+    index.remove("stray@chat.example.org.other.org")
+
+    metrics_main(config.mailboxes_dir, index.path)
+    out, _ = capsys.readouterr()
+    assert "\naccounts 2\n" in out
+    assert "\nci_accounts 1\n" in out
+
+
+def test_admin_delete_updates_index(config, index):
+    create_account(config, "a@chat.example.org")
+    status, _ = delete_admin_account(config, "a@chat.example.org")
+    assert status == 200
+    assert index.get("a@chat.example.org") is None
+
+
+def test_expire_updates_index(config, index, capsys):
+    create_account(config, "old@chat.example.org", last_login=86400)
+    user = create_account(config, "active@chat.example.org")
+    user.maildir.joinpath("cur").mkdir()
+    user.maildir.joinpath("cur", "msg1").write_text("x" * 100)
+
+    expiry_main([str(config._inipath), "--remove"])
+    assert not config.get_user("old@chat.example.org").maildir.exists()
+    assert list(index.iter_addresses()) == ["active@chat.example.org"]
+    account = index.get("active@chat.example.org")
+    assert (account.messages, account.size) == (1, 100)
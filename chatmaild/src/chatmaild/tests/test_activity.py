@@ -0,0 +1,152 @@
+import io
+import time
+
+import pytest
+
+from chatmaild.activity import ActivityLog, get_day_name
+from chatmaild.activity import main as activity_main
+from chatmaild.admin_delete_helper import delete_admin_account
+from chatmaild.expire import main as expiry_main
+from chatmaild.lastlogin import LastLoginDictProxy
+
+DAY = 86400
+
+
+@pytest.fixture
+def config(make_config):
+    return make_config("chat.example.org", settings=dict(activity_log="true"))
+
+
+@pytest.fixture
+def log(config):
+    return config.activity_log
+
+
+def login(dictproxy, addr, timestamp):
+    requests = f"B1\t{addr}\nS1\tshared/last-login/{addr}\t{timestamp}\nC1\n"
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(requests.encode()), wfile)
+    assert wfile.getvalue() == b"O\n"
+
+
+def create_account(config, addr):
+    user = config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    return user
+
+
+def test_activity_log_is_disabled_by_default(example_config):
+    assert example_config.activity_log is None
+
+
+def test_record_bitmaps(tmp_path):
+    log = ActivityLog(tmp_path.joinpath("activity"))
+    log.record({"a@x.org": 10 * DAY, "b@x.org": 10 * DAY + 5})
+    log.record({"b@x.org": 11 * DAY, "c@x.org": 11 * DAY})
+    assert log.accounts_path.read_text() == "a@x.org\nb@x.org\nc@x.org\n"
+    assert log.read_bitmap(10 * DAY) == 0b011
+    assert log.read_bitmap(11 * DAY) == 0b110
+    assert log.read_bitmap(10 * DAY, "new") == 0b011
+    assert log.read_bitmap(11 * DAY, "new") == 0b100
+    assert log.get_bitmap_path(10 * DAY, "active").name == "1970-01-11.active"
+
+    # numbers are stable across processes
+    other = ActivityLog(log.directory)
+    other.record({"d@x.org": 12 * DAY, "a@x.org": 12 * DAY})
+    log.record({"d@x.org": 12 * DAY})
+    assert log.read_bitmap(12 * DAY) == 0b1001
+
+
+def test_many_accounts(tmp_path):
+    log = ActivityLog(tmp_path)
+    log.record({f"user{i}@x.org": DAY for i in range(1000)})
+    log.record({f"user{i}@x.org": 2 * DAY for i in range(0, 1000, 3)})
+    assert log.get_bitmap_path(DAY, "active").stat().st_size == 125
+    assert log.count_active(2 * DAY, 1) == 334
+    assert log.count_active(2 * DAY + 100, 2) == 1000
+    assert log.get_retention(DAY, 2) == [1000, 334, 0]
+
+
+def test_forget(tmp_path):
+    log = ActivityLog(tmp_path)
+    log.record({"a@x.org": DAY, "ab@x.org": DAY, "b@x.org": DAY})
+    log.forget("b@x.org")
+    log.forget("unknown@x.org")
+    assert log.accounts_path.read_text() == "a@x.org\nab@x.org\n       \n"
+
+    log.record({"b@x.org": 2 * DAY})
+    assert log.read_bitmap(2 * DAY) == 0b1000
+    assert ActivityLog(tmp_path).count_active(2 * DAY, 2) == 4
+
+
+def test_forget_in_other_process(tmp_path):
+    log = ActivityLog(tmp_path)
+    log.record({"a@x.org": DAY, "b@x.org": DAY})
+    other = ActivityLog(tmp_path)
+    other.forget("a@x.org")
+
+    # "a@x.org" was deleted and re-created meanwhile
+    log.record({"a@x.org": 2 * DAY})
+    assert log.accounts_path.read_text() == "       \nb@x.org\na@x.org\n"
+    assert log.read_bitmap(2 * DAY) == 0b100
+    other.record({"a@x.org": 2 * DAY, "b@x.org": 2 * DAY})
+    assert log.read_bitmap(2 * DAY) == 0b110
+    assert log.read_bitmap(2 * DAY, "new") == 0b100
+
+
+def test_prune(tmp_path):
+    log = ActivityLog(tmp_path)
+    for day in range(1, 6):
+        log.record({"a@x.org": day * DAY})
+    tmp_path.joinpath("notes.txt").write_text("")
+    assert log.prune(5 * DAY, keep_days=2) == 3
+    assert log.count_active(5 * DAY, 5) == 1
+    assert log.read_bitmap(3 * DAY) == 1
+    assert log.read_bitmap(2 * DAY) == 0
+
+
+def test_lastlogin_records_activity(config, log):
+    user = create_account(config, "a@chat.example.org")
+    dictproxy = LastLoginDictProxy(config=config)
+    login(dictproxy, "a@chat.example.org", 20 * DAY)
+    login(dictproxy, "a@chat.example.org", 20 * DAY + 100)
+    login(dictproxy, "missing@chat.example.org", 20 * DAY)
+    assert user.get_last_login_timestamp() == 20 * DAY
+    assert log.accounts_path.read_text() == "a@chat.example.org\n"
+    assert log.count_active(20 * DAY, 1) == 1
+
+
+def test_delete_forgets_activity(config, log):
+    create_account(config, "a@chat.example.org")
+    create_account(config, "b@chat.example.org").set_last_login_timestamp(DAY)
+    log.record({"a@chat.example.org": DAY, "b@chat.example.org": DAY})
+
+    status, _ = delete_admin_account(config, "a@chat.example.org")
+    assert status == 200
+    expiry_main([str(config._inipath), "--remove"])
+    assert log.accounts_path.read_text().strip() == ""
+    # older than activity_log_days
+    assert log.read_bitmap(DAY) == 0
+
+
+def test_activity_command(config, log, capsys):
+    now = time.time()
+    log.record({"a@chat.example.org": now - 3 * DAY, "b@chat.example.org": now})
+    log.record({"a@chat.example.org": now - DAY})
+
+    activity_main([str(config._inipath), "active", "--days", "1", "7"])
+    out, _ = capsys.readouterr()
+    assert out == "active in last 1 days: 1\nactive in last 7 days: 2\n"
+
+    start = get_day_name(now - 3 * DAY)
+    activity_main([str(config._inipath), "retention", "--start", start, "--days", "2"])
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == [
+        f"{start}: 1 new accounts",
+        "day 1: 0 (0.0%)",
+        "day 2: 1 (100.0%)",
+    ]
+
+    activity_main([str(config._inipath), "prune", "--days", "2"])
+    out, _ = capsys.readouterr()
+    assert out == "removed 2 bitmaps\n"
@@ -89,3 +89,16 @@ def test_config_userstate_paths(make_config, tmp_path):
 def test_config_max_message_size(make_config, tmp_path):
     config = make_config("something.testrun.org", dict(max_message_size="10000"))
     assert config.max_message_size == 10000
+
+
+def test_config_dictproxy_engine(make_config):
+    config = make_config("chat.example.org")
+    assert config.dictproxy_engine == "threads"
+    assert config.dictproxy_executor_threads == 16
+    assert config.dictproxy_workers == 1
+
+    config = make_config("chat.example.org", dict(dictproxy_engine="asyncio"))
+    assert config.dictproxy_engine == "asyncio"
+
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", dict(dictproxy_engine="fibers"))
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from chatmaild.dictbench import main, parse_mix, percentile, run_benchmark
+
+
+def test_parse_mix():
+    assert parse_mix("passdb=4,userdb,metadata=0") == dict(passdb=4.0, userdb=1.0)
+    with pytest.raises(ValueError):
+        parse_mix("passdb=1,unknown=2")
+    with pytest.raises(ValueError):
+        parse_mix("passdb=0")
+
+
+def test_percentile():
+    values = [i / 1000 for i in range(1000)]
+    assert percentile(values, 0.5) == 0.5
+    assert percentile(values, 0.999) == 0.999
+    assert percentile([], 0.5) == 0.0
+
+
+def test_run_benchmark_all_operations():
+    mix = parse_mix("passdb,create,userdb,iterate,lastlogin,metadata")
+    report = run_benchmark(mix, num_clients=4, num_requests=200, num_accounts=5)
+    assert report["errors"] == 0
+    assert report["requests"] == 200
+    assert set(report["operations"]) <= set(mix)
+    assert report["throughput_rps"] > 0
+    latency = report["latency"]
+    assert latency["p50_ms"] <= latency["p99_ms"] <= latency["p999_ms"]
+
+
+def test_main_prints_json(capsys):
+    main(["--mix", "userdb", "--requests", "50", "--clients", "2", "--accounts", "2"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["operations"]["userdb"]["count"] == 50
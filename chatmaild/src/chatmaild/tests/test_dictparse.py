@@ -0,0 +1,62 @@
+import pytest
+
+from chatmaild.dictparse import parse_request, split_and_unescape
+
+
+def test_parse_request():
+    command, parts = parse_request(
+        b"Lshared/userdb/user@chat.example.org\tuser@chat.example.org"
+    )
+    assert command == "L"
+    assert len(parts) == 2
+    assert parts[0] == "shared/userdb/user@chat.example.org"
+    assert parts[-1] == "user@chat.example.org"
+    assert parts[1:] == ["user@chat.example.org"]
+    assert parts == ["shared/userdb/user@chat.example.org", "user@chat.example.org"]
+
+
+def test_parse_request_memoryview():
+    command, parts = parse_request(memoryview(b"C1"))
+    assert command == "C"
+    assert list(parts) == ["1"]
+
+
+def test_parse_request_decodes_lazily():
+    command, parts = parse_request(b"S1\tpriv/x/devicetoken\t\xff")
+    assert parts[1] == "priv/x/devicetoken"
+    with pytest.raises(UnicodeDecodeError):
+        parts[2]
+
+
+@pytest.mark.parametrize(
+    ("s", "expected"),
+    [
+        ("", [""]),
+        ("pass", ["pass"]),
+        ('pass"user@x.org', ["pass", "user@x.org"]),
+        ('p\\"a\\\\ss"user@x.org', ['p"a\\ss', "user@x.org"]),
+        ("a\\'b/c", ["a'b/c"]),
+        ('"', ["", ""]),
+        ('\\""', ['"', ""]),
+    ],
+)
+def test_split_and_unescape(s, expected):
+    assert split_and_unescape(s) == expected
+
+
+def test_split_and_unescape_dangling_escape():
+    with pytest.raises(ValueError):
+        split_and_unescape('pass"user\\')
+
+
+def test_parse_request_indexing():
+    command, parts = parse_request(b"B1\tuser@chat.example.org")
+    assert command == "B"
+    assert parts[0] == "1"
+    assert parts[-2] == "1"
+    assert parts[:1] == ["1"]
+    assert parts[::-1] == ["user@chat.example.org", "1"]
+    with pytest.raises(IndexError):
+        parts[2]
+    with pytest.raises(IndexError):
+        parts[-3]
@@ -0,0 +1,433 @@
+import asyncio
+import io
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chatmaild.dictproxy import DictProxy, create_listening_socket, get_systemd_socket
+from chatmaild.dictstats import query_stats_socket
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.lastlogin import LastLoginDictProxy
+from chatmaild.prefork import Supervisor
+from chatmaild.tests.plugin import get_samples
+
+
+class EchoDictProxy(DictProxy):
+    def handle_lookup(self, parts):
+        return f"O{parts[0]}\n"
+
+
+def run_async_clients(dictproxy, socket, requests, num_clients=1):
+    async def client():
+        reader, writer = await asyncio.open_unix_connection(str(socket))
+        writer.write(requests)
+        await writer.drain()
+        writer.write_eof()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def main():
+        server = await dictproxy.start_async_server(str(socket), executor)
+        async with server:
+            return await asyncio.gather(*[client() for _ in range(num_clients)])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        return asyncio.run(main())
+
+
+def test_async_lookup(tmp_path):
+    socket = tmp_path.joinpath("echo.socket")
+    res = run_async_clients(
+        EchoDictProxy(), socket, b"H3\t2\t0\t\techo\nLkey1\nLkey2\n"
+    )
+    assert res == [b"Okey1\nOkey2\n"]
+
+
+def test_async_close_keeps_socket_path(tmp_path):
+    socket = tmp_path.joinpath("echo.socket")
+    listen_sock = create_listening_socket(socket)
+    inode = os.stat(socket).st_ino
+
+    async def main():
+        server = await EchoDictProxy().start_async_server(
+            str(socket), executor, listen_sock
+        )
+        server.close()
+        await server.wait_closed()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(main())
+    assert os.stat(socket).st_ino == inode
+
+
+def test_async_many_connections(tmp_path):
+    socket = tmp_path.joinpath("echo.socket")
+    res = run_async_clients(EchoDictProxy(), socket, b"Lkey\n", num_clients=300)
+    assert res == [b"Okey\n"] * 300
+
+
+def test_async_last_login_transaction(tmp_path, example_config, testaddr):
+    user = example_config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    socket = tmp_path.joinpath("lastlogin.socket")
+    dictproxy = LastLoginDictProxy(config=example_config)
+    requests = f"B1\t{testaddr}\nS1\tshared/last-login/{testaddr}\t86400\nC1\n".encode()
+    res = run_async_clients(dictproxy, socket, requests)
+    assert res == [b"O\n"]
+    assert user.get_last_login_timestamp() == 86400
+
+
+def test_pipelined_requests_coalesce_writes(counting_writer):
+    dictproxy = EchoDictProxy()
+    rfile = io.BytesIO(b"H3\t2\t0\t\techo\nLkey1\nLkey2\nLkey3\n")
+    wfile = counting_writer
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"Okey1\nOkey2\nOkey3\n"
+    assert wfile.num_writes == 1
+    samples = get_samples(dictproxy.stats.render())
+    assert samples['dictproxy_batch_size_bucket{proxy="dictproxy",le="2"}'] == 0
+    assert samples['dictproxy_batch_size_bucket{proxy="dictproxy",le="4"}'] == 1
+
+
+def test_partial_lines_are_joined(counting_writer):
+    dictproxy = EchoDictProxy()
+
+    class ChunkedReader:
+        chunks = [b"Lke", b"y1\nLkey2\nL", b"key3\n", b""]
+
+        def read1(self, size):
+            return self.chunks.pop(0)
+
+    wfile = counting_writer
+    dictproxy.loop_forever(ChunkedReader(), wfile)
+    assert wfile.getvalue() == b"Okey1\nOkey2\nOkey3\n"
+    assert wfile.num_writes == 2
+    samples = get_samples(dictproxy.stats.render())
+    assert samples['dictproxy_batch_size_bucket{proxy="dictproxy",le="1"}'] == 1
+    assert samples['dictproxy_batch_size_bucket{proxy="dictproxy",le="2"}'] == 2
+
+
+def test_empty_line_ends_connection():
+    dictproxy = EchoDictProxy()
+    rfile = io.BytesIO(b"Lkey1\n\nLkey2\n")
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"Okey1\n"
+
+
+class BlockingDictProxy(DictProxy):
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def handle_lookup(self, parts):
+        self.entered.set()
+        self.release.wait()
+        return "O\n"
+
+
+def test_queue_deadline_rejects_with_failure():
+    dictproxy = BlockingDictProxy()
+    dictproxy.set_limits(max_inflight=1, queue_deadline=0.05)
+
+    first = threading.Thread(
+        target=dictproxy.loop_forever, args=(io.BytesIO(b"Lkey\n"), io.BytesIO())
+    )
+    first.start()
+    dictproxy.entered.wait()
+
+    wfile = io.BytesIO()
+    requests = b"Lkey\nB1\tuser\nS1\tkey\tvalue\nC1\nI1\t0\tshared/\n"
+    dictproxy.loop_forever(io.BytesIO(requests), wfile)
+    assert wfile.getvalue() == b"F\nF\nF\n"
+
+    dictproxy.release.set()
+    first.join()
+
+    samples = get_samples(dictproxy.stats.render())
+    assert samples['dictproxy_rejected_requests_total{proxy="dictproxy"}'] == 5
+    assert samples['dictproxy_queue_wait_seconds_count{proxy="dictproxy"}'] == 6
+
+
+class RecordingDictProxy(DictProxy):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def handle_set_batch(self, addr, sets):
+        if any(parts[1] == "fail" for parts in sets):
+            raise ValueError("cannot apply")
+        self.batches.append((addr, [list(parts) for parts in sets]))
+        return True
+
+
+def test_transaction_sets_are_applied_on_commit():
+    dictproxy = RecordingDictProxy()
+    requests = (
+        b"B1\tuser\nS1\tkey1\tvalue1\nB2\tother\nS2\tkey\tx\nS1\tkey2\tvalue2\nR2\nC1\n"
+    )
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(requests), wfile)
+    assert wfile.getvalue() == b"O\n"
+    assert dictproxy.batches == [
+        ("user", [["1", "key1", "value1"], ["1", "key2", "value2"]])
+    ]
+
+
+def test_transaction_fails_if_commit_raises():
+    dictproxy = RecordingDictProxy()
+    requests = b"B1\tuser\nS1\tkey\tvalue\nS1\tfail\nC1\nB2\tuser\nC2\n"
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(requests), wfile)
+    assert wfile.getvalue() == b"F\nO\n"
+    assert not dictproxy.batches
+
+
+def test_last_login_transaction_writes_once(example_config, testaddr, monkeypatch):
+    user = example_config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    utimes = []
+    monkeypatch.setattr(os, "utime", lambda *args: utimes.append(args))
+
+    dictproxy = LastLoginDictProxy(config=example_config)
+    requests = (
+        f"B1\t{testaddr}\n"
+        f"S1\tshared/last-login/{testaddr}\t86400\n"
+        f"S1\tshared/last-login/{testaddr}\t{3 * 86400}\n"
+        "C1\n"
+    )
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(requests.encode()), wfile)
+    assert wfile.getvalue() == b"O\n"
+    assert utimes == [(user.password_path, (3 * 86400, 3 * 86400))]
+
+
+def test_max_inflight_admits_after_release():
+    dictproxy = EchoDictProxy()
+    dictproxy.set_limits(max_inflight=1, queue_deadline=1)
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(b"Lkey1\nLkey2\n"), wfile)
+    assert wfile.getvalue() == b"Okey1\nOkey2\n"
+
+
+def test_max_connections(tmp_path):
+    dictproxy = EchoDictProxy()
+    dictproxy.set_limits(max_connections=1)
+    assert dictproxy.accept_connection()
+    dictproxy._add_connection(1)
+    assert not dictproxy.accept_connection()
+    dictproxy._add_connection(-1)
+    assert dictproxy.accept_connection()
+    samples = get_samples(dictproxy.stats.render())
+    assert samples['dictproxy_rejected_connections_total{proxy="dictproxy"}'] == 1
+
+
+class SlowStartDictProxy(BlockingDictProxy):
+    def loop_forever(self, rfile, wfile, counted=False):
+        # handler threads may start long after their connection was accepted
+        time.sleep(0.1)
+        super().loop_forever(rfile, wfile, counted=counted)
+
+
+def test_max_connections_burst(tmp_path):
+    dictproxy = SlowStartDictProxy()
+    dictproxy.set_limits(max_connections=2)
+    dict_socket = tmp_path.joinpath("dict.socket")
+    listen_sock = create_listening_socket(dict_socket)
+
+    # all connections are queued before the server accepts the first one
+    clients = []
+    for _ in range(5):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(dict_socket))
+        sock.sendall(b"Lkey\n")
+        sock.shutdown(socket.SHUT_WR)
+        clients.append(sock)
+
+    def get_rejected():
+        samples = get_samples(dictproxy.stats.render())
+        return samples['dictproxy_rejected_connections_total{proxy="dictproxy"}']
+
+    responses = []
+
+    def run_clients():
+        try:
+            wait_for(lambda: get_rejected() == 3)
+            dictproxy.release.set()
+            for sock in clients:
+                with sock, sock.makefile("rb") as reader:
+                    try:
+                        responses.append(reader.read())
+                    except ConnectionResetError:
+                        # closed by the server without reading the request
+                        responses.append(b"")
+        finally:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    old_handler = signal.getsignal(signal.SIGTERM)
+    thread = threading.Thread(target=run_clients)
+    thread.start()
+    try:
+        dictproxy.serve_forever_from_socket(dict_socket, listen_sock=listen_sock)
+    finally:
+        signal.signal(signal.SIGTERM, old_handler)
+        thread.join()
+    assert sorted(responses) == [b"", b"", b"", b"O\n", b"O\n"]
+    assert get_rejected() == 3
+    assert dictproxy.get_num_connections() == 0
+
+
+def wait_for(func, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            res = func()
+        except OSError:
+            res = None
+        if res:
+            return res
+        assert time.monotonic() < deadline, "timeout"
+        time.sleep(0.05)
+
+
+def query_dict_socket(path, requests):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        sock.sendall(requests)
+        sock.shutdown(socket.SHUT_WR)
+        return sock.makefile("rb").read()
+
+
+def test_prefork_workers(tmp_path, example_config, testaddr):
+    user = example_config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    dict_socket = tmp_path.joinpath("lastlogin.socket")
+    stats_socket = tmp_path.joinpath("lastlogin-stats.socket")
+    args = [str(dict_socket), str(example_config._inipath), "--workers", "2"]
+    code = "from chatmaild.lastlogin import main; main()"
+    proc = subprocess.Popen([sys.executable, "-c", code, *args])
+    try:
+
+        def get_worker_pids():
+            lines = query_stats_socket(stats_socket, "workers").splitlines()
+            pids = [line.split()[1].split("=")[1] for line in lines]
+            if "None" not in pids:
+                return [int(pid) for pid in pids]
+
+        pids = wait_for(get_worker_pids)
+        assert len(set(pids)) == 2
+
+        requests = f"B1\t{testaddr}\nS1\tshared/last-login/{testaddr}\t86400\nC1\n"
+        for _ in range(4):
+            assert query_dict_socket(dict_socket, requests.encode()) == b"O\n"
+        assert user.get_last_login_timestamp() == 86400
+
+        samples = get_samples(query_stats_socket(stats_socket))
+        assert samples['dictproxy_requests_total{proxy="lastlogin",command="C"}'] == 4
+        assert samples['dictproxy_workers{proxy="lastlogin"}'] == 2
+
+        os.kill(pids[0], signal.SIGKILL)
+        restarted = wait_for(lambda: (get_worker_pids() or pids)[0] != pids[0])
+        assert restarted
+        samples = get_samples(query_stats_socket(stats_socket))
+        assert samples['dictproxy_worker_restarts_total{proxy="lastlogin"}'] == 1
+        assert query_dict_socket(dict_socket, requests.encode()) == b"O\n"
+    finally:
+        proc.terminate()
+        assert proc.wait(timeout=10) == 0
+
+
+def test_prefork_restarted_worker_is_not_first_start(tmp_path, monkeypatch):
+    supervisor = Supervisor(EchoDictProxy(), tmp_path.joinpath("x.socket"), None, 2)
+    pids = iter([1001, 1002])
+    monkeypatch.setattr(os, "fork", lambda: next(pids))
+    worker = supervisor.workers[0]
+    assert worker.first_start
+    supervisor.start_worker(worker)
+    assert worker.pid == 1001
+    assert not worker.first_start
+    supervisor.start_worker(worker)
+    assert worker.pid == 1002
+    assert not worker.first_start
+
+
+def test_drain_answers_received_requests():
+    dictproxy = BlockingDictProxy()
+    server_sock, client_sock = socket.socketpair()
+
+    def serve():
+        dictproxy.track_connection(server_sock)
+        with server_sock, server_sock.makefile("rb") as rfile:
+            with server_sock.makefile("wb") as wfile:
+                dictproxy.loop_forever(rfile, wfile)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    client_sock.sendall(b"Lkey1\nLkey2\n")
+    dictproxy.entered.wait()
+    dictproxy.drain()
+    dictproxy.release.set()
+    with client_sock, client_sock.makefile("rb") as reader:
+        assert reader.read() == b"O\nO\n"
+    thread.join()
+    assert not dictproxy.accept_connection()
+
+
+def test_get_systemd_socket_ignores_other_pid(monkeypatch, tmp_path):
+    monkeypatch.setenv("LISTEN_PID", str(os.getpid() + 1))
+    monkeypatch.setenv("LISTEN_FDS", "1")
+    assert get_systemd_socket(tmp_path.joinpath("x.socket")) is None
+
+
+def test_socket_activation_and_graceful_stop(tmp_path, example_config, testaddr):
+    example_config.get_user(testaddr).set_password("{SHA512-CRYPT}xyz")
+    dict_socket = tmp_path.joinpath("lastlogin.socket")
+    listen_sock = create_listening_socket(dict_socket)
+    inode = os.stat(dict_socket).st_ino
+
+    # pass the listening socket as file descriptor 3 like systemd does
+    code = (
+        "import os, sys; os.dup2(int(sys.argv.pop(1)), 3); "
+        "os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS='1'); "
+        "from chatmaild.lastlogin import main; main()"
+    )
+    fd = listen_sock.fileno()
+    args = [str(fd), str(dict_socket), str(example_config._inipath)]
+    proc = subprocess.Popen([sys.executable, "-c", code, *args], pass_fds=(fd,))
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(dict_socket))
+            request = f"B1\t{testaddr}\nS1\tshared/last-login/{testaddr}\t86400\nC1\n"
+            sock.sendall(request.encode())
+            reader = sock.makefile("rb")
+            assert reader.readline() == b"O\n"
+
+            # the idle connection is closed and the process exits
+            proc.terminate()
+            assert reader.read() == b""
+        assert proc.wait(timeout=10) == 0
+    finally:
+        proc.kill()
+
+    assert os.stat(dict_socket).st_ino == inode
+    listen_sock.close()
+
+
+def test_async_streamed_iterate(tmp_path, example_config):
+    example_config.dictproxy_iterate_chunk_size = 3
+    addresses = [f"user{i}@chat.example.org" for i in range(10)]
+    for addr in addresses:
+        example_config.get_user(addr).set_password("{SHA512-CRYPT}xyz")
+    socket = tmp_path.joinpath("auth.socket")
+    requests = b"I0\t0\tshared/userdb/\nLshared/userdb/x@example.org\tx\n"
+    [res] = run_async_clients(AuthDictProxy(config=example_config), socket, requests)
+    lines = res.decode().split("\n")
+    assert sorted(lines[:10]) == [f"Oshared/userdb/{addr}\t" for addr in addresses]
+    assert lines[10:] == ["", "N", ""]
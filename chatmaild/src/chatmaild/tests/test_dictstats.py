@@ -0,0 +1,102 @@
+import io
+import threading
+
+from chatmaild.dictproxy import DictProxy
+from chatmaild.dictstats import (
+    DictProxyStats,
+    get_stats_socket_path,
+    main,
+    merge_metrics,
+    query_stats_socket,
+    start_stats_server,
+)
+from chatmaild.tests.plugin import get_samples
+
+
+class EchoDictProxy(DictProxy):
+    def handle_lookup(self, parts):
+        return f"O{parts[0]}\n"
+
+
+def test_request_statistics():
+    dictproxy = EchoDictProxy()
+    rfile = io.BytesIO(
+        b"H3\t2\t0\t\techo\nLkey1\nLkey2\nB1\tuser\nS1\tkey\tvalue\nC1\n"
+    )
+    dictproxy.loop_forever(rfile, io.BytesIO())
+    samples = get_samples(dictproxy.stats.render())
+    labels = 'proxy="dictproxy",command'
+    assert samples[f'dictproxy_requests_total{{{labels}="L"}}'] == 2
+    assert samples[f'dictproxy_requests_total{{{labels}="C"}}'] == 1
+    assert samples[f'dictproxy_errors_total{{{labels}="C"}}'] == 1
+    assert samples[f'dictproxy_errors_total{{{labels}="L"}}'] == 0
+    assert samples[f'dictproxy_request_duration_seconds_count{{{labels}="L"}}'] == 2
+    assert (
+        samples[f'dictproxy_request_duration_seconds_bucket{{{labels}="L",le="+Inf"}}']
+        == 2
+    )
+    assert samples['dictproxy_connections{proxy="dictproxy"}'] == 0
+    assert samples['dictproxy_inflight_requests{proxy="dictproxy"}'] == 0
+
+
+def test_inflight_and_connections_while_handling():
+    entered = threading.Event()
+    release = threading.Event()
+
+    class BlockingDictProxy(DictProxy):
+        def handle_lookup(self, parts):
+            entered.set()
+            release.wait()
+            return "N\n"
+
+    dictproxy = BlockingDictProxy()
+    thread = threading.Thread(
+        target=dictproxy.loop_forever, args=(io.BytesIO(b"Lkey\n"), io.BytesIO())
+    )
+    thread.start()
+    entered.wait()
+    samples = get_samples(dictproxy.stats.render())
+    assert samples['dictproxy_connections{proxy="dictproxy"}'] == 1
+    assert samples['dictproxy_inflight_requests{proxy="dictproxy"}'] == 1
+    release.set()
+    thread.join()
+
+
+def test_stats_socket(tmp_path, capsys):
+    socket_path = str(tmp_path.joinpath("echo.socket"))
+    stats_path = get_stats_socket_path(socket_path)
+    assert stats_path == str(tmp_path.joinpath("echo-stats.socket"))
+
+    dictproxy = EchoDictProxy()
+    dictproxy.loop_forever(io.BytesIO(b"Lkey\n"), io.BytesIO())
+    server = start_stats_server(stats_path, dictproxy.handle_stats_command)
+    try:
+        text = query_stats_socket(stats_path)
+        assert text == dictproxy.stats.render()
+        assert "unknown command" in query_stats_socket(stats_path, "xyz")
+
+        main([stats_path])
+        out, _ = capsys.readouterr()
+        assert 'dictproxy_requests_total{proxy="dictproxy",command="L"} 1' in out
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_merge_metrics():
+    texts = []
+    for proxy in ("doveauth", "doveauth", "lastlogin"):
+        stats = DictProxyStats(proxy)
+        stats.start_request()
+        stats.finish_request("L", 0.002, failed=False)
+        texts.append(stats.render())
+
+    merged = merge_metrics(texts)
+    assert merged.count("# TYPE dictproxy_requests_total counter") == 1
+    samples = get_samples(merged)
+    assert samples['dictproxy_requests_total{proxy="doveauth",command="L"}'] == 2
+    assert samples['dictproxy_requests_total{proxy="lastlogin",command="L"}'] == 1
+    key = 'dictproxy_request_duration_seconds_bucket{proxy="doveauth",command="L",le="0.0025"}'
+    assert samples[key] == 2
+    key = 'dictproxy_request_duration_seconds_sum{proxy="doveauth",command="L"}'
+    assert samples[key] == 0.004
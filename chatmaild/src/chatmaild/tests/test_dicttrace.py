@@ -0,0 +1,95 @@
+import io
+import json
+import time
+
+from chatmaild.dictproxy import DictProxy
+from chatmaild.dicttrace import describe_request, hash_address
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.lastlogin import LastLoginDictProxy
+
+
+def get_traces(dictproxy):
+    return [
+        json.loads(line)
+        for line in dictproxy.handle_stats_command("traces").splitlines()
+    ]
+
+
+def test_describe_request_hides_addresses_and_values():
+    addr = "user@example.org"
+    assert describe_request("L", ['shared/passdb/secret"' + addr, addr]) == (
+        "shared/passdb",
+        hash_address(addr),
+    )
+    assert (
+        describe_request("L", ["priv/guid/devicetoken", addr])[0] == "priv/devicetoken"
+    )
+    assert describe_request("S", ["1", f"shared/last-login/{addr}", "123"]) == (
+        "shared/last-login",
+        None,
+    )
+    assert describe_request("I", ["0", "0", "shared/userdb/"]) == (
+        "shared/userdb",
+        None,
+    )
+
+
+def test_tracing_disabled_by_default(example_config):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    assert dictproxy.tracer is None
+    assert dictproxy.handle_stats_command("traces") == ""
+
+
+def test_sampled_traces_record_fs_calls(example_config, testaddr):
+    user = example_config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    dictproxy = LastLoginDictProxy(config=example_config)
+    dictproxy.set_tracing(sample_rate=1.0)
+    requests = f"B1\t{testaddr}\nS1\tshared/last-login/{testaddr}\t86400\nC1\n"
+    dictproxy.loop_forever(io.BytesIO(requests.encode()), io.BytesIO())
+
+    dump = dictproxy.handle_stats_command("traces")
+    assert testaddr not in dump
+    begin, set_, commit = get_traces(dictproxy)
+    assert begin["command"] == "B"
+    assert begin["addr"] == hash_address(testaddr)
+    assert set_["namespace"] == "shared/last-login"
+    assert set_["sampled"]
+    assert "handle" in set_["phases"]
+    # sets are applied when the transaction is committed
+    assert not set_["fs_calls"]
+    assert commit["result"] == "O"
+    assert commit["fs_calls"][0][0] == "os.utime"
+
+
+def test_slow_requests_are_kept_and_logged(caplog):
+    class SlowDictProxy(DictProxy):
+        def handle_lookup(self, parts):
+            if parts[0] == "slow":
+                time.sleep(0.05)
+            return "O\n"
+
+    dictproxy = SlowDictProxy()
+    dictproxy.set_tracing(slow_threshold=0.02, buffer_size=2)
+    dictproxy.loop_forever(io.BytesIO(b"Lfast\nLslow\nLfast\n"), io.BytesIO())
+
+    [trace] = get_traces(dictproxy)
+    assert trace["duration"] >= 0.05
+    assert not trace["sampled"]
+    assert "slow dict request" in caplog.text
+
+
+def test_trace_password_hashing_phase(example_config, gencreds):
+    example_config.public_create_enabled = True
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.set_tracing(sample_rate=1.0)
+    addr, password = gencreds()
+    request = f'Lshared/passdb/{password}"{addr}\t{addr}\n'
+    dictproxy.loop_forever(io.BytesIO(request.encode()), io.BytesIO())
+
+    dump = dictproxy.handle_stats_command("traces")
+    assert password not in dump
+    assert addr not in dump
+    [trace] = get_traces(dictproxy)
+    assert trace["namespace"] == "shared/passdb"
+    assert trace["phases"]["encrypt_password"] <= trace["phases"]["handle"]
@@ -2,6 +2,7 @@ import io
 import json
 import queue
 import threading
+import time
 import traceback
 
 import pytest
@@ -160,3 +161,66 @@ def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
         res = results.get()
         if res is not None:
             pytest.fail(f"concurrent lookup failed\n{res}")
+
+
+def test_iterate_userdb_streams_chunks(example_config, counting_writer):
+    example_config.dictproxy_iterate_chunk_size = 2
+    dictproxy = AuthDictProxy(config=example_config)
+    addresses = [f"user{i}@chat.example.org" for i in range(5)]
+    for addr in addresses:
+        example_config.get_user(addr).set_password("{SHA512-CRYPT}xyz")
+
+    res = dictproxy.handle_dovecot_request("I0\t0\tshared/userdb/", {})
+    chunks = list(res)
+    assert [chunk.count("\n") for chunk in chunks] == [2, 2, 2]
+    lines = "".join(chunks).split("\n")
+    assert sorted(lines[:-2]) == [f"Oshared/userdb/{addr}\t" for addr in addresses]
+    assert lines[-2:] == ["", ""]
+
+    rfile = io.BytesIO(b"I0\t0\tshared/userdb/\nLshared/userdb/x@example.org\tx\n")
+    wfile = counting_writer
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == "".join(chunks).encode() + b"N\n"
+    assert wfile.num_writes == 4
+
+
+def test_concurrent_first_logins_create_once(dictproxy, gencreds, monkeypatch):
+    addr, password = gencreds()
+    # hash on the calling threads to see the patched encrypt_password
+    dictproxy.password_hasher.processes = 0
+    entered = threading.Event()
+    release = threading.Event()
+    encrypted = []
+    encrypt_password = chatmaild.doveauth.encrypt_password
+
+    def blocking_encrypt_password(cleartext_password):
+        encrypted.append(cleartext_password)
+        entered.set()
+        release.wait()
+        return encrypt_password(cleartext_password)
+
+    monkeypatch.setattr(
+        chatmaild.doveauth, "encrypt_password", blocking_encrypt_password
+    )
+    results = queue.Queue()
+
+    def login(password):
+        results.put(dictproxy.lookup_passdb(addr, password))
+
+    first = threading.Thread(target=login, args=(password,))
+    first.start()
+    entered.wait()
+    others = [
+        threading.Thread(target=login, args=(password + str(i),)) for i in range(3)
+    ]
+    for thread in others:
+        thread.start()
+    while dictproxy.flights.shared.values[()] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [first] + others:
+        thread.join()
+
+    assert encrypted == [password]
+    userdata = [results.get() for _ in range(4)]
+    assert all(data == userdata[0] for data in userdata)
@@ -0,0 +1,50 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from chatmaild.dictstats import query_stats_socket
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.hub import create_dictproxies, start_hub
+from chatmaild.lastlogin import LastLoginDictProxy
+from chatmaild.metadata import MetadataDictProxy
+
+
+def test_hub_serves_all_sockets(tmp_path, example_config, gencreds):
+    example_config.public_create_enabled = True
+    testaddr, password = gencreds()
+    sockets = [tmp_path.joinpath(f"{name}.socket") for name in ("auth", "ll", "md")]
+    dictproxies = create_dictproxies(example_config, *map(str, sockets))
+    auth, lastlogin, metadata = dictproxies.values()
+    assert isinstance(auth, AuthDictProxy)
+    assert isinstance(lastlogin, LastLoginDictProxy)
+    assert isinstance(metadata, MetadataDictProxy)
+    assert auth.config is lastlogin.config is example_config
+
+    requests = [
+        f'Lshared/passdb/{password}"{testaddr}\t{testaddr}\n',
+        f"B1\t{testaddr}\nS1\tshared/last-login/{testaddr}\t86400\nC1\n",
+        f"Lpriv/123/devicetoken\t{testaddr}\n",
+    ]
+
+    async def query(socket, request):
+        reader, writer = await asyncio.open_unix_connection(str(socket))
+        writer.write(request.encode())
+        writer.write_eof()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def main():
+        servers = await start_hub(dictproxies, example_config, executor)
+        res = [await query(*args) for args in zip(sockets, requests)]
+        for server in servers:
+            server.close()
+        return res
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        res = asyncio.run(main())
+
+    assert res[0].startswith(b"O{")
+    assert res[1:] == [b"O\n", b"O\n"]
+    assert example_config.get_user(testaddr).get_last_login_timestamp() == 86400
+    stats = query_stats_socket(tmp_path.joinpath("ll-stats.socket"))
+    assert 'dictproxy_requests_total{proxy="lastlogin",command="C"} 1' in stats
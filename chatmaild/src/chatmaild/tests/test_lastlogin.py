@@ -1,9 +1,13 @@
+import io
 import time
 
+import pytest
+
 from chatmaild.doveauth import AuthDictProxy
 from chatmaild.lastlogin import (
     LastLoginDictProxy,
 )
+from chatmaild.tests.plugin import get_samples
 
 
 def test_handle_dovecot_request_last_login(testaddr, example_config):
@@ -19,7 +23,7 @@ def test_handle_dovecot_request_last_login(testaddr, example_config):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert not res
-    assert dictproxy_transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert dictproxy_transactions == {tx: dict(addr=testaddr, res="O\n", sets=[])}
 
     # set last-login info for user
     user = dictproxy.config.get_user(testaddr)
@@ -28,11 +32,94 @@ def test_handle_dovecot_request_last_login(testaddr, example_config):
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert not res
     assert len(dictproxy_transactions) == 1
-    read_timestamp = user.get_last_login_timestamp()
-    assert read_timestamp == timestamp // 86400 * 86400
 
     # finish transaction
     msg = f"C{tx}"
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert res == "O\n"
     assert len(dictproxy_transactions) == 0
+    read_timestamp = user.get_last_login_timestamp()
+    assert read_timestamp == timestamp // 86400 * 86400
+
+
+def login(dictproxy, addr, timestamp):
+    requests = f"B1\t{addr}\nS1\tshared/last-login/{addr}\t{timestamp}\nC1\n"
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(requests.encode()), wfile)
+    assert wfile.getvalue() == b"O\n"
+
+
+@pytest.fixture
+def user(example_config, testaddr):
+    user = example_config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    return user
+
+
+def test_repeated_logins_are_coalesced(example_config, user, monkeypatch):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    get_user_calls = []
+    get_user = example_config.get_user
+    monkeypatch.setattr(
+        example_config,
+        "get_user",
+        lambda addr: get_user_calls.append(addr) or get_user(addr),
+    )
+
+    login(dictproxy, user.addr, 86400 + 10)
+    login(dictproxy, user.addr, 86400 + 20)
+    login(dictproxy, user.addr, 86400 + 30)
+    assert get_user_calls == [user.addr]
+    assert user.get_last_login_timestamp() == 86400
+
+    # the next day is written again
+    login(dictproxy, user.addr, 2 * 86400)
+    assert get_user_calls == [user.addr] * 2
+    assert user.get_last_login_timestamp() == 2 * 86400
+
+    samples = get_samples(dictproxy.stats.render())
+    saved = 'lastlogin_saved_syscalls_total{proxy="lastlogin",syscall="stat"}'
+    assert samples[saved] == 2
+    assert samples['lastlogin_recorded_addresses{proxy="lastlogin"}'] == 1
+
+
+def test_failed_login_record_is_retried(example_config, testaddr):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    login(dictproxy, testaddr, 86400)
+    user = example_config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    login(dictproxy, testaddr, 86400)
+    assert user.get_last_login_timestamp() == 86400
+
+
+def test_logins_are_flushed_in_batches(make_config, testaddr):
+    config = make_config("chat.example.org", dict(lastlogin_flush_interval="60"))
+    user = config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    dictproxy = LastLoginDictProxy(config=config)
+
+    login(dictproxy, testaddr, 86400)
+    login(dictproxy, testaddr, 2 * 86400)
+    assert user.get_last_login_timestamp() != 2 * 86400
+    dictproxy.flush()
+    assert user.get_last_login_timestamp() == 2 * 86400
+
+    samples = get_samples(dictproxy.stats.render())
+    assert samples['lastlogin_flushed_total{proxy="lastlogin"}'] == 1
+    saved = 'lastlogin_saved_syscalls_total{proxy="lastlogin",syscall="utime"}'
+    assert samples[saved] == 1
+
+
+def test_shutdown_flushes_pending_logins(make_config, testaddr):
+    config = make_config("chat.example.org", dict(lastlogin_flush_interval="3600"))
+    user = config.get_user(testaddr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    dictproxy = LastLoginDictProxy(config=config)
+    dictproxy.init_worker(0)
+    assert dictproxy.flusher.is_alive()
+
+    login(dictproxy, testaddr, 86400)
+    assert user.get_last_login_timestamp() != 86400
+    dictproxy.shutdown()
+    assert not dictproxy.flusher.is_alive()
+    assert user.get_last_login_timestamp() == 86400
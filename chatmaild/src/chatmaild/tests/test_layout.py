@@ -0,0 +1,202 @@
+import os
+
+import pytest
+
+from chatmaild.admin_accounts_helper import list_accounts
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import iter_mailboxes
+from chatmaild.layout import get_maildir, get_shard, iter_maildirs
+from chatmaild.metadata import Metadata
+from chatmaild.metrics import main as metrics_main
+from chatmaild.migrate_layout import main as migrate_main
+from chatmaild.migrate_layout import migrate_layout
+
+
+@pytest.fixture
+def flat_config(make_config):
+    return make_config("chat.example.org")
+
+
+@pytest.fixture
+def config(make_config):
+    return make_config("chat.example.org", settings=dict(mailboxes_layout="sharded"))
+
+
+@pytest.fixture(autouse=True)
+def flushed(monkeypatch):
+    flushed = []
+    monkeypatch.setattr("chatmaild.migrate_layout.flush_auth_cache", flushed.append)
+    return flushed
+
+
+def create_account(config, addr):
+    user = config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    return user
+
+
+def test_get_shard():
+    assert get_shard("user@chat.example.org") == ("6c", "d0")
+    assert get_shard("other@chat.example.org") != get_shard("user@chat.example.org")
+
+
+def test_invalid_layout(make_config):
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", settings=dict(mailboxes_layout="deep"))
+
+
+def test_sharded_get_user(config):
+    user = create_account(config, "user@chat.example.org")
+    assert user.maildir == config.mailboxes_dir.joinpath(
+        "6c", "d0", "user@chat.example.org"
+    )
+    assert user.password_path.exists()
+
+
+def test_unmigrated_mailbox_is_found(flat_config, config):
+    flat_user = create_account(flat_config, "user@chat.example.org")
+    assert flat_user.maildir == flat_config.mailboxes_dir / "user@chat.example.org"
+    assert config.get_user("user@chat.example.org").maildir == flat_user.maildir
+    # new accounts are created in the sharded layout
+    maildir = get_maildir(config.mailboxes_dir, "new@chat.example.org", "sharded")
+    assert maildir.parent.parent.parent == config.mailboxes_dir
+
+
+def test_iter_maildirs_finds_both_layouts(flat_config, config):
+    create_account(flat_config, "flat@chat.example.org")
+    sharded = create_account(config, "sharded@chat.example.org")
+    config.mailboxes_dir.joinpath("pending_notifications").mkdir()
+    assert sorted(iter_maildirs(config.mailboxes_dir)) == [
+        (
+            "flat@chat.example.org",
+            str(flat_config.mailboxes_dir / "flat@chat.example.org"),
+        ),
+        ("sharded@chat.example.org", str(sharded.maildir)),
+    ]
+    assert list(iter_maildirs(config.mailboxes_dir / "missing")) == []
+
+
+def test_iter_maildirs_lists_mailboxes_dir_once(flat_config, config, monkeypatch):
+    create_account(flat_config, "flat@chat.example.org")
+    create_account(config, "sharded@chat.example.org")
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(
+        os, "scandir", lambda path: scanned.append(path) or scandir(path)
+    )
+    assert len(list(iter_maildirs(config.mailboxes_dir))) == 2
+    assert scanned.count(config.mailboxes_dir) == 1
+
+
+def test_migrate_layout(flat_config, config, flushed, monkeypatch):
+    for i in range(5):
+        create_account(flat_config, f"user{i}@chat.example.org")
+    with pytest.raises(ValueError):
+        migrate_layout(flat_config)
+
+    sleeps = []
+    monkeypatch.setattr("time.sleep", sleeps.append)
+    assert migrate_layout(config, batch_size=2, pause=0.5, limit=3) == 3
+    assert sleeps == [0.5]
+    # resumed where it stopped
+    assert migrate_layout(config, batch_size=2, pause=0.5) == 2
+
+    for i in range(5):
+        user = config.get_user(f"user{i}@chat.example.org")
+        assert user.password_path.exists()
+        assert user.maildir.parent.name == get_shard(user.addr)[1]
+    assert not any("@" in name for name in os.listdir(config.mailboxes_dir))
+    assert sorted(flushed) == [f"user{i}@chat.example.org" for i in range(5)]
+
+
+def test_migrate_stops_if_auth_cache_flush_fails(config, monkeypatch, capsys):
+    monkeypatch.undo()
+    create_account(config, "a@chat.example.org")
+    config.mailboxes_dir.joinpath("b@chat.example.org").mkdir()
+    config.mailboxes_dir.joinpath("c@chat.example.org").mkdir()
+    monkeypatch.setenv("PATH", "")
+    with pytest.raises(SystemExit):
+        migrate_main([str(config._inipath)])
+    _, err = capsys.readouterr()
+    assert "could not flush Dovecot's auth cache of b@chat.example.org" in err
+    assert config.mailboxes_dir.joinpath("c@chat.example.org").exists()
+
+
+def test_migrate_creates_shards_owned_by_vmail(config, monkeypatch):
+    config.mailboxes_dir.joinpath("user@chat.example.org", "new").mkdir(parents=True)
+    chowned = []
+    monkeypatch.setattr(os, "chown", lambda *args: chowned.append(args))
+    migrate_layout(config)
+    maildir = config.get_user("user@chat.example.org").maildir
+    owner = os.stat(config.mailboxes_dir)
+    assert chowned == [
+        (maildir.parent.parent, owner.st_uid, owner.st_gid),
+        (maildir.parent, owner.st_uid, owner.st_gid),
+    ]
+
+
+def test_migrate_merges_recreated_mailbox(flat_config, config, capsys):
+    user = create_account(flat_config, "user@chat.example.org")
+    user.maildir.joinpath("cur").mkdir()
+    user.maildir.joinpath("cur", "msg1").write_text("one")
+    migrate_main([str(config._inipath)])
+
+    # a client delivered into the flat location while the mailbox was moved
+    user.maildir.joinpath("new").mkdir(parents=True)
+    user.maildir.joinpath("new", "msg2").write_text("two")
+    user.maildir.joinpath("maildirsize").write_text("stale")
+    sharded = config.get_user("user@chat.example.org")
+    sharded.maildir.joinpath("maildirsize").write_text("current")
+    migrate_main([str(config._inipath)])
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == [
+        "moved 1 mailboxes, 0 remaining",
+        "moved 1 mailboxes, 0 remaining",
+    ]
+
+    assert not user.maildir.exists()
+    assert sharded.maildir.joinpath("cur", "msg1").read_text() == "one"
+    assert sharded.maildir.joinpath("new", "msg2").read_text() == "two"
+    assert sharded.maildir.joinpath("maildirsize").read_text() == "current"
+
+
+def test_doveauth_sees_moved_mailbox(flat_config, config):
+    create_account(flat_config, "user@chat.example.org")
+    dictproxy = AuthDictProxy(config=config)
+    assert dictproxy.account_filter is None
+    home = dictproxy.lookup_userdb("user@chat.example.org")["home"]
+    assert home == str(flat_config.mailboxes_dir / "user@chat.example.org")
+
+    migrate_layout(config)
+    home = dictproxy.lookup_userdb("user@chat.example.org")["home"]
+    assert home == str(config.get_user("user@chat.example.org").maildir)
+    assert list(dictproxy.iter_userdb()) == ["user@chat.example.org"]
+
+
+def test_tools_understand_sharded_layout(flat_config, config, capsys):
+    create_account(flat_config, "ci-flat@chat.example.org")
+    for addr in ("a@chat.example.org", "b@chat.example.org"):
+        user = create_account(config, addr)
+        user.maildir.joinpath("cur").mkdir()
+    config.get_user("ci-flat@chat.example.org").maildir.joinpath("cur").mkdir()
+
+    emails = [a["email"] for a in list_accounts(config)]
+    assert emails == [
+        "a@chat.example.org",
+        "b@chat.example.org",
+        "ci-flat@chat.example.org",
+    ]
+
+    mailboxes = iter_mailboxes(str(config.mailboxes_dir), maxnum=None)
+    assert sorted(os.path.basename(m.basedir) for m in mailboxes) == emails
+
+    metrics_main(config.mailboxes_dir)
+    out, _ = capsys.readouterr()
+    assert "\naccounts 3\n" in out
+    assert "\nci_accounts 1\n" in out
+
+    metadata = Metadata(config.mailboxes_dir, "sharded")
+    metadata.add_token_to_addr("a@chat.example.org", "token")
+    path = config.get_user("a@chat.example.org").maildir.joinpath("metadata.json")
+    assert path.exists()
+    assert metadata.get_tokens_for_addr("a@chat.example.org") == ["token"]
@@ -4,15 +4,19 @@ import time
 import pytest
 import requests
 
+from chatmaild.dictstats import Stats
 from chatmaild.metadata import (
     Metadata,
     MetadataDictProxy,
+    create_metadata_dictproxy,
 )
 from chatmaild.notifier import (
+    NewMessageQueue,
     Notifier,
     NotifyThread,
     PersistentQueueItem,
 )
+from chatmaild.tests.plugin import get_samples
 
 
 @pytest.fixture
@@ -106,13 +110,14 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res and not metadata.get_tokens_for_addr(testaddr)
-    assert transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert transactions == {tx: dict(addr=testaddr, res="O\n", sets=[])}
 
     msg = f"S{tx}\tpriv/guid00/devicetoken\t{token}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res
     assert len(transactions) == 1
-    assert metadata.get_tokens_for_addr(testaddr) == [token]
+    # sets are applied on commit
+    assert not metadata.get_tokens_for_addr(testaddr)
 
     msg = f"C{tx}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
@@ -125,10 +130,11 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     assert dictproxy.handle_dovecot_request(f"B{tx2}\t{testaddr}", transactions) is None
     msg = f"S{tx2}\tpriv/guid00/messagenew"
     assert dictproxy.handle_dovecot_request(msg, transactions) is None
-    queue_item = notifier.retry_queues[0].get()[1]
-    assert queue_item.token == token
+    assert notifier.retry_queues[0].empty()
     assert dictproxy.handle_dovecot_request(f"C{tx2}", transactions) == "O\n"
     assert not transactions
+    queue_item = notifier.retry_queues[0].get()[1]
+    assert queue_item.token == token
     assert queue_item.path.exists()
 
 
@@ -149,6 +155,47 @@ def test_handle_dovecot_protocol_set_devicetoken(dictproxy):
     assert dictproxy.metadata.get_tokens_for_addr("user@example.org") == ["01234"]
 
 
+def test_transaction_tokens_are_written_once(dictproxy, testaddr, monkeypatch):
+    modified = []
+    get_metadata_dict = dictproxy.metadata.get_metadata_dict
+
+    def counting_get_metadata_dict(addr):
+        modified.append(addr)
+        return get_metadata_dict(addr)
+
+    monkeypatch.setattr(
+        dictproxy.metadata, "get_metadata_dict", counting_get_metadata_dict
+    )
+    rfile = io.BytesIO(
+        f"B1\t{testaddr}\n"
+        "S1\tpriv/guid00/devicetoken\ttoken1\n"
+        "S1\tpriv/guid00/devicetoken\ttoken2\n"
+        "C1\n".encode()
+    )
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"O\n"
+    assert modified == [testaddr]
+    monkeypatch.undo()
+    assert sorted(dictproxy.metadata.get_tokens_for_addr(testaddr)) == [
+        "token1",
+        "token2",
+    ]
+
+
+def test_transaction_with_unknown_key_is_not_applied(dictproxy, testaddr):
+    rfile = io.BytesIO(
+        f"B1\t{testaddr}\n"
+        "S1\tpriv/guid00/devicetoken\ttoken1\n"
+        "S1\tpriv/guid00/unknown\tvalue\n"
+        "C1\n".encode()
+    )
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"F\n"
+    assert not dictproxy.metadata.get_tokens_for_addr(testaddr)
+
+
 def test_handle_dovecot_protocol_set_get_devicetoken(dictproxy):
     rfile = io.BytesIO(
         b"\n".join(
@@ -266,6 +313,23 @@ def test_start_and_stop_notification_threads(notifier, testaddr):
             t.join()
 
 
+@pytest.mark.parametrize(
+    ("worker_num", "first_start", "requeue"),
+    [(0, True, True), (1, True, False), (0, False, False)],
+)
+def test_init_worker_requeues_once(
+    dictproxy, monkeypatch, worker_num, first_start, requeue
+):
+    calls = []
+    monkeypatch.setattr(
+        dictproxy.notifier,
+        "start_notification_threads",
+        lambda remove_token_from_addr, requeue: calls.append(requeue),
+    )
+    dictproxy.init_worker(worker_num, first_start)
+    assert calls == [requeue]
+
+
 def test_multi_device_notifier(metadata, notifier, testaddr):
     metadata.add_token_to_addr(testaddr, "01234")
     metadata.add_token_to_addr(testaddr, "56789")
@@ -314,6 +378,81 @@ def test_persistent_queue_items(tmp_path, testaddr, token):
     assert not queue_item < item2 and not item2 < queue_item
 
 
+def send_new_message(dictproxy, addr):
+    rfile = io.BytesIO(f"B1\t{addr}\nS1\tpriv/guid00/messagenew\nC1\n".encode())
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"O\n"
+
+
+def get_queue_counts(stats):
+    samples = get_samples(stats.render())
+    return tuple(
+        samples[f"metadata_messagenew_{name}"]
+        for name in ("queued_total", "coalesced_total", "inline_total", "queue_depth")
+    )
+
+
+def test_async_new_message(dictproxy, notifier, metadata, testaddr, testaddr2):
+    stats = Stats()
+    dictproxy.new_messages = NewMessageQueue(notifier, metadata, stats=stats)
+    metadata.add_token_to_addr(testaddr, "01234")
+    metadata.add_token_to_addr(testaddr2, "56789")
+
+    send_new_message(dictproxy, testaddr)
+    send_new_message(dictproxy, testaddr)
+    send_new_message(dictproxy, testaddr2)
+    assert notifier.retry_queues[0].empty()
+    assert not list(notifier.queue_dir.iterdir())
+    assert get_queue_counts(stats) == (2, 1, 0, 2)
+
+    assert dictproxy.new_messages.handle_one()
+    assert dictproxy.new_messages.handle_one()
+    assert get_queue_counts(stats) == (2, 1, 0, 0)
+    tokens = [notifier.retry_queues[0].get()[1].token for _ in range(2)]
+    assert sorted(tokens) == ["01234", "56789"]
+    assert len(list(notifier.queue_dir.iterdir())) == 2
+
+    # queued again after it was handled
+    send_new_message(dictproxy, testaddr)
+    assert get_queue_counts(stats) == (3, 1, 0, 1)
+
+
+def test_async_new_message_queue_full(notifier, metadata, testaddr, testaddr2):
+    stats = Stats()
+    new_messages = NewMessageQueue(notifier, metadata, maxsize=1, stats=stats)
+    metadata.add_token_to_addr(testaddr2, "56789")
+    new_messages.put(testaddr)
+    new_messages.put(testaddr2)
+    assert get_queue_counts(stats) == (1, 0, 1, 1)
+    assert notifier.retry_queues[0].get()[1].token == "56789"
+
+
+def test_async_new_message_queue_is_drained_on_shutdown(
+    dictproxy, notifier, metadata, testaddr, monkeypatch
+):
+    monkeypatch.setattr(notifier, "start_notification_threads", lambda *args, **kw: 0)
+    dictproxy.new_messages = NewMessageQueue(notifier, metadata)
+    metadata.add_token_to_addr(testaddr, "01234")
+    dictproxy.init_worker(0)
+    send_new_message(dictproxy, testaddr)
+    dictproxy.shutdown()
+    assert notifier.retry_queues[0].get()[1].token == "01234"
+    assert dictproxy.new_messages.thread is None
+
+
+def test_notify_mode_from_config(make_config):
+    config = make_config("chat.example.org")
+    assert create_metadata_dictproxy(config).new_messages is None
+    config = make_config(
+        "chat.example.org",
+        dict(metadata_notify_mode="async", metadata_notify_queue_size="10"),
+    )
+    assert create_metadata_dictproxy(config).new_messages.queue.maxsize == 10
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", dict(metadata_notify_mode="later"))
+
+
 def test_iroh_relay(dictproxy):
     rfile = io.BytesIO(
         b"\n".join(
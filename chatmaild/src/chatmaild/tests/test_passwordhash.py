@@ -0,0 +1,137 @@
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from chatmaild.dictproxy import TemporaryFailure
+from chatmaild.dictstats import Stats
+from chatmaild.doveauth import AuthDictProxy, encrypt_password
+from chatmaild.passwordhash import PasswordHasher
+from chatmaild.tests.plugin import get_samples
+
+
+class FakePool:
+    def __init__(self, submit_error=None, result_error=None):
+        self.submit_error = submit_error
+        self.result_error = result_error
+        self.shut_down = False
+
+    def submit(self, func, password):
+        if self.submit_error:
+            raise self.submit_error
+        future = Future()
+        if self.result_error:
+            future.set_exception(self.result_error)
+        else:
+            future.set_result(func(password))
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+@pytest.fixture
+def use_pools(monkeypatch):
+    """Make `PasswordHasher.get_pool` return the given pools in order."""
+    monkeypatch.setattr(PasswordHasher, "_pools", {})
+
+    def use(*pools):
+        pools = list(pools)
+        monkeypatch.setattr(PasswordHasher, "get_pool", lambda self: pools.pop(0))
+
+    return use
+
+
+def test_hash_in_process_pool():
+    hasher = PasswordHasher(processes=1)
+    passhash = hasher.hash(encrypt_password, "secret-password")
+    assert passhash.startswith("{SHA512-CRYPT}$6$")
+
+
+def test_creation_rejected_after_deadline():
+    stats = Stats()
+    hasher = PasswordHasher(processes=0, max_inflight=1, deadline=0.05, stats=stats)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def blocking_hash(password):
+        entered.set()
+        release.wait()
+        return password
+
+    thread = threading.Thread(target=hasher.hash, args=(blocking_hash, "first"))
+    thread.start()
+    entered.wait()
+    assert get_samples(stats.render())["doveauth_account_creations_inflight"] == 1
+
+    start = time.monotonic()
+    with pytest.raises(TemporaryFailure):
+        hasher.hash(blocking_hash, "second")
+    assert time.monotonic() - start >= 0.05
+    release.set()
+    thread.join()
+
+    samples = get_samples(stats.render())
+    assert samples["doveauth_account_creations_rejected_total"] == 1
+    assert samples["doveauth_account_creations_queued"] == 0
+    assert samples["doveauth_account_creations_inflight"] == 0
+    assert samples["doveauth_password_hash_seconds_count"] == 1
+
+
+def test_queued_gauge():
+    stats = Stats()
+    hasher = PasswordHasher(processes=0, max_inflight=1, deadline=5, stats=stats)
+    release = threading.Event()
+    threads = [
+        threading.Thread(target=hasher.hash, args=(lambda p: release.wait(), "x"))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    while get_samples(stats.render())["doveauth_account_creations_queued"] != 2:
+        time.sleep(0.001)
+    assert get_samples(stats.render())["doveauth_account_creations_inflight"] == 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert get_samples(stats.render())["doveauth_account_creations_queued"] == 0
+
+
+def test_broken_pool_fails_temporarily(use_pools):
+    broken = FakePool(result_error=BrokenProcessPool("worker died"))
+    use_pools(broken)
+    stats = Stats()
+    hasher = PasswordHasher(processes=1, stats=stats)
+    with pytest.raises(TemporaryFailure):
+        hasher.hash(str.upper, "x")
+    assert broken.shut_down
+    assert get_samples(stats.render())["doveauth_account_creations_inflight"] == 0
+
+
+def test_discarded_pool_is_replaced(use_pools):
+    discarded = FakePool(submit_error=RuntimeError("cannot schedule new futures"))
+    use_pools(discarded, FakePool())
+    hasher = PasswordHasher(processes=1)
+    assert hasher.hash(str.upper, "x") == "X"
+
+    use_pools(discarded, discarded)
+    with pytest.raises(TemporaryFailure):
+        hasher.hash(str.upper, "x")
+
+
+def test_doveauth_answers_failure_when_creation_rejected(example_config, gencreds):
+    example_config.public_create_enabled = True
+    example_config.doveauth_create_max_inflight = 1
+    example_config.doveauth_create_deadline = 0.01
+    dictproxy = AuthDictProxy(config=example_config)
+    addr, password = gencreds()
+    request = f'Lshared/passdb/{password}"{addr}\t{addr}'
+
+    dictproxy.password_hasher.slots.acquire()
+    assert dictproxy.handle_dovecot_request(request, {}) == "F\n"
+    assert not dictproxy.lookup_userdb(addr)
+
+    dictproxy.password_hasher.slots.release()
+    assert dictproxy.handle_dovecot_request(request, {}).startswith("O")
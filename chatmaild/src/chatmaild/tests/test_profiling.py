@@ -0,0 +1,91 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from chatmaild.dictproxy import DictProxy
+from chatmaild.profiling import Profiler, SamplingProfiler, dump_stacks
+
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+@pytest.fixture
+def busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_function, args=(stop,), name="busy")
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+def test_dump_stacks(busy_thread):
+    text = dump_stacks()
+    assert "thread busy" in text
+    assert "busy_function" in text
+    assert "test_dump_stacks" in text
+
+
+def test_sampling_profiler(busy_thread):
+    session = SamplingProfiler(interval=0.001)
+    session.start()
+    time.sleep(0.1)
+    session.stop()
+    assert session.samples > 0
+    folded = session.format_folded()
+    busy_lines = [line for line in folded.splitlines() if line.startswith("busy;")]
+    assert any("busy_function (tests/test_profiling.py" in line for line in busy_lines)
+    assert "profiler;" not in folded
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in busy_lines) == session.samples
+
+
+def test_profile_commands(tmp_path, busy_thread):
+    dictproxy = DictProxy()
+    assert dictproxy.handle_stats_command("stacks") == "profiling not available\n"
+
+    dictproxy.profiler = Profiler("test", tmp_path)
+    assert dictproxy.handle_stats_command("profile-stop") == "profiling not running\n"
+    assert dictproxy.handle_stats_command("profile-start x").startswith("invalid")
+    for arg in ("0", "-1", "nan", "inf"):
+        res = dictproxy.handle_stats_command(f"profile-start {arg}")
+        assert res.startswith("invalid interval")
+    assert dictproxy.profiler.session is None
+    assert (
+        dictproxy.handle_stats_command("profile-start 0.00001") == "profiling started\n"
+    )
+    assert "already running" in dictproxy.handle_stats_command("profile-start")
+    assert dictproxy.profiler.session.interval == 0.001
+    time.sleep(0.05)
+    res = dictproxy.handle_stats_command("profile-stop")
+    [path] = tmp_path.glob(f"test-{os.getpid()}-*.folded")
+    assert str(path) in res
+    assert "busy_function" in path.read_text()
+
+    res = dictproxy.handle_stats_command("stacks")
+    [path] = tmp_path.glob("*.stacks")
+    assert str(path) in res
+    assert "busy_function" in path.read_text()
+
+
+def test_profile_signals(tmp_path):
+    profiler = Profiler("test", tmp_path)
+    old_handlers = [
+        signal.getsignal(signum) for signum in (signal.SIGUSR1, signal.SIGUSR2)
+    ]
+    try:
+        profiler.install_signal_handlers()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert profiler.session is not None
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert profiler.session is None
+        os.kill(os.getpid(), signal.SIGUSR2)
+    finally:
+        signal.signal(signal.SIGUSR1, old_handlers[0])
+        signal.signal(signal.SIGUSR2, old_handlers[1])
+    assert len(list(tmp_path.glob("*.folded"))) == 1
+    assert len(list(tmp_path.glob("*.stacks"))) == 1
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from chatmaild.dictstats import Stats
+from chatmaild.singleflight import SingleFlight
+
+
+class BlockingCall:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.num_calls = 0
+
+    def __call__(self):
+        self.num_calls += 1
+        self.entered.set()
+        self.release.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def wait_for_shared(flights, num):
+    while flights.shared.values[()] < num:
+        time.sleep(0.001)
+
+
+def start_threads(target, num):
+    threads = [threading.Thread(target=target) for _ in range(num)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_concurrent_calls_share_result():
+    flights = SingleFlight(stats=Stats())
+    func = BlockingCall(result=object())
+    results = []
+
+    def call():
+        results.append(flights.do("key", func))
+
+    threads = start_threads(call, 1)
+    func.entered.wait()
+    threads += start_threads(call, 4)
+    wait_for_shared(flights, 4)
+    func.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert func.num_calls == 1
+    assert results == [func.result] * 5
+    assert "dictproxy_coalesced_requests_total 4" in flights.stats.render()
+
+    # later calls run again
+    assert flights.do("key", lambda: 42) == 42
+    assert not flights.calls
+
+
+def test_different_keys_run_separately():
+    flights = SingleFlight()
+    assert flights.do("a", lambda: 1) == 1
+    assert flights.do("b", lambda: 2) == 2
+
+
+def test_followers_get_exception():
+    flights = SingleFlight(stats=Stats())
+    func = BlockingCall(error=ValueError("failed"))
+    errors = []
+
+    def call():
+        try:
+            flights.do("key", func)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = start_threads(call, 1)
+    func.entered.wait()
+    threads += start_threads(call, 2)
+    wait_for_shared(flights, 2)
+    func.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert func.num_calls == 1
+    assert errors == [func.error] * 3
+    with pytest.raises(ValueError):
+        flights.do("key", func)
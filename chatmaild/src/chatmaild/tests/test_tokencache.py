@@ -0,0 +1,78 @@
+import pytest
+
+from chatmaild.dictstats import Stats
+from chatmaild.filedict import FileDict
+from chatmaild.metadata import Metadata, create_metadata_dictproxy
+from chatmaild.tests.plugin import get_samples
+from chatmaild.tokencache import TokenCache
+
+
+@pytest.fixture
+def stats():
+    return Stats()
+
+
+@pytest.fixture
+def metadata(tmp_path, stats):
+    return Metadata(tmp_path, cache=TokenCache(maxsize=2, stats=stats))
+
+
+def get_counts(stats):
+    samples = get_samples(stats.render())
+    return (
+        samples["metadata_token_cache_hits_total"],
+        samples["metadata_token_cache_misses_total"],
+        samples["metadata_token_cache_evictions_total"],
+    )
+
+
+def test_cache_hit(metadata, stats, testaddr, monkeypatch):
+    metadata.add_token_to_addr(testaddr, "01234")
+    assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
+    assert get_counts(stats) == (1, 0, 0)
+
+    def fail(self):
+        raise AssertionError("metadata.json read")
+
+    monkeypatch.setattr(FileDict, "read", fail)
+    assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
+    assert get_counts(stats) == (2, 0, 0)
+
+
+def test_write_through(metadata, stats, testaddr):
+    metadata.add_token_to_addr(testaddr, "01234")
+    metadata.add_token_to_addr(testaddr, "56789")
+    assert metadata.get_tokens_for_addr(testaddr) == ["01234", "56789"]
+    metadata.remove_token_from_addr(testaddr, "01234")
+    assert metadata.get_tokens_for_addr(testaddr) == ["56789"]
+    assert get_counts(stats) == (2, 0, 0)
+
+
+def test_changes_of_other_processes_are_seen(tmp_path, metadata, stats, testaddr):
+    other = Metadata(tmp_path)
+    assert metadata.get_tokens_for_addr(testaddr) == []
+    assert metadata.get_tokens_for_addr(testaddr) == []
+    assert get_counts(stats) == (1, 1, 0)
+
+    other.add_token_to_addr(testaddr, "01234")
+    assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
+    other.remove_token_from_addr(testaddr, "01234")
+    assert metadata.get_tokens_for_addr(testaddr) == []
+    assert get_counts(stats) == (1, 3, 0)
+
+
+def test_eviction(metadata, stats):
+    for addr in ("a@x.org", "b@x.org", "c@x.org"):
+        metadata.add_token_to_addr(addr, "token")
+    assert list(metadata.cache.entries) == ["b@x.org", "c@x.org"]
+    assert metadata.get_tokens_for_addr("a@x.org") == ["token"]
+    assert list(metadata.cache.entries) == ["c@x.org", "a@x.org"]
+    assert get_counts(stats) == (0, 1, 2)
+    assert get_samples(stats.render())["metadata_token_cache_entries"] == 2
+
+
+def test_cache_size_from_config(make_config):
+    config = make_config("chat.example.org")
+    assert create_metadata_dictproxy(config).metadata.cache.maxsize == 10000
+    config = make_config("chat.example.org", dict(metadata_cache_size="0"))
+    assert create_metadata_dictproxy(config).metadata.cache is None
@@ -0,0 +1,177 @@
+import json
+import time
+
+import pytest
+
+from chatmaild.admin_delete_helper import delete_admin_account
+from chatmaild.expire import main as expiry_main
+from chatmaild.filedict import FileDict
+from chatmaild.metadata import Metadata, create_metadata_dictproxy
+from chatmaild.tokenstore import TokenStore
+from chatmaild.tokenstore import main as token_store_main
+
+
+@pytest.fixture
+def config(make_config):
+    return make_config("chat.example.org", settings=dict(metadata_token_store="true"))
+
+
+@pytest.fixture
+def store(config):
+    store = config.metadata_token_store
+    store.import_metadata_files(config.mailboxes_dir)
+    return store
+
+
+@pytest.fixture
+def metadata(config, store):
+    return Metadata(config.mailboxes_dir, store=store)
+
+
+def test_store_is_disabled_by_default(example_config):
+    assert example_config.metadata_token_store is None
+
+
+def test_metadata_uses_store(config, metadata, testaddr, monkeypatch):
+    def fail(self, *args):
+        raise AssertionError("metadata.json used")
+
+    monkeypatch.setattr(FileDict, "read", fail)
+    monkeypatch.setattr(FileDict, "modify", fail)
+
+    metadata.add_tokens_to_addr(testaddr, ["01234", "56789"])
+    metadata.add_token_to_addr("other@chat.example.org", "01234")
+    assert sorted(metadata.get_tokens_for_addr(testaddr)) == ["01234", "56789"]
+    metadata.remove_token_from_addr(testaddr, "56789")
+    assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
+    assert metadata.get_tokens_for_addr("other@chat.example.org") == ["01234"]
+
+    # rejected by the notification server
+    metadata.remove_invalid_token(testaddr, "01234")
+    assert metadata.get_tokens_for_addr(testaddr) == []
+    assert metadata.get_tokens_for_addr("other@chat.example.org") == []
+    assert not list(config.mailboxes_dir.iterdir())
+
+
+def test_metadata_files_are_used_until_imported(config, capsys):
+    addr = "user@chat.example.org"
+    store = config.metadata_token_store
+    metadata = Metadata(config.mailboxes_dir, store=store)
+    metadata.add_token_to_addr(addr, "01234")
+    assert store.get_tokens(addr) == {}
+    assert metadata.get_tokens_for_addr(addr) == ["01234"]
+
+    token_store_main([str(config._inipath), "import", "--remove"])
+    assert store.get_tokens(addr)
+    assert metadata.get_tokens_for_addr(addr) == ["01234"]
+    metadata.add_token_to_addr(addr, "56789")
+    assert not metadata.get_metadata_dict(addr).path.exists()
+    assert sorted(store.get_tokens(addr)) == ["01234", "56789"]
+
+
+def test_cli_must_run_as_vmail(config, monkeypatch, capsys):
+    monkeypatch.setattr("os.geteuid", lambda: config.mailboxes_dir.stat().st_uid + 1)
+    with pytest.raises(SystemExit):
+        token_store_main([str(config._inipath), "count"])
+    _, err = capsys.readouterr()
+    assert "runuser -u vmail" in err
+    assert not config.metadata_token_store.path.exists()
+
+
+def test_expired_tokens_are_skipped(metadata, store, testaddr):
+    now = int(time.time())
+    store.add_tokens([(testaddr, "old", now - 100 * 86400), (testaddr, "new", now)])
+    assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+    assert store.get_tokens(testaddr) == {"old": now - 100 * 86400, "new": now}
+
+
+def test_add_keeps_newest_timestamp(store, testaddr):
+    store.add_tokens([(testaddr, "01234", 200), (testaddr, "01234", 100)])
+    assert store.get_tokens(testaddr) == {"01234": 200}
+    assert store.count() == 1
+
+
+def test_token_index(store):
+    plan = store.get_connection().execute(
+        "EXPLAIN QUERY PLAN DELETE FROM tokens WHERE token = ?", ("x",)
+    )
+    assert "tokens_token" in " ".join(row[-1] for row in plan)
+
+
+def test_import_metadata_files(config, store, capsys):
+    now = int(time.time())
+    files = Metadata(config.mailboxes_dir)
+    files.add_tokens_to_addr("a@chat.example.org", ["01234", "56789"])
+    files.add_token_to_addr("b@chat.example.org", "456")
+    old = config.get_user("c@chat.example.org").maildir.joinpath("metadata.json")
+    old.parent.mkdir()
+    old.write_text(json.dumps({"devicetoken": ["789"]}))
+    config.get_user("d@chat.example.org").maildir.mkdir()
+
+    token_store_main([str(config._inipath), "import"])
+    out, _ = capsys.readouterr()
+    assert out.startswith("imported 4 tokens from 3 metadata files")
+    assert old.exists()
+
+    token_store_main([str(config._inipath), "import", "--remove"])
+    assert not old.exists()
+    assert not old.with_name("metadata.json.lock").exists()
+    token_store_main([str(config._inipath), "count"])
+    out, _ = capsys.readouterr()
+    assert out.endswith("4\n")
+
+    metadata = Metadata(config.mailboxes_dir, store=store)
+    assert metadata.get_tokens_for_addr("b@chat.example.org") == ["456"]
+    assert store.get_tokens("c@chat.example.org")["789"] >= now
+
+
+def test_import_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr("chatmaild.tokenstore.IMPORT_BATCH_SIZE", 2)
+    vmail_dir = tmp_path.joinpath("vmail")
+    files = Metadata(vmail_dir)
+    for i in range(5):
+        files.add_token_to_addr(f"user{i}@x.org", f"token{i}")
+    store = TokenStore(tmp_path.joinpath("tokens.sqlite"))
+    batches = []
+    add_tokens = store.add_tokens
+    monkeypatch.setattr(store, "add_tokens", batches.append)
+    store.import_metadata_files(vmail_dir)
+    assert [len(items) for items in batches] == [2, 2, 1]
+    for items in batches:
+        add_tokens(items)
+    assert store.count() == 5
+
+
+def test_dictproxy_uses_store(config):
+    dictproxy = create_metadata_dictproxy(config)
+    assert dictproxy.metadata.store is config.metadata_token_store
+    assert dictproxy.metadata.cache is None
+
+
+def test_admin_delete_removes_tokens(config, metadata, store):
+    # the addr fixture would rewrite chatmail.ini without the store
+    addr = "user@chat.example.org"
+    user = config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    metadata.add_token_to_addr(addr, "01234")
+    metadata.add_token_to_addr("other@chat.example.org", "56789")
+
+    status, _ = delete_admin_account(config, addr)
+    assert status == 200
+    assert store.get_tokens(addr) == {}
+    assert metadata.get_tokens_for_addr("other@chat.example.org") == ["56789"]
+
+
+def test_expire_removes_tokens(config, metadata, store):
+    # the addr fixture would rewrite chatmail.ini without the store
+    addr = "user@chat.example.org"
+    user = config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}xyz")
+    user.set_last_login_timestamp(86400)
+    metadata.add_token_to_addr(addr, "01234")
+    metadata.add_token_to_addr("other@chat.example.org", "56789")
+
+    expiry_main([str(config._inipath), "--remove"])
+    assert not user.maildir.exists()
+    assert store.get_tokens(addr) == {}
+    assert metadata.get_tokens_for_addr("other@chat.example.org") == ["56789"]
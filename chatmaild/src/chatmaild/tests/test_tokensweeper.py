@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+
+import pytest
+
+from chatmaild.dictstats import Stats
+from chatmaild.filedict import FileDict
+from chatmaild.metadata import Metadata, TokenSweeper, create_metadata_dictproxy
+from chatmaild.tests.plugin import get_samples
+from chatmaild.tokencache import TokenCache
+from chatmaild.tokenstore import TokenStore
+
+DAY = 86400
+
+
+@pytest.fixture
+def stats():
+    return Stats()
+
+
+def get_counts(stats):
+    samples = get_samples(stats.render())
+    return (
+        samples["metadata_token_sweeps_total"],
+        samples["metadata_expired_tokens_total"],
+    )
+
+
+def write_tokens(metadata, addr, tokens):
+    path = metadata.get_metadata_dict(addr).path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"devicetoken": tokens}))
+
+
+def test_lookup_does_not_rewrite_expired_tokens(tmp_path, testaddr, monkeypatch):
+    metadata = Metadata(tmp_path)
+    now = int(time.time())
+    write_tokens(metadata, testaddr, {"old": now - 100 * DAY, "new": now})
+
+    def fail(self):
+        raise AssertionError("metadata.json rewritten")
+
+    monkeypatch.setattr(FileDict, "modify", fail)
+    assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+
+
+def test_sweep_mailboxes(tmp_path, stats, monkeypatch):
+    metadata = Metadata(tmp_path)
+    now = int(time.time())
+    for i in range(5):
+        write_tokens(metadata, f"user{i}@x.org", {"old": now - 100 * DAY, "new": now})
+    write_tokens(metadata, "valid@x.org", {"new": now})
+    tmp_path.joinpath("nometadata@x.org").mkdir()
+
+    sweeper = TokenSweeper(metadata, interval=DAY, batch_size=3, stats=stats)
+    pauses = []
+    monkeypatch.setattr(sweeper.stopped, "wait", pauses.append)
+    modified = []
+    modify = FileDict.modify
+    monkeypatch.setattr(
+        FileDict, "modify", lambda self: modified.append(self.path) or modify(self)
+    )
+
+    assert sweeper.sweep() == 5
+    assert len(modified) == 5
+    assert pauses == [1.0, 1.0]
+    assert get_counts(stats) == (1, 5)
+    for i in range(5):
+        data = json.loads(metadata.get_metadata_dict(f"user{i}@x.org").path.read_text())
+        assert data == {"devicetoken": {"new": now}}
+    assert sweeper.sweep() == 0
+    assert get_counts(stats) == (2, 5)
+
+
+def test_sweep_does_not_evict_cached_tokens(tmp_path, monkeypatch):
+    metadata = Metadata(tmp_path, cache=TokenCache(maxsize=2))
+    now = int(time.time())
+    metadata.add_token_to_addr("hot@x.org", "hot")
+    for i in range(5):
+        write_tokens(metadata, f"user{i}@x.org", {"old": now - 100 * DAY, "new": now})
+
+    sweeper = TokenSweeper(metadata, interval=DAY, batch_size=100)
+    assert sweeper.sweep() == 5
+    assert list(metadata.cache.entries) == ["hot@x.org"]
+
+    def fail(self):
+        raise AssertionError("metadata.json read")
+
+    monkeypatch.setattr(FileDict, "read", fail)
+    assert metadata.get_tokens_for_addr("hot@x.org") == ["hot"]
+
+
+def test_sweep_skips_deleted_mailbox(tmp_path, stats, monkeypatch):
+    metadata = Metadata(tmp_path)
+    now = int(time.time())
+    for i in range(3):
+        write_tokens(metadata, f"user{i}@x.org", {"old": now - 100 * DAY})
+
+    remove_expired_tokens = metadata.remove_expired_tokens
+
+    def remove_or_fail(addr):
+        if addr == "user1@x.org":
+            raise FileNotFoundError(addr)
+        return remove_expired_tokens(addr)
+
+    monkeypatch.setattr(metadata, "remove_expired_tokens", remove_or_fail)
+    sweeper = TokenSweeper(metadata, interval=DAY, stats=stats)
+    assert sweeper.sweep() == 2
+    assert get_counts(stats) == (1, 2)
+
+
+def test_sweep_token_store(tmp_path, stats, monkeypatch):
+    store = TokenStore(tmp_path.joinpath("tokens.sqlite"))
+    store.import_metadata_files(tmp_path)
+    metadata = Metadata(tmp_path, store=store)
+    now = int(time.time())
+    store.add_tokens([(f"user{i}@x.org", "old", now - 100 * DAY) for i in range(5)])
+    store.add_tokens([("a@x.org", "new", now), ("a@x.org", "future", now + DAY)])
+
+    sweeper = TokenSweeper(metadata, interval=DAY, batch_size=2, stats=stats)
+    pauses = []
+    monkeypatch.setattr(sweeper.stopped, "wait", pauses.append)
+    assert sweeper.sweep() == 6
+    assert pauses == [1.0, 1.0, 1.0]
+    assert store.get_tokens("a@x.org") == {"new": now}
+    assert get_counts(stats) == (1, 6)
+
+
+def test_stopped_sweep(tmp_path):
+    metadata = Metadata(tmp_path)
+    for i in range(3):
+        write_tokens(metadata, f"user{i}@x.org", {})
+    sweeper = TokenSweeper(metadata, interval=DAY, batch_size=1)
+    sweeper.stopped.set()
+    assert sweeper.sweep() is None
+
+
+def test_sweeper_runs_in_first_worker(make_config):
+    config = make_config("chat.example.org", dict(metadata_sweep_interval="3600"))
+    dictproxy = create_metadata_dictproxy(config)
+    sweeper = dictproxy.sweeper
+    assert sweeper.interval == 3600
+    assert sweeper.batch_size == 100
+
+    dictproxy.init_worker(1)
+    assert sweeper.thread is None
+
+    sweeper.initial_delay = 0
+    swept = threading.Event()
+    sweeper.sweep = swept.set
+    dictproxy.init_worker(0)
+    assert swept.wait(10)
+    dictproxy.shutdown()
+    assert not sweeper.thread.is_alive()
+
+    config = make_config("chat.example.org", dict(metadata_sweep_interval="0"))
+    assert create_metadata_dictproxy(config).sweeper is None
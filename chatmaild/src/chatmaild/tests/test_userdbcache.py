@@ -0,0 +1,115 @@
+import shutil
+
+import pytest
+
+from chatmaild.dictstats import Stats
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.tests.plugin import get_samples
+from chatmaild.userdbcache import UserdbCache
+
+
+class FakeClock:
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def stats():
+    return Stats()
+
+
+def create_user(config, addr, password="{SHA512-CRYPT}xyz"):
+    user = config.get_user(addr)
+    user.set_password(password)
+    return user
+
+
+def get_counts(stats):
+    samples = get_samples(stats.render())
+    return (
+        samples["doveauth_userdb_cache_hits_total"],
+        samples["doveauth_userdb_cache_misses_total"],
+    )
+
+
+def test_cache_hit(example_config, testaddr, stats, monkeypatch):
+    cache = UserdbCache(stats=stats)
+    user = create_user(example_config, testaddr)
+    entry = cache.get(user)
+    assert entry.userdb == user.get_userdb_dict()
+    assert get_counts(stats) == (0, 1)
+
+    def fail():
+        raise AssertionError("password file read")
+
+    monkeypatch.setattr(user, "get_userdb_dict", fail)
+    assert cache.get(user) is entry
+    assert get_counts(stats) == (1, 1)
+    assert "doveauth_userdb_cache_entries 1" in stats.render()
+
+
+def test_cache_invalidated_by_new_password(example_config, testaddr):
+    cache = UserdbCache()
+    user = create_user(example_config, testaddr, "{SHA512-CRYPT}old")
+    assert cache.get(user).userdb["password"] == "{SHA512-CRYPT}old"
+    user.set_password("{SHA512-CRYPT}new")
+    assert cache.get(user).userdb["password"] == "{SHA512-CRYPT}new"
+
+
+def test_cache_invalidated_by_deletion(example_config, testaddr):
+    cache = UserdbCache()
+    user = create_user(example_config, testaddr)
+    assert cache.get(user)
+    shutil.rmtree(user.maildir)
+    assert cache.get(user) is None
+    assert not cache.entries
+
+
+def test_cache_ttl(example_config, testaddr, clock):
+    cache = UserdbCache(ttl=10, clock=clock)
+    user = create_user(example_config, testaddr)
+    entry = cache.get(user)
+    clock.now += 9
+    assert cache.get(user) is entry
+    clock.now += 2
+    assert cache.get(user) is not entry
+
+
+def test_cache_lru_eviction(example_config, stats):
+    cache = UserdbCache(maxsize=2, stats=stats)
+    users = [create_user(example_config, f"user{i}@chat.example.org") for i in range(3)]
+    cache.get(users[0])
+    cache.get(users[1])
+    cache.get(users[0])
+    cache.get(users[2])
+    assert list(cache.entries) == [users[0].addr, users[2].addr]
+    assert "doveauth_userdb_cache_entries 2" in stats.render()
+
+
+def test_cache_disabled(example_config, testaddr):
+    cache = UserdbCache(maxsize=0)
+    user = create_user(example_config, testaddr)
+    assert cache.get(user)
+    assert not cache.entries
+
+
+def test_doveauth_lookup_from_cache(example_config, gencreds):
+    example_config.public_create_enabled = True
+    dictproxy = AuthDictProxy(config=example_config)
+    addr, password = gencreds()
+    created = dictproxy.handle_lookup([f'shared/passdb/{password}"{addr}', addr])
+    assert created.startswith("O")
+    assert dictproxy.handle_lookup([f"shared/userdb/{addr}", addr]) == created
+
+    samples = dictproxy.stats.render()
+    assert 'doveauth_userdb_cache_hits_total{proxy="doveauth"} 1' in samples
+
+    shutil.rmtree(example_config.get_user(addr).maildir)
+    assert dictproxy.handle_lookup([f"shared/userdb/{addr}", addr]) == "N\n"
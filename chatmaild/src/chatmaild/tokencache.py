@@ -0,0 +1,82 @@
+"""
+In-memory cache of push notification tokens for chatmail-metadata.
+
+Every new message of a user looks up its device tokens, which otherwise
+means opening and parsing its ``metadata.json``.  `TokenCache` keeps
+the parsed tokens of recently notified users in a bounded LRU mapping.
+
+Entries are validated with a ``stat`` of ``metadata.json``:
+`chatmaild.filedict.FileDict` replaces the file on every change,
+so an entry is only used while the inode, modification time
+and size of the file are unchanged.  `chatmaild.metadata.Metadata` stores
+the tokens it writes together with the validator of the written file,
+other processes' changes are noticed by the next lookup.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class TokenCache:
+    """Bounded LRU cache of token dicts keyed by address."""
+
+    def __init__(self, maxsize=10000, stats=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.stats = stats
+        if stats is not None:
+            self.hits = stats.counter(
+                "metadata_token_cache_hits_total",
+                "number of token lookups answered from the cache",
+            )
+            self.misses = stats.counter(
+                "metadata_token_cache_misses_total",
+                "number of token lookups reading metadata.json",
+            )
+            self.evictions = stats.counter(
+                "metadata_token_cache_evictions_total",
+                "number of cached token dicts evicted to stay within the size limit",
+            )
+            self.size = stats.gauge(
+                "metadata_token_cache_entries", "number of cached token dicts"
+            )
+            self.hits.inc(amount=0)
+            self.misses.inc(amount=0)
+            self.evictions.inc(amount=0)
+            self.size.set(0)
+
+    def get(self, addr, validator):
+        """Return the cached tokens of ``addr`` if they were read
+        from the file identified by ``validator``, otherwise None."""
+        with self.lock:
+            entry = self.entries.get(addr)
+            if entry is not None:
+                if entry[0] == validator:
+                    self.entries.move_to_end(addr)
+                else:
+                    del self.entries[addr]
+                    entry = None
+        self.record(hit=entry is not None)
+        return None if entry is None else entry[1]
+
+    def put(self, addr, validator, tokens):
+        """Cache ``tokens`` read from or written to the file
+        identified by ``validator``."""
+        evicted = 0
+        with self.lock:
+            self.entries[addr] = (validator, tokens)
+            self.entries.move_to_end(addr)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                evicted += 1
+            size = len(self.entries)
+        if self.stats is not None:
+            with self.stats.lock:
+                self.evictions.inc(amount=evicted)
+                self.size.set(size)
+
+    def record(self, hit):
+        if self.stats is not None:
+            with self.stats.lock:
+                (self.hits if hit else self.misses).inc()
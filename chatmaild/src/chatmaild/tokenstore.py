@@ -0,0 +1,228 @@
+"""
+Central store of push notification tokens.
+
+By default chatmail-metadata keeps the device tokens of every account
+in a ``metadata.json`` file in its mailbox, written with a lock file
+and a rename on every token registration.  With ``metadata_token_store = True``
+all tokens are kept in one SQLite database in WAL mode
+next to ``mailboxes_dir`` instead, with one row per address and token.
+The tokens are indexed, so tokens rejected by the notification server
+are removed from all addresses at once.
+
+Tokens of existing ``metadata.json`` files are imported after
+enabling the store and deploying with::
+
+    runuser -u vmail -- chatmail-token-store \
+        /usr/local/lib/chatmaild/chatmail.ini import --remove
+
+which can be run again at any time, e.g. if it was interrupted.
+The command must run as the owner of ``mailboxes_dir``
+because chatmail-metadata could not write a database created by root.
+Until an import has finished, chatmail-metadata keeps using
+the ``metadata.json`` files, so no tokens are missed before the import.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from chatmaild.accountindex import Transaction
+from chatmaild.filedict import FileDict
+from chatmaild.layout import iter_maildirs
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS tokens (
+        addr TEXT NOT NULL,
+        token TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        PRIMARY KEY (addr, token)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS tokens_token ON tokens (token)",
+    "CREATE INDEX IF NOT EXISTS tokens_timestamp ON tokens (timestamp)",
+    # one row for every finished import of metadata.json files
+    "CREATE TABLE IF NOT EXISTS imports (timestamp INTEGER NOT NULL)",
+)
+
+# upsert keeping the newest registration time of a token
+UPSERT = (
+    "INSERT INTO tokens (addr, token, timestamp) VALUES (?, ?, ?) "
+    "ON CONFLICT (addr, token) DO UPDATE "
+    "SET timestamp = max(timestamp, excluded.timestamp)"
+)
+
+# number of metadata.json files imported per transaction
+IMPORT_BATCH_SIZE = 1000
+
+
+class TokenStore:
+    """SQLite database of the device tokens of all addresses.
+
+    Every thread, and every forked process, uses its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.local = threading.local()
+        self.imported = False
+
+    def get_connection(self):
+        local = self.local
+        if getattr(local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def transaction(self):
+        return Transaction(self.get_connection())
+
+    def is_imported(self):
+        """Return True if the tokens of metadata.json files were imported."""
+        if not self.imported:
+            conn = self.get_connection()
+            row = conn.execute("SELECT 1 FROM imports LIMIT 1").fetchone()
+            self.imported = row is not None
+        return self.imported
+
+    def add_tokens(self, items):
+        """Store the ``(addr, token, timestamp)`` tuples in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany(UPSERT, items)
+
+    def get_tokens(self, addr):
+        """Return the ``{token: timestamp}`` dict of ``addr``."""
+        rows = self.get_connection().execute(
+            "SELECT token, timestamp FROM tokens WHERE addr = ?", (addr,)
+        )
+        return dict(rows)
+
+    def remove_token_from_addr(self, addr, token):
+        self.get_connection().execute(
+            "DELETE FROM tokens WHERE addr = ? AND token = ?", (addr, token)
+        )
+
+    def remove_token(self, token):
+        """Remove ``token`` from all addresses."""
+        self.get_connection().execute("DELETE FROM tokens WHERE token = ?", (token,))
+
+    def remove(self, addr):
+        """Remove all tokens of the deleted account ``addr``."""
+        self.get_connection().execute("DELETE FROM tokens WHERE addr = ?", (addr,))
+
+    def remove_expired_tokens(self, oldest, newest, limit):
+        """Remove up to ``limit`` tokens registered before ``oldest``
+        or after ``newest`` and return the number of removed tokens."""
+        cursor = self.get_connection().execute(
+            "DELETE FROM tokens WHERE (addr, token) IN ("
+            "SELECT addr, token FROM tokens WHERE timestamp < ? OR timestamp > ? "
+            "LIMIT ?)",
+            (oldest, newest, limit),
+        )
+        return cursor.rowcount
+
+    def count(self):
+        return (
+            self.get_connection().execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+        )
+
+    def import_metadata_files(self, mailboxes_dir, remove=False, now=None):
+        """Import the tokens of all ``metadata.json`` files in ``mailboxes_dir``,
+        removing the files afterwards if ``remove`` is true,
+        and return the number of imported files and tokens."""
+        if now is None:
+            now = int(time.time())
+        num_files = num_tokens = 0
+        batch = []
+
+        def write_batch():
+            items = [item for _, items in batch for item in items]
+            self.add_tokens(items)
+            if remove:
+                for path, _ in batch:
+                    path.unlink(missing_ok=True)
+                    path.with_name(path.name + ".lock").unlink(missing_ok=True)
+            batch.clear()
+            return len(items)
+
+        for addr, maildir in iter_maildirs(mailboxes_dir):
+            path = Path(maildir, "metadata.json")
+            if not path.exists():
+                continue
+            # see Metadata.DEVICETOKEN_KEY
+            tokens = FileDict(path).read().get("devicetoken", {})
+            if isinstance(tokens, list):
+                tokens = {token: now for token in tokens}
+            batch.append((path, [(addr, t, ts) for t, ts in tokens.items()]))
+            num_files += 1
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                num_tokens += write_batch()
+        num_tokens += write_batch()
+        self.get_connection().execute("INSERT INTO imports VALUES (?)", (now,))
+        return num_files, num_tokens
+
+
+def main(args=None):
+    """Maintain the central push notification token store of a chatmail server"""
+    from chatmaild.config import read_config
+
+    parser = ArgumentParser(description=main.__doc__)
+    ini = "/usr/local/lib/chatmaild/chatmail.ini"
+    parser.add_argument(
+        "chatmail_ini",
+        action="store",
+        nargs="?",
+        help=f"path pointing to chatmail.ini file, default: {ini}",
+        default=ini,
+    )
+    parser.add_argument(
+        "command",
+        choices=["import", "count"],
+        help="'import' stores the tokens of all metadata.json files, "
+        "'count' prints the number of stored tokens",
+    )
+    parser.add_argument(
+        "--remove",
+        action="store_true",
+        help="remove metadata.json files after importing them",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    store = config.metadata_token_store
+    if store is None:
+        print("token store is disabled", file=sys.stderr)
+        return
+    if os.geteuid() != config.mailboxes_dir.stat().st_uid:
+        print(
+            f"must run as the owner of {config.mailboxes_dir}, "
+            "e.g. with 'runuser -u vmail --'",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    if args.command == "count":
+        print(store.count())
+        return
+
+    start = time.time()
+    num_files, num_tokens = store.import_metadata_files(
+        config.mailboxes_dir, remove=args.remove
+    )
+    print(
+        f"imported {num_tokens} tokens from {num_files} metadata files "
+        f"into {store.path} in {time.time() - start:2.2f} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 
 from chatmaild.filedict import write_bytes_atomic
 
@@ -9,13 +10,14 @@ def get_daytimestamp(timestamp) -> int:
 
 
 class User:
-    def __init__(self, maildir, addr, password_path, uid, gid):
+    def __init__(self, maildir, addr, password_path, uid, gid, account_index=None):
         self.maildir = maildir
         self.addr = addr
         self.password_path = password_path
         self.enforce_E2EE_path = maildir.joinpath("enforceE2EEincoming")
         self.uid = uid
         self.gid = gid
+        self.account_index = account_index
 
     @property
     def can_track(self):
@@ -58,21 +60,28 @@ class User:
             logging.error(f"could not write password for: {self.addr}")
             raise
         self.enforce_E2EE_path.touch()
+        if self.account_index is not None:
+            self.account_index.add(self.addr, created=time.time())
 
     def set_last_login_timestamp(self, timestamp):
         """Track login time with daily granularity
-        to minimize touching files and to minimize metadata leakage."""
+        to minimize touching files and to minimize metadata leakage.
+
+        Return False if the timestamp could not be recorded."""
         if not self.can_track:
-            return
+            return False
         try:
             mtime = int(os.stat(self.password_path).st_mtime)
         except FileNotFoundError:
             logging.error(f"Can not get last login timestamp for {self.addr}")
-            return
+            return False
 
         timestamp = get_daytimestamp(timestamp)
         if mtime != timestamp:
             os.utime(self.password_path, (timestamp, timestamp))
+            if self.account_index is not None:
+                self.account_index.set_last_login(self.addr, timestamp)
+        return True
 
     def get_last_login_timestamp(self):
         if self.can_track:
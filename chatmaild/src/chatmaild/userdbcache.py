@@ -0,0 +1,126 @@
+"""
+In-memory cache of userdb dicts for doveauth.
+
+Dovecot looks up the userdb and passdb entry of a user on every
+IMAP and SMTP login and busy clients log in often.
+`UserdbCache` keeps the userdb dicts of recently seen users
+together with their JSON serialization in a bounded LRU mapping.
+
+Entries are validated with a ``stat`` of the password file
+instead of reading it: an entry is only used while the inode
+and modification time of the file are unchanged
+and it is not older than ``ttl`` seconds.
+Setting a password replaces the file and deleting an account removes it,
+so changes made by other processes, e.g. the admin helpers
+or ``chatmail-expire``, take effect with the next lookup.
+"""
+
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from .filedict import get_validator
+
+
+class UserdbEntry:
+    __slots__ = ("userdb", "json", "validator", "expires")
+
+    def __init__(self, userdb, validator, expires):
+        self.userdb = userdb
+        self.json = json.dumps(userdb)
+        self.validator = validator
+        self.expires = expires
+
+
+class UserdbCache:
+    """Bounded LRU cache of userdb entries keyed by address.
+
+    A ``maxsize`` of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, stats=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.stats = stats
+        if stats is not None:
+            self.hits = stats.counter(
+                "doveauth_userdb_cache_hits_total",
+                "number of userdb lookups answered from the cache",
+            )
+            self.misses = stats.counter(
+                "doveauth_userdb_cache_misses_total",
+                "number of userdb lookups reading the password file",
+            )
+            self.size = stats.gauge(
+                "doveauth_userdb_cache_entries", "number of cached userdb entries"
+            )
+            self.hits.inc(amount=0)
+            self.misses.inc(amount=0)
+            self.size.set(0)
+
+    def get(self, user):
+        """Return the `UserdbEntry` of the `User` ``user``
+        or None if the user has no password."""
+        validator = get_validator(user.password_path)
+        if validator is None:
+            self.discard(user.addr)
+            self.record(hit=False)
+            return None
+
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(user.addr)
+            if entry is not None:
+                if (
+                    entry.validator == validator
+                    and entry.expires > now
+                    # the mailbox did not move to another layout
+                    and entry.userdb["home"] == str(user.maildir)
+                ):
+                    self.entries.move_to_end(user.addr)
+                else:
+                    del self.entries[user.addr]
+                    entry = None
+        if entry is not None:
+            self.record(hit=True)
+            return entry
+
+        self.record(hit=False)
+        # a file replaced after the stat above is cached with the old
+        # validator and therefore read again on the next lookup
+        userdb = user.get_userdb_dict()
+        if not userdb:
+            return None
+        entry = UserdbEntry(userdb, validator, now + self.ttl)
+        if self.maxsize:
+            with self.lock:
+                self.entries[user.addr] = entry
+                self.entries.move_to_end(user.addr)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                self.update_size()
+        return entry
+
+    def discard(self, addr):
+        with self.lock:
+            if self.entries.pop(addr, None) is not None:
+                self.update_size()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.update_size()
+
+    def update_size(self):
+        if self.stats is not None:
+            with self.stats.lock:
+                self.size.set(len(self.entries))
+
+    def record(self, hit):
+        if self.stats is not None:
+            with self.stats.lock:
+                (self.hits if hit else self.misses).inc()
@@ -2,6 +2,8 @@ import importlib.resources
 import io
 import os
 
+from pyinfra import host
+from pyinfra.facts.systemd import SystemdEnabled
 from pyinfra.operations import files, server, systemd
 
 
@@ -47,16 +49,34 @@ def activate_remote_units(units) -> None:
             enabled = False
         else:
             enabled = True
+        # Restarting a socket unit would refuse connections while it is down.
+        # Only its service is restarted and takes over the listening socket,
+        # connections arriving meanwhile wait in the socket's backlog.
+        restarted = enabled and not fn.endswith(".socket")
         systemd.service(
             name=f"Setup {basename}",
             service=basename,
             running=enabled,
             enabled=enabled,
-            restarted=enabled,
+            restarted=restarted,
             daemon_reload=True,
         )
 
 
+def deactivate_remote_units(units) -> None:
+    # stop and disable systemd units which were replaced by other units
+    enabled_units = host.get_fact(SystemdEnabled)
+    for fn in units:
+        basename = fn if "." in fn else f"{fn}.service"
+        if enabled_units.get(basename):
+            systemd.service(
+                name=f"Disable {basename}",
+                service=basename,
+                running=False,
+                enabled=False,
+            )
+
+
 class Deployment:
     def install(self, deployer):
         # optional 'required_users' contains a list of (user, group, secondary-group-list) tuples.
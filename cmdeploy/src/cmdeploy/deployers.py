@@ -24,6 +24,7 @@ from .basedeploy import (
     Deployment,
     activate_remote_units,
     configure_remote_units,
+    deactivate_remote_units,
     get_resource,
 )
 from .dovecot.deployer import DovecotDeployer
@@ -50,6 +51,14 @@ class Port(FactBase):
         return output[0]
 
 
+# statistics sockets of doveauth, lastlogin and chatmail-metadata
+DICTPROXY_STATS_SOCKETS = (
+    "/run/doveauth/doveauth-stats.socket",
+    "/run/chatmail-lastlogin/lastlogin-stats.socket",
+    "/run/chatmail-metadata/metadata-stats.socket",
+)
+
+
 def _build_chatmaild(dist_dir) -> None:
     dist_dir = Path(dist_dir).resolve()
     if dist_dir.exists():
@@ -136,7 +145,10 @@ def _configure_remote_venv_with_chatmaild(config) -> None:
         mode="644",
         config={
             "mailboxes_dir": config.mailboxes_dir,
+            "account_index": config.account_index and config.account_index.path,
             "execpath": f"{remote_venv_dir}/bin/chatmail-metrics",
+            "dictstats_execpath": f"{remote_venv_dir}/bin/chatmail-dictstats",
+            "dictstats_sockets": " ".join(DICTPROXY_STATS_SOCKETS),
         },
     )
 
@@ -448,9 +460,26 @@ class JournaldDeployer(Deployer):
 class ChatmailVenvDeployer(Deployer):
     def __init__(self, config):
         self.config = config
-        self.units = (
-            "chatmail-metadata",
-            "lastlogin",
+        if config.dictproxy_hub:
+            dictproxy_units = ("chatmail-hub.socket", "chatmail-hub")
+            # sockets first, otherwise a connection would start the service again
+            self.replaced_units = (
+                "doveauth.socket",
+                "doveauth",
+                "chatmail-metadata.socket",
+                "chatmail-metadata",
+                "lastlogin.socket",
+                "lastlogin",
+            )
+        else:
+            dictproxy_units = (
+                "chatmail-metadata.socket",
+                "chatmail-metadata",
+                "lastlogin.socket",
+                "lastlogin",
+            )
+            self.replaced_units = ("chatmail-hub.socket", "chatmail-hub")
+        self.units = dictproxy_units + (
             "chatmail-expire",
             "chatmail-expire.timer",
             "chatmail-fsreport",
@@ -465,6 +494,9 @@ class ChatmailVenvDeployer(Deployer):
         configure_remote_units(self.config.mail_domain, self.units)
 
     def activate(self):
+        # stop replaced units first because they remove
+        # their runtime directories containing the sockets
+        deactivate_remote_units(self.replaced_units)
         activate_remote_units(self.units)
 
 
@@ -20,7 +20,8 @@ class DovecotDeployer(Deployer):
     def __init__(self, config, disable_mail):
         self.config = config
         self.disable_mail = disable_mail
-        self.units = ["doveauth"]
+        # with dictproxy_hub the chatmail-hub unit serves the doveauth socket
+        self.units = [] if config.dictproxy_hub else ["doveauth.socket", "doveauth"]
 
     def install(self):
         arch = host.get_fact(Arch)
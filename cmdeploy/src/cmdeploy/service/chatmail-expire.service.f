@@ -5,5 +5,7 @@ After=network.target
 [Service]
 Type=oneshot
 User=vmail
+# update the account index from mailboxes changed by other means, if enabled
+ExecStartPre=/usr/local/lib/chatmaild/venv/bin/chatmail-account-index /usr/local/lib/chatmaild/chatmail.ini reconcile
 ExecStart=/usr/local/lib/chatmaild/venv/bin/chatmail-expire /usr/local/lib/chatmaild/chatmail.ini -v --remove
 
@@ -0,0 +1,17 @@
+[Unit]
+Description=Chatmail dict proxies for authentication, last-login tracking and IMAP METADATA
+Requires=chatmail-hub.socket
+After=chatmail-hub.socket
+
+[Service]
+ExecStart={execpath} {config_path}
+Restart=always
+RestartSec=2
+User=vmail
+RuntimeDirectory=doveauth chatmail-lastlogin chatmail-metadata
+# keep the sockets created by the socket unit when stopping
+RuntimeDirectoryPreserve=yes
+UMask=0077
+
+[Install]
+WantedBy=multi-user.target
@@ -1,12 +1,16 @@
 [Unit]
 Description=Chatmail dict proxy for IMAP METADATA
+Requires=chatmail-metadata.socket
+After=chatmail-metadata.socket
 
 [Service]
 ExecStart={execpath} /run/chatmail-metadata/metadata.socket {config_path}
 Restart=always
-RestartSec=30
+RestartSec=2
 User=vmail
 RuntimeDirectory=chatmail-metadata
+# keep the sockets created by the socket unit when stopping
+RuntimeDirectoryPreserve=yes
 UMask=0077
 
 [Install]
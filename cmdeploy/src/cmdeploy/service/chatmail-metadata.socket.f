@@ -0,0 +1,12 @@
+[Unit]
+Description=Socket of the chatmail dict proxy for IMAP METADATA
+
+[Socket]
+ListenStream=/run/chatmail-metadata/metadata.socket
+SocketUser=vmail
+SocketGroup=vmail
+SocketMode=0600
+Backlog=1000
+
+[Install]
+WantedBy=sockets.target
@@ -1,12 +1,16 @@
 [Unit]
 Description=Chatmail dict authentication proxy for dovecot
+Requires=doveauth.socket
+After=doveauth.socket
 
 [Service]
 ExecStart={execpath} /run/doveauth/doveauth.socket {config_path}
 Restart=always
-RestartSec=30
+RestartSec=2
 User=vmail
 RuntimeDirectory=doveauth
+# keep the sockets created by the socket unit when stopping
+RuntimeDirectoryPreserve=yes
 UMask=0077
 
 [Install]
@@ -0,0 +1,12 @@
+[Unit]
+Description=Socket of the chatmail dict authentication proxy for dovecot
+
+[Socket]
+ListenStream=/run/doveauth/doveauth.socket
+SocketUser=vmail
+SocketGroup=vmail
+SocketMode=0600
+Backlog=1000
+
+[Install]
+WantedBy=sockets.target
@@ -1,12 +1,16 @@
 [Unit]
 Description=Dict proxy for last-login tracking
+Requires=lastlogin.socket
+After=lastlogin.socket
 
 [Service]
 ExecStart={execpath} /run/chatmail-lastlogin/lastlogin.socket {config_path}
 Restart=always
-RestartSec=30
+RestartSec=2
 User=vmail
 RuntimeDirectory=chatmail-lastlogin
+# keep the sockets created by the socket unit when stopping
+RuntimeDirectoryPreserve=yes
 
 [Install]
 WantedBy=multi-user.target
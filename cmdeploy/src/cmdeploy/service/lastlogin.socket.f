@@ -0,0 +1,12 @@
+[Unit]
+Description=Socket of the dict proxy for last-login tracking
+
+[Socket]
+ListenStream=/run/chatmail-lastlogin/lastlogin.socket
+SocketUser=vmail
+SocketGroup=vmail
+SocketMode=0600
+Backlog=1000
+
+[Install]
+WantedBy=sockets.target